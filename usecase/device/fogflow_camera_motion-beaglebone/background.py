@@ -0,0 +1,159 @@
+# Background models computing the motion mask of the analysed frames.
+# The model is selected and tuned with the 'background' block of the device profile:
+#   "background": {"model": "running_average", "blur": 21, "threshold": 5, "alpha": 0.5}
+#   "background": {"model": "mog2", "history": 500, "var_threshold": 16, "shadows": true}
+#   "background": {"model": "knn", "history": 500, "dist2_threshold": 400}
+# and any model can run on a downscaled frame, its boxes being mapped back up:
+#   "background": {"model": "running_average", "scale": 0.25}
+
+import logging
+import cv2
+import numpy as np
+
+MODELS = ('running_average', 'mog2', 'knn')
+
+
+class BackgroundModel:
+
+    def __init__(self, workspace, height, width, iterations=2):
+        self.workspace = workspace
+        self.shape = (height, width)
+        self.iterations = iterations  # dilations filling the holes of the mask
+
+    # motion mask of a BGR frame, None while the model starts
+    # the mask is overwritten by the next frame
+    def mask(self, frame):
+        raise NotImplementedError
+
+    # moving objects (x, y, w, h, area) of a BGR frame, None while the model starts
+    def objects(self, frame):
+        mask = self.mask(frame)
+        if mask is None:
+            return None
+        # the mask is rebuilt for every frame, findContours can work on it directly
+        (_, cnts, _) = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return [cv2.boundingRect(c) + (cv2.contourArea(c),) for c in cnts]
+
+    # bounding boxes (x, y, w, h) of the moving objects with at least min_area pixels
+    def boxes(self, frame, min_area):
+        objects = self.objects(frame)
+        if objects is None:
+            return None
+        return [(x, y, w, h) for (x, y, w, h, area) in objects if area >= min_area]
+
+    # dilate the thresholded image to fill in holes
+    def dilate(self, thresh):
+        ws = self.workspace
+        return ws.keep('mask', cv2.dilate(thresh, None, dst=ws.buffer('mask', self.shape),
+                                          iterations=self.iterations))
+
+
+class RunningAverage(BackgroundModel):
+
+    def __init__(self, workspace, height, width, blur=21, threshold=5, alpha=0.5, iterations=2):
+        BackgroundModel.__init__(self, workspace, height, width, iterations)
+        self.blur = (blur, blur)
+        self.threshold = threshold
+        self.alpha = alpha
+        self.started = False
+
+    def mask(self, frame):
+        ws = self.workspace
+        shape = self.shape
+
+        # convert the frame to grayscale, and blur it
+        gray = ws.keep('gray', cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=ws.buffer('gray', shape)))
+        blurred = ws.keep('blurred', cv2.GaussianBlur(gray, self.blur, 0, dst=ws.buffer('blurred', shape)))
+
+        # if the background is empty, initialize it
+        average = ws.buffer('average', shape, dtype=np.float32)
+        if not self.started:
+            logging.info("[INFO] starting background model...")
+            average[...] = blurred
+            self.started = True
+            return None
+
+        # accumulate the weighted average between the current frame and
+        # previous frames, then compute the difference between the current
+        # frame and running average
+        cv2.accumulateWeighted(blurred, average, self.alpha)
+        background = ws.keep('background', cv2.convertScaleAbs(average, dst=ws.buffer('background', shape)))
+        delta = ws.keep('delta', cv2.absdiff(blurred, background, dst=ws.buffer('delta', shape)))
+        delta = ws.keep('delta', cv2.threshold(delta, self.threshold, 255, cv2.THRESH_BINARY, dst=delta)[1])
+        return self.dilate(delta)
+
+
+# OpenCV background subtractors (MOG2 and KNN)
+class Subtractor(BackgroundModel):
+
+    def __init__(self, workspace, height, width, model='mog2', history=500, var_threshold=16,
+                 dist2_threshold=400.0, shadows=False, learning_rate=-1, iterations=2):
+        BackgroundModel.__init__(self, workspace, height, width, iterations)
+        if model == 'mog2':
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(history=history, varThreshold=var_threshold,
+                                                                 detectShadows=shadows)
+        else:
+            self.subtractor = cv2.createBackgroundSubtractorKNN(history=history, dist2Threshold=dist2_threshold,
+                                                                detectShadows=shadows)
+        self.learning_rate = learning_rate
+
+    def mask(self, frame):
+        ws = self.workspace
+        fgmask = ws.keep('fgmask', self.subtractor.apply(frame, fgmask=ws.buffer('fgmask', self.shape),
+                                                         learningRate=self.learning_rate))
+        # shadows are marked with 127, keep only the foreground (255)
+        fgmask = ws.keep('fgmask', cv2.threshold(fgmask, 200, 255, cv2.THRESH_BINARY, dst=fgmask)[1])
+        return self.dilate(fgmask)
+
+
+# runs a model on the frame downscaled by 'scale' and maps its boxes back up
+class Downscaled(BackgroundModel):
+
+    def __init__(self, workspace, height, width, model, scale):
+        BackgroundModel.__init__(self, workspace, height, width)
+        self.model = model
+        self.scale = scale
+        self.size = (model.shape[1], model.shape[0])
+
+    def mask(self, frame):
+        return self.model.mask(self.downscale(frame))
+
+    def downscale(self, frame):
+        ws = self.workspace
+        small = ws.buffer('small', (self.size[1], self.size[0]) + frame.shape[2:])
+        return ws.keep('small', cv2.resize(frame, self.size, dst=small, interpolation=cv2.INTER_AREA))
+
+    def objects(self, frame):
+        objects = self.model.objects(self.downscale(frame))
+        if objects is None:
+            return None
+        (sx, sy) = (self.shape[1] / float(self.size[0]), self.shape[0] / float(self.size[1]))
+        return [(int(x * sx), int(y * sy), int(w * sx), int(h * sy), area * sx * sy)
+                for (x, y, w, h, area) in objects]
+
+
+# create the background model configured in the profile for frames of height x width
+def createBackgroundModel(workspace, height, width, config=None):
+    config = dict(config or {})
+    model = config.pop('model', 'running_average')
+    scale = float(config.pop('scale', 1.0))
+    if model not in MODELS:
+        raise ValueError('invalid background model: ' + str(model))
+    if not 0 < scale <= 1:
+        raise ValueError('invalid background scale: ' + str(scale))
+
+    (h, w) = (height, width)
+    if scale < 1:
+        (h, w) = (max(1, int(round(height * scale))), max(1, int(round(width * scale))))
+        # keep the blur radius proportional to the frame size (odd kernel)
+        if model == 'running_average':
+            config['blur'] = max(1, int(config.get('blur', 21) * scale)) | 1
+
+    if model == 'running_average':
+        bg = RunningAverage(workspace, h, w, **config)
+    else:
+        bg = Subtractor(workspace, h, w, model=model, **config)
+
+    if scale < 1:
+        bg = Downscaled(workspace, height, width, bg, scale)
+    return bg
@@ -6,189 +6,273 @@ import threading
 import signal
 import sys
 import json
-import requests
+import base64
 import logging
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from os import path
 # CameraMotion class
-from imutils import resize
 from imutils.video import VideoStream
 import cv2
-from collections import deque
 import numpy as np
 from datetime import datetime
+from geometry import FrameGeometry, CrossingLines, profileLines
+from tracker import ObjectTracker
+from workspace import FrameWorkspace
+from background import createBackgroundModel
+from scheduler import AdaptiveScheduler
+from parallel import ShardedBackground
+from pipeline import StageQueue, Stage, DROP_OLDEST, DROP_NEWEST
+from ngsi import EntityTemplate
+from ngsi_publisher import NGSIPublisher
+from discovery import BrokerDiscovery
+from image_store import ImageStore
+from image_server import ImageServer
 
 
 # Global variables
 discoveryURL = 'http://10.7.40.146/ngsi9'
 brokerURL = ''
+discovery = None
+publisher = None
+store = None
 profile = {}
+templates = {}  # entity id -> EntityTemplate of the device
 runThread = True
 
 
 class CameraMotion:
 
-    def __init__(self, camera_id, src_video=0, max_width=500, roi=None, min_area=500, crossline=1):
+    def __init__(self, camera_id, src_video=0, max_width=500, roi=None, min_area=500, lines=None,
+                 tracker=None, background=None, scheduler=None, pipeline=None, parallel=None, resolution=None,
+                 picamera=False, callback=None):
         # identification of the camera
         self.camera_id = camera_id
-        # video source (file_name, rtsp_url, or 0:/dev/video0)
-        self.video_stream = VideoStream(src=src_video)
-        # set the maximum width of the frame
-        self.max_width = max_width
-        # region of interest: 'startCol,startLin,endCol,endLin'
-        self.roi = roi
+        # called with every saved crossing, publishMySelf by default
+        self.callback = callback
+        # video source (file_name, rtsp_url, 0:/dev/video0, or the Pi camera module)
+        if picamera:
+            self.video_stream = VideoStream(usePiCamera=True, resolution=tuple(resolution or (640, 480)))
+        else:
+            self.video_stream = VideoStream(src=src_video)
+            # read frames at a reduced resolution when the source allows it (cameras, not files)
+            capture = getattr(self.video_stream.stream, 'stream', None)
+            if resolution is not None and isinstance(src_video, int) and capture is not None:
+                capture.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+                capture.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+        # region of interest: 'startCol,startLin,endCol,endLin', in pixels of the captured frames
         if roi is not None:
-            (startCol, startLin, endCol, endLin) = roi.split(',')
-            self.startCol = int(startCol)
-            self.startLin = int(startLin)
-            self.endCol = int(endCol)
-            self.endLin = int(endLin)
+            roi = tuple(int(v) for v in roi.split(','))
+        # crop and resize to the maximum width, computed once per stream (see geometry.py)
+        self.geometry = FrameGeometry(roi, max_width)
 
         self.min_area = min_area  # consider only objects with this minimum area size
-        self.crossline = crossline  # shape of the cross line to detect motion: 1(-) 2(|) 3(/) 4(\)
-
-    # check if two line segments have an intersection
-    def segment_intersection(self, line1, line2):
-        class Point:
-            def __init__(self, x, y):
-                self.x = x
-                self.y = y
-
-        def ccw(A, B, C):
-            return (C.y - A.y) * (B.x - A.x) > (B.y - A.y) * (C.x - A.x)
-
-        def intersect(A, B, C, D):
-            return ccw(A, C, D) != ccw(B, C, D) and ccw(A, B, C) != ccw(A, B, D)
-
-        x1 = Point(line1[0][0], line1[0][1])
-        y1 = Point(line1[1][0], line1[1][1])
-        x2 = Point(line2[0][0], line2[0][1])
-        y2 = Point(line2[1][0], line2[1][1])
-        return intersect(x1, y1, x2, y2)
-
-    # gets the centroid of the box
-    def centroid(self, pts):
-        coordxcentroid = (pts[0] + pts[0] + pts[2]) // 2
-        coordycentroid = (pts[1] + pts[1] + pts[3]) // 2
-        return (coordxcentroid, coordycentroid)
+        # virtual lines crossed by the moving objects (see geometry.py)
+        if lines is None:
+            lines = profileLines({})
+        self.lines = CrossingLines(lines)
+
+        # background model configuration (see background.py), the model is created with the geometry
+        self.background_config = background
+        self.background = None
+        # motion analysis sharded across processes (see parallel.py), serial without it
+        self.parallel = parallel
+        self.sharded = None
+        # buffers of the motion detection, allocated at the analysis size (see workspace.py)
+        self.workspace = FrameWorkspace()
+        # moving objects tracked across frames (see tracker.py)
+        if tracker is None:
+            tracker = {}
+        self.tracker = ObjectTracker(**tracker)
+
+        # adaptive analysis rate (see scheduler.py), every frame is analysed without it
+        self.scheduler = None
+        if scheduler is not None:
+            self.scheduler = AdaptiveScheduler(**scheduler)
+
+        # staged pipeline: capture -> frames -> analysis -> events -> publish
+        # each queue has its own depth and drop policy (see pipeline.py)
+        if pipeline is None:
+            pipeline = {}
+        self.frames = StageQueue('frames', maxsize=pipeline.get('frame_queue', 4),
+                                 drop_policy=pipeline.get('frame_drop', DROP_OLDEST))
+        self.events = StageQueue('events', maxsize=pipeline.get('event_queue', 32),
+                                 drop_policy=pipeline.get('event_drop', DROP_NEWEST))
+        self.stages = []
+        self.captured = 0
 
     def run(self):
         global runThread
-        firstFrame = None
 
-        # initialize the frame dimensions (we'll set them as soon as we read
-        # the first frame from the video)
-        W = None
-        H = None
-
-        # initialize the list of tracked box
-        # and the coordinate deltas
-        from collections import deque
-        box = deque(maxlen=2)
-        (dX, dY) = (0, 0)
-        direction = ""
+        # analysis and publish stages consume the queues filled by the capture loop
+        analysis = Stage('analysis', self.frames, self.analyze)
+        publisher = Stage('publish', self.events, self.publish)
+        self.stages = [analysis, publisher]
+        analysis.start()
+        publisher.start()
 
         self.video_stream.start()
-        # loop over the frames of the video
-        while runThread:
+        # loop over the frames of the video, capture never waits for the other stages
+        last = None
+        while runThread and not self.frames.closed:
             frame = self.video_stream.read()
             if frame is None:
                 break
+            # the stream returns its latest frame, wait for a new one
+            if frame is last:
+                time.sleep(0.005)
+                continue
+            last = frame
+            self.captured += 1
 
-            # crop ROI (region of interest) from image if required
-            if self.roi is not None:
-                frame = frame[self.startLin:self.endLin, self.startCol:self.endCol]
-
-            # resize the frame
-            frame = resize(frame, width=self.max_width)
-
-            # if the frame dimensions are empty, set them
-            if W is None or H is None:
-                (H, W) = frame.shape[:2]
-                if self.crossline == 1:  # horizontal
-                    crossline = ((0, H // 2), (W, H // 2))
-                elif self.crossline == 2:  # vertical
-                    crossline = ((W // 2, 0), (W // 2, H))
-                elif self.crossline == 3:  # diagonal /
-                    crossline = ((0, H), (W, 0))
-                elif self.crossline == 4:  # diagonal \
-                    crossline = ((0, 0), (W, H))
-                else:
-                    logging.info("[ERROR] invalid cross line parameter")
-                    break
-
-            # convert the frame to grayscale, and blur it
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (21, 21), 0)
-
-            # if the first frame is None, initialize it
-            if firstFrame is None:
-                logging.info("[INFO] starting background model...")
-                firstFrame = gray.copy().astype("float")
+            # while the scene is static only the frames needed by the idle rate are analysed
+            if self.scheduler is not None and not self.scheduler.accept():
                 continue
+            self.frames.put(frame)
 
-            # accumulate the weighted average between the current frame and
-            # previous frames, then compute the difference between the current
-            # frame and running average
-            cv2.accumulateWeighted(src=gray, dst=firstFrame, alpha=0.5)
-            frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(firstFrame))
-            thresh = cv2.threshold(frameDelta, 5, 255, cv2.THRESH_BINARY)[1]
-
-            # dilate the thresholded image to fill in holes, then find contours
-            # on thresholded image
-            thresh = cv2.dilate(thresh, None, iterations=2)
-            (_, cnts, _) = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            # only proceed if at least one contour was found
-            if len(cnts) > 0:
-                # find the largest contour in the mask
-                c = max(cnts, key=cv2.contourArea)
-
-                # if the contour is too small, ignore it
-                if cv2.contourArea(c) >= self.min_area:
-                    # compute the bounding box for the contour
-                    (x, y, w, h) = cv2.boundingRect(c)
-                    box.appendleft((x, y, w, h))
-                else:
-                    box.clear()
-            else:
-                box.clear()
-
-            # track the last two points
-            if len(box) > 1:
-                # compute the centroid line of the moving object
-                objline = (self.centroid(box[0]), self.centroid(box[1]))
-                # check if the object is crossing the crossline
-                if self.segment_intersection(crossline, objline):
-                    dX = self.centroid(box[0])[0] - self.centroid(box[1])[0]
-                    dY = self.centroid(box[0])[1] - self.centroid(box[1])[1]
-                    (dirX, dirY) = ("", "")
-
-                    # ensure there is significant movement in the
-                    # x-direction or y-direction
-                    if np.abs(dX) > 4:
-                        dirX = "Right" if np.sign(dX) == 1 else "Left"
-                    if np.abs(dY) > 4:
-                        dirY = "Down" if np.sign(dY) == 1 else "Up"
-
-                    # handle when both directions are non-empty
-                    if dirX != "" and dirY != "":
-                        direction = "{}-{}".format(dirY, dirX)
-                    # otherwise, only one direction is non-empty
-                    else:
-                        direction = dirX if dirX != "" else dirY
-
-                    (x, y, w, h) = box[0]
-                    frame = frame[y:y+h, x:x+w]
-                    timestamp = datetime.now()
-                    filename = timestamp.strftime(self.camera_id + '_%Y-%m-%d_%H-%M-%S-%f_' + direction + '.jpg')
-                    logging.info("[INFO] captured object: {}".format(filename))
-                    cv2.imwrite(filename, frame)
-                    publishMySelf(filename, timestamp.strftime('%Y-%m-%d_%H-%M-%S-%f'), direction)
-
-        # cleanup the camera
+        # cleanup the camera and drain the pipeline
         logging.info('[INFO] closing video source')
         self.video_stream.stop()
+        self.frames.close()
+        analysis.join()
+        self.drain()
+        self.events.close()
+        publisher.join()
+        logging.info('[INFO] pipeline stats: {}'.format(json.dumps(self.stats())))
+
+    # motion analysis of one captured frame, runs on the analysis stage
+    def analyze(self, frame):
+        # set the geometry up from the first frame (or when the source changes its size)
+        # and place the lines on the analysed frame
+        geometry = self.geometry
+        if frame.shape != geometry.shape:
+            self.drain()
+            geometry.setup(frame.shape)
+            self.lines.setup(geometry.width, geometry.height, scale=geometry.scale)
+            try:
+                self.background = createBackgroundModel(self.workspace, geometry.height, geometry.width,
+                                                        self.background_config)
+            except (ValueError, TypeError) as e:
+                logging.info('[ERROR] invalid background configuration: ' + str(e))
+                # stops the capture loop
+                self.frames.close()
+                return
+            if self.parallel is not None:
+                self.sharded = ShardedBackground(geometry.height, geometry.width, self.background_config,
+                                                 channels=frame.shape[2] if frame.ndim > 2 else 1,
+                                                 **self.parallel)
+
+        if self.sharded is not None:
+            self.analyze_parallel(frame)
+            return
+
+        # crop ROI (region of interest) and resize the frame in one pass
+        frame = geometry.apply(frame)
+
+        # find the moving objects above the minimum area
+        self.workspace.begin()
+        boxes = self.background.boxes(frame, self.min_area)
+        self.workspace.end()
+        self.track(frame, boxes, datetime.now())
+
+    # hand the frame over to the stripe workers and track the frames they have finished
+    def analyze_parallel(self, frame):
+        sharded = self.sharded
+        slot = sharded.acquire()
+        if slot is None:
+            # every slot is in flight, wait for the oldest frame
+            self.collect()
+            slot = sharded.acquire()
+
+        # crop and resize straight into the shared memory slot
+        self.geometry.apply(frame, out=sharded.frames[slot])
+        sharded.submit(slot, datetime.now())
+        while sharded.ready():
+            self.collect()
+
+    # track the oldest frame of the stripe workers
+    def collect(self):
+        (slot, timestamp, objects) = self.sharded.collect()
+        boxes = None
+        if objects is not None:
+            boxes = [(x, y, w, h) for (x, y, w, h, area) in objects if area >= self.min_area]
+        self.track(self.sharded.frames[slot], boxes, timestamp)
+
+    # track the frames still in flight and stop the stripe workers
+    def drain(self):
+        if self.sharded is None:
+            return
+        while self.sharded.inflight() > 0:
+            self.collect()
+        self.sharded.close()
+        self.sharded = None
+
+    # track the moving objects of an analysed frame and report the line crossings
+    def track(self, frame, boxes, timestamp):
+        if boxes is None:
+            return
+        if self.scheduler is not None:
+            self.scheduler.update(len(boxes) > 0)
+
+        # track every object
+        tracks = [t for t in self.tracker.update(boxes) if t.previous() is not None]
+        if len(tracks) == 0:
+            return
+
+        # check the movement of all objects against all lines at once
+        prev = [t.previous() for t in tracks]
+        curr = [t.centroid for t in tracks]
+        for (obj, line, side) in self.lines.crossings(prev, curr):
+            track = tracks[obj]
+            # one crossing event per object and line
+            if line in track.crossed:
+                continue
+            track.crossed.add(line)
+
+            (x, y, w, h) = track.box
+            # hand a copy of the crop over to the publish stage, the frame buffer is reused
+            self.events.put((frame[y:y+h, x:x+w].copy(), timestamp, track.id,
+                             self.direction(prev[obj], curr[obj]), line, side))
+
+    # compass direction of a movement between two centroids
+    def direction(self, prev, curr):
+        dX = curr[0] - prev[0]
+        dY = curr[1] - prev[1]
+        (dirX, dirY) = ("", "")
+
+        # ensure there is significant movement in the
+        # x-direction or y-direction
+        if np.abs(dX) > 4:
+            dirX = "Right" if np.sign(dX) == 1 else "Left"
+        if np.abs(dY) > 4:
+            dirY = "Down" if np.sign(dY) == 1 else "Up"
+
+        # handle when both directions are non-empty
+        if dirX != "" and dirY != "":
+            return "{}-{}".format(dirY, dirX)
+        # otherwise, only one direction is non-empty
+        return dirX if dirX != "" else dirY
+
+    # save and publish one crossing event, runs on the publish stage
+    def publish(self, event):
+        (frame, timestamp, object_id, direction, line, side) = event
+        # name the line in the file only when several lines can be crossed at once
+        suffix = direction if len(self.lines.names) == 1 else line + '_' + direction
+        filename = timestamp.strftime(self.camera_id + '_%Y-%m-%d_%H-%M-%S-%f_' + str(object_id) + '_' + suffix + '.jpg')
+        logging.info("[INFO] captured object: {}".format(filename))
+        # encoded once and served from memory (see image_store.py)
+        store.put_image(filename, frame)
+        callback = self.callback if self.callback is not None else publishMySelf
+        callback(filename, timestamp.strftime('%Y-%m-%d_%H-%M-%S-%f'), object_id, direction, line, side)
+
+    # per-stage counters of the pipeline
+    def stats(self):
+        stats = {'capture': {'frames': self.captured},
+                 'frames': self.frames.stats(), 'events': self.events.stats()}
+        for stage in self.stages:
+            stats[stage.name] = stage.stats()
+        stats['workspace'] = self.workspace.stats()
+        stats['store'] = store.stats()
+        if self.scheduler is not None:
+            stats['scheduler'] = self.scheduler.stats()
+        return stats
 
 ##########################################
 # FogFlow/Main code:
@@ -199,184 +283,157 @@ def signal_handler(signal, frame):
     runThread = False
     # delete my registration and context entity
     unpublishMySelf()
+    # write the pending images
+    if store is not None:
+        store.close()
     sys.exit(0)
 
 
-def loadFile(filename):
-    try:
-        with open(filename, 'rb') as file:
-            return file.read()
-    except Exception as e:
-        logging.info('[ERROR] failed to load file ' + filename)
-        return ''
-
-
 def findNearbyBroker():
-    global profile, discoveryURL
-
-    nearby = {}
-    nearby['latitude'] = profile['location']['latitude']
-    nearby['longitude'] = profile['location']['longitude']
-    nearby['limit'] = 1
-
-    discoveryReq = {}
-    discoveryReq['entities'] = [{'type': 'IoTBroker', 'isPattern': True}]
-    discoveryReq['restriction'] = {'scopes': [{'scopeType': 'nearby', 'scopeValue': nearby}]}
+    global profile, discoveryURL, discovery
 
+    # ranked nearby brokers, refreshed in the background with failover (see discovery.py)
     discoveryURL = profile['discoveryURL']
-    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-    response = requests.post(discoveryURL + '/discoverContextAvailability', data=json.dumps(discoveryReq),
-                             headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to find a nearby IoT Broker')
-        return ''
-
-    logging.info('[INFO] registration successed, json response: ' + response.text)
-    registrations = json.loads(response.text)
-
-    for registration in registrations['contextRegistrationResponses']:
-        providerURL = registration['contextRegistration']['providingApplication']
-        if providerURL != '':
-            return providerURL
-
-    return ''
-
-
-def publishMySelf(filename, timestamp, direction):
-    global profile, brokerURL
+    discovery = BrokerDiscovery(discoveryURL, profile['location'], **profile.get('discovery', {}))
+    return discovery.refresh()
+
+
+# 'inline' block of a device, None unless the mode is enabled; it is opt-in, the
+# profiles ship it disabled as it makes every context update larger
+#   "inline": {"enabled": true, "max_bytes": 16384, "width": 300, "height": 300}
+#   width/height: optional size of the inline variant (see image_store.py)
+def inlineConfig(device):
+    config = device.get('inline')
+    if config is None or not config.get('enabled', True):
+        return None
+    return config
+
+
+# base64 JPEG of a captured image to send inline with the context update, None if the
+# 'inline' mode is off or the image is above its size threshold
+def inlineImage(filename, config):
+    global store
+    if config is None:
+        return None
+    (width, height) = (config.get('width'), config.get('height'))
+    if width is None and height is None:
+        (data, etag, filepath) = store.lookup(filename)
+    else:
+        (data, etag, filepath) = store.variant(filename, width, height)
+    if data is None or len(data) > config.get('max_bytes', 16384):
+        return None
+    return base64.b64encode(data.tobytes()).decode('ascii')
+
+
+def publishMySelf(filename, timestamp, object_id, direction, line, side, device=None):
+    global profile, publisher
+    if device is None:
+        device = profile
+
+    url = 'http://' + device['myIP'] + ':' + str(device['myPort']) + '/' + filename
+    values = [url, timestamp, direction, object_id, line, side]
+    # the operators decode the inline image instead of fetching the url; sent empty when
+    # the image is not inline, so the broker does not keep the one of a previous update
+    config = inlineConfig(device)
+    if config is not None:
+        values.append(inlineImage(filename, config) or '')
+
+    publisher.update(deviceTemplate(device).encode(*values))
+
+
+# template of the device entity, its constant part is serialized the first time the
+# device publishes and only the values of the crossing are encoded afterwards
+def deviceTemplate(device):
+    global templates
+    entityId = 'Device.' + device['type'] + '.' + device['id']
+    template = templates.get(entityId)
+    if template is not None:
+        return template
 
     # device entity
     deviceCtxObj = {}
     deviceCtxObj['entityId'] = {}
-    deviceCtxObj['entityId']['id'] = 'Device.' + profile['type'] + '.' + profile['id']
-    deviceCtxObj['entityId']['type'] = profile['type']
+    deviceCtxObj['entityId']['id'] = entityId
+    deviceCtxObj['entityId']['type'] = device['type']
     deviceCtxObj['entityId']['isPattern'] = False
 
     deviceCtxObj['attributes'] = {}
-    deviceCtxObj['attributes']['url'] = {'type': 'string',
-                                         'value': 'http://' + profile['myIP'] + ':' + str(profile['myPort']) + '/' + filename}
-    deviceCtxObj['attributes']['timestamp'] = {'type': 'string',
-                                         'value': timestamp}
-    deviceCtxObj['attributes']['direction'] = {'type':'string',
-                                             'value': direction}
-    deviceCtxObj['attributes']['iconURL'] = {'type': 'string', 'value': profile['iconURL']}
+    deviceCtxObj['attributes']['iconURL'] = {'type': 'string', 'value': device['iconURL']}
 
     deviceCtxObj['metadata'] = {}
-    deviceCtxObj['metadata']['location'] = {'type': 'point', 'value': {'latitude': profile['location']['latitude'],
-                                                                       'longitude': profile['location']['longitude']}}
-    deviceCtxObj['metadata']['cameraID'] = {'type': 'string', 'value': profile['id']}
+    deviceCtxObj['metadata']['location'] = {'type': 'point', 'value': {'latitude': device['location']['latitude'],
+                                                                       'longitude': device['location']['longitude']}}
+    deviceCtxObj['metadata']['cameraID'] = {'type': 'string', 'value': device['id']}
+
+    dynamic = [('url', 'string'), ('timestamp', 'string'), ('direction', 'string'), ('objectID', 'integer'),
+               ('line', 'string'), ('side', 'string')]
+    if inlineConfig(device) is not None:
+        dynamic.append(('image', 'base64'))
 
-    updateContext(brokerURL, deviceCtxObj)
+    template = EntityTemplate(deviceCtxObj, dynamic)
+    templates[entityId] = template
+    return template
 
 
-def unpublishMySelf():
-    global profile, brokerURL
+def unpublishMySelf(device=None):
+    global profile, publisher
+    if publisher is None:
+        return
+    if device is None:
+        device = profile
 
     # device entity
     deviceCtxObj = {}
     deviceCtxObj['entityId'] = {}
-    deviceCtxObj['entityId']['id'] = 'Device.' + profile['type'] + '.' + profile['id']
-    deviceCtxObj['entityId']['type'] = profile['type']
+    deviceCtxObj['entityId']['id'] = 'Device.' + device['type'] + '.' + device['id']
+    deviceCtxObj['entityId']['type'] = device['type']
     deviceCtxObj['entityId']['isPattern'] = False
 
-    deleteContext(brokerURL, deviceCtxObj)
-
-
-def object2Element(ctxObj):
-    ctxElement = {}
-
-    ctxElement['entityId'] = ctxObj['entityId']
-
-    ctxElement['attributes'] = []
-    if 'attributes' in ctxObj:
-        for key in ctxObj['attributes']:
-            attr = ctxObj['attributes'][key]
-            ctxElement['attributes'].append({'name': key, 'type': attr['type'], 'value': attr['value']})
-
-    ctxElement['domainMetadata'] = []
-    if 'metadata' in ctxObj:
-        for key in ctxObj['metadata']:
-            meta = ctxObj['metadata'][key]
-            ctxElement['domainMetadata'].append({'name': key, 'type': meta['type'], 'value': meta['value']})
-
-    return ctxElement
-
+    # send the pending updates before deleting the entity
+    publisher.close()
+    logging.info('[INFO] publisher stats: ' + json.dumps(publisher.stats()))
+    publisher.delete(deviceCtxObj)
 
-def updateContext(broker, ctxObj):
-    ctxElement = object2Element(ctxObj)
-
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'UPDATE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-    response = requests.post(broker + '/updateContext', data=json.dumps(updateCtxReq), headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to UPDATE context: ' + response.text)
-
-
-def deleteContext(broker, ctxObj):
-    ctxElement = object2Element(ctxObj)
-
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'DELETE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-    response = requests.post(broker + '/updateContext', data=json.dumps(updateCtxReq), headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to DELETE context: ' + response.text)
 
+# create the CameraMotion described by a device profile, None if the profile is invalid
+def createCamera(device, callback=None):
+    try:
+        lines = profileLines(device)
+    except ValueError as e:
+        logging.info('[ERROR] ' + str(e))
+        return None
 
-class RequestHandler(BaseHTTPRequestHandler):
-    # handle GET command
-    def do_GET(self):
-        if self.path == '/timestamp':
-            self.send_response(200)
-            self.send_header
-            self.send_header('timestamp', str(datetime.now()))
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            self.wfile.write(str(datetime.now()))
-            return
-        elif self.path != '/':
-            # send code 200 response
-            filename = self.path[1:]
-            if path.exists(filename):
-                self.send_response(200)
-                ctype = 'image/jpg' if '.jpg' in filename else 'application/json'
-                # send header first
-                self.send_header('Content-type', ctype)
-                self.end_headers()
-
-                # send the image file content to client
-                self.wfile.write(loadFile(filename))
-                return
-        else:
-            self.send_error(404, 'File not Found')
-            return
+    return CameraMotion(camera_id=device['id'], src_video=device['source'], roi=device['roi'],
+        min_area=device['area'], max_width=device.get('max_width', 500), lines=lines,
+        tracker=device.get('tracker'), background=device.get('background'),
+        scheduler=device.get('scheduler'), pipeline=device.get('pipeline'), parallel=device.get('parallel'),
+        resolution=device.get('resolution'), picamera=device.get('picamera', False), callback=callback)
 
 
 def thread_function(name):
     global runThread, profile
     logging.info("[INFO] Thread %s: starting", name)
 
-    camera = CameraMotion(camera_id=profile['id'], src_video=profile['source'], roi=profile['roi'], 
-        min_area=profile['area'], crossline=profile['crossline'])
-    camera.run()
+    camera = createCamera(profile)
+    if camera is not None:
+        camera.run()
 
     logging.info("[INFO] Thread %s: finishing", name)
 
 
 def run():
-    global brokerURL
+    global brokerURL, publisher, store
     brokerURL = findNearbyBroker()
     if brokerURL == '':
         logging.info('[ERROR] failed to find a nearby broker')
         sys.exit(0)
 
+    publisher = NGSIPublisher(brokerURL, discovery=discovery, **profile.get('publisher', {}))
+    publisher.start()
+    discovery.start()
+    store = ImageStore(**profile.get('store', {}))
+    store.start()
+
     thread = threading.Thread(target=thread_function, args=(1,))
     thread.start()
 
@@ -384,7 +441,7 @@ def run():
                  + str(profile['myPort']) + '/<filename>')
     signal.signal(signal.SIGINT, signal_handler)
     server_address = ('0.0.0.0', profile['myPort'])
-    httpd = HTTPServer(server_address, RequestHandler)
+    httpd = ImageServer(server_address, store, prefix='/', **profile.get('server', {}))
     httpd.serve_forever() # blocking function call
 
 
@@ -0,0 +1,162 @@
+# Discovery of the nearby IoT Brokers shared by the device scripts. The ranked list
+# of brokers returned by /discoverContextAvailability (nearest first) is cached and
+# refreshed in the background every ttl seconds. The publisher reports the outcome
+# and latency of every request, and the discovery fails over to the next nearest
+# broker when the one in use keeps failing or gets too slow.
+# Configured with the 'discovery' block of the device profile:
+#   "discovery": {"limit": 3, "ttl": 60, "max_errors": 3, "max_latency": 2.0, "timeout": 5}
+#   limit: brokers kept in the list, max_errors: consecutive failed requests,
+#   max_latency: seconds, average latency of the recent requests
+
+import time
+import json
+import threading
+import logging
+import requests
+
+HEADERS = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+
+
+class BrokerStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.latency = None  # moving average of the recent requests
+        self.total_latency = 0.0
+        self.down_until = 0.0  # not used again before this time after a failover
+
+    def report(self, ok, latency):
+        self.requests += 1
+        self.total_latency += latency
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if ok:
+            self.consecutive_errors = 0
+        else:
+            self.errors += 1
+            self.consecutive_errors += 1
+
+    def stats(self):
+        return {'requests': self.requests, 'errors': self.errors,
+                'consecutive_errors': self.consecutive_errors,
+                'latency': round(self.latency, 6) if self.latency is not None else None,
+                'avg_latency': round(self.total_latency / self.requests, 6) if self.requests > 0 else 0.0}
+
+
+class BrokerDiscovery(threading.Thread):
+
+    def __init__(self, discoveryURL, location, limit=3, ttl=60, max_errors=3, max_latency=2.0, timeout=5,
+                 min_requests=5):
+        threading.Thread.__init__(self, name='broker-discovery')
+        self.daemon = True
+        self.discoveryURL = discoveryURL
+        self.location = location
+        self.limit = max(1, int(limit))
+        self.ttl = ttl
+        self.max_errors = max(1, int(max_errors))
+        self.max_latency = max_latency
+        self.timeout = timeout
+        self.min_requests = min_requests  # requests before the latency is trusted
+
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.brokers = []  # ranked broker URLs, nearest first
+        self.broker = ''  # broker in use
+        self.brokerStats = {}
+
+        # counters
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.failovers = 0
+        self.last_refresh = 0.0
+
+    # query the discovery for the nearby brokers, returns the broker in use
+    def refresh(self):
+        nearby = {}
+        nearby['latitude'] = self.location['latitude']
+        nearby['longitude'] = self.location['longitude']
+        nearby['limit'] = self.limit
+
+        discoveryReq = {}
+        discoveryReq['entities'] = [{'type': 'IoTBroker', 'isPattern': True}]
+        discoveryReq['restriction'] = {'scopes': [{'scopeType': 'nearby', 'scopeValue': nearby}]}
+
+        brokers = []
+        try:
+            response = requests.post(self.discoveryURL + '/discoverContextAvailability',
+                                     data=json.dumps(discoveryReq), headers=HEADERS, timeout=self.timeout)
+            if response.status_code != 200:
+                raise ValueError(response.text)
+            registrations = json.loads(response.text)
+            for registration in registrations.get('contextRegistrationResponses') or []:
+                providerURL = registration['contextRegistration']['providingApplication']
+                if providerURL != '' and providerURL not in brokers:
+                    brokers.append(providerURL)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.refresh_errors += 1
+            logging.info('[ERROR] failed to find a nearby IoT Broker: ' + str(e))
+
+        with self.lock:
+            self.refreshes += 1
+            self.last_refresh = time.time()
+            # keep the cached list when the discovery cannot be reached
+            if len(brokers) > 0:
+                self.brokers = brokers
+                for broker in brokers:
+                    if broker not in self.brokerStats:
+                        self.brokerStats[broker] = BrokerStats()
+            if self.broker not in self.brokers or self.brokerStats[self.broker].down_until > time.time():
+                self.select()
+            return self.broker
+
+    # use the nearest broker that is not down, the nearest one if they all are
+    def select(self):
+        now = time.time()
+        previous = self.broker
+        available = [b for b in self.brokers if self.brokerStats[b].down_until <= now]
+        if len(available) > 0:
+            self.broker = available[0]
+        elif len(self.brokers) > 0:
+            self.broker = self.brokers[0]
+        if self.broker != previous:
+            logging.info('[INFO] using the IoT Broker ' + self.broker)
+
+    # broker the requests are sent to
+    def current(self):
+        with self.lock:
+            return self.broker
+
+    # outcome of a request sent to a broker, may fail over to the next one
+    def report(self, broker, ok, latency):
+        with self.lock:
+            stats = self.brokerStats.get(broker)
+            if stats is None:
+                return
+            stats.report(ok, latency)
+            if broker != self.broker:
+                return
+            slow = (self.max_latency is not None and stats.requests >= self.min_requests
+                    and stats.latency > self.max_latency)
+            if stats.consecutive_errors >= self.max_errors or slow:
+                logging.info('[WARN] IoT Broker ' + broker + (' too slow' if slow else ' failing')
+                             + ', failing over')
+                stats.down_until = time.time() + self.ttl
+                # start afresh if it is used again
+                stats.consecutive_errors = 0
+                stats.latency = None
+                self.failovers += 1
+                self.select()
+
+    def close(self):
+        self.event.set()
+
+    def run(self):
+        while not self.event.wait(self.ttl):
+            self.refresh()
+
+    def stats(self):
+        with self.lock:
+            return {'broker': self.broker, 'brokers': self.brokers, 'refreshes': self.refreshes,
+                    'refresh_errors': self.refresh_errors, 'failovers': self.failovers,
+                    'per_broker': dict((b, s.stats()) for (b, s) in self.brokerStats.items())}
@@ -6,12 +6,15 @@ import numpy as np
 import signal
 import sys
 import json
-import requests
 import logging
+from ngsi_publisher import NGSIPublisher
+from discovery import BrokerDiscovery
 
 
 discoveryURL = 'http://10.7.40.146/ngsi9'
 brokerURL = ''
+discovery = None
+publisher = None
 profile = {}
 runThread = True
 
@@ -36,38 +39,17 @@ def loadImage(file):
         return ''
 
 
-def findNearbyBroker():    
-    global profile, discoveryURL
+def findNearbyBroker():
+    global profile, discoveryURL, discovery
 
-    nearby = {}
-    nearby['latitude'] = profile['location']['latitude']
-    nearby['longitude'] = profile['location']['longitude'] 
-    nearby['limit'] = 1
- 
-    discoveryReq = {}
-    discoveryReq['entities'] = [{'type': 'IoTBroker', 'isPattern': True}]
-    discoveryReq['restriction'] = {'scopes':[{'scopeType': 'nearby', 'scopeValue': nearby}]}
-    
+    # ranked nearby brokers, refreshed in the background with failover (see discovery.py)
     discoveryURL = profile['discoveryURL']
-    headers = {'Accept' : 'application/json', 'Content-Type' : 'application/json'}
-    response = requests.post(discoveryURL + '/discoverContextAvailability', data=json.dumps(discoveryReq), 
-                             headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to find a nearby IoT Broker')
-        return ''
-    
-    logging.info('[INFO] registration successed, json response: ' + response.text)
-    registrations = json.loads(response.text)
-    
-    for registration in registrations['contextRegistrationResponses']:
-        providerURL = registration['contextRegistration']['providingApplication']
-        if providerURL != '':
-            return providerURL
-          
-    return '' 
-    
+    discovery = BrokerDiscovery(discoveryURL, profile['location'], **profile.get('discovery', {}))
+    return discovery.refresh()
+
+
 def publishMySelf():
-    global profile, brokerURL
+    global profile, publisher
     
     # device entity
     deviceCtxObj = {}
@@ -84,11 +66,13 @@ def publishMySelf():
     deviceCtxObj['metadata']['location'] = {'type': 'point', 'value': {'latitude': profile['location']['latitude'], 'longitude': profile['location']['longitude'] }}
     deviceCtxObj['metadata']['cameraID'] = {'type': 'string', 'value': profile['id']}
 
-    updateContext(brokerURL, deviceCtxObj)
+    publisher.update(deviceCtxObj)
 
 
 def unpublishMySelf():
-    global profile, brokerURL
+    global profile, publisher
+    if publisher is None:
+        return
 
     # device entity
     deviceCtxObj = {}
@@ -97,60 +81,18 @@ def unpublishMySelf():
     deviceCtxObj['entityId']['type'] = profile['type']        
     deviceCtxObj['entityId']['isPattern'] = False
     
-    deleteContext(brokerURL, deviceCtxObj) 
-
-def object2Element(ctxObj):
-    ctxElement = {}
-    
-    ctxElement['entityId'] = ctxObj['entityId'];
-    
-    ctxElement['attributes'] = []  
-    if 'attributes' in ctxObj:
-        for key in ctxObj['attributes']:
-            attr = ctxObj['attributes'][key]
-            ctxElement['attributes'].append({'name': key, 'type': attr['type'], 'value': attr['value']})
-    
-    ctxElement['domainMetadata'] = []
-    if 'metadata' in ctxObj:    
-        for key in ctxObj['metadata']:
-            meta = ctxObj['metadata'][key]
-            ctxElement['domainMetadata'].append({'name': key, 'type': meta['type'], 'value': meta['value']})
-    
-    return ctxElement
-
-def updateContext(broker, ctxObj):        
-    ctxElement = object2Element(ctxObj)
-    
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'UPDATE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept' : 'application/json', 'Content-Type' : 'application/json'}
-    response = requests.post(broker + '/updateContext', data=json.dumps(updateCtxReq), headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to UPDATE context: ' + response.text)
-
-
-def deleteContext(broker, ctxObj):        
-    ctxElement = object2Element(ctxObj)
-    
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'DELETE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept' : 'application/json', 'Content-Type' : 'application/json'}
-    response = requests.post(broker + '/updateContext', data=json.dumps(updateCtxReq), headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to DELETE context: ' + response.text)
+    # send the pending updates before deleting the entity
+    publisher.close()
+    logging.info('[INFO] publisher stats: ' + json.dumps(publisher.stats()))
+    publisher.delete(deviceCtxObj)
 
 
 class RequestHandler(BaseHTTPRequestHandler):  
   #handle GET command
   def do_GET(self):
     try:
-      if self.path == '/image':
+      # the query string is ignored, the fake camera has no variants
+      if self.path.split('?')[0] == '/image':
 
         #send code 200 response
         self.send_response(200)
@@ -162,6 +104,8 @@ class RequestHandler(BaseHTTPRequestHandler):
         #send the image file content to client
         self.wfile.write(loadImage('content.jpg'))
         return
+
+      self.send_error(404, 'not found')
       
     except IOError:
       self.send_error(404, 'error to fetch images from the camera')
@@ -180,11 +124,15 @@ def thread_function(name):
 
 
 def run():
-    global brokerURL
+    global brokerURL, publisher
     brokerURL = findNearbyBroker()
     if brokerURL == '':
         logging.info('[ERROR] failed to find a nearby broker')
         sys.exit(0)
+
+    publisher = NGSIPublisher(brokerURL, discovery=discovery, **profile.get('publisher', {}))
+    publisher.start()
+    discovery.start()
         
     #announce myself        
     publishMySelf()
@@ -0,0 +1,157 @@
+# Virtual lines (tripwires and polylines) crossed by the tracked objects.
+# Lines are read from the 'lines' list of the device profile:
+#   "lines": [{"name": "lane-1", "points": [[10, 200], [250, 180], [480, 240]]},
+#             {"name": "exit", "points": [[0.5, 0], [0.5, 1]], "relative": true,
+#              "directions": ["entering", "exiting"]}]
+# 'points' are pixels of the ROI (cropped source frame), or fractions of the frame
+# when 'relative' is true. 'directions' names the side an object moves to:
+# [<to the left of the line>, <to the right of the line>], following the point order.
+
+import cv2
+import numpy as np
+
+# legacy 'crossline' modes: 1(-) 2(|) 3(/) 4(\)
+CROSSLINES = {1: [[0, 0.5], [1, 0.5]],
+              2: [[0.5, 0], [0.5, 1]],
+              3: [[0, 1], [1, 0]],
+              4: [[0, 0], [1, 1]]}
+
+
+# build the line configuration from the profile, falling back to the legacy crossline mode
+def profileLines(profile):
+    if profile.get('lines'):
+        return profile['lines']
+    crossline = profile.get('crossline', 1)
+    if crossline not in CROSSLINES:
+        raise ValueError('invalid cross line parameter: ' + str(crossline))
+    return [{'name': 'crossline', 'points': CROSSLINES[crossline], 'relative': True}]
+
+
+class FrameGeometry:
+
+    def __init__(self, roi=None, max_width=500):
+        # region of interest: (startCol, startLin, endCol, endLin) in source pixels
+        self.roi = roi
+        self.max_width = max_width
+        # shape of the source frames the geometry was computed for
+        self.shape = None
+
+    # precompute the crop and resize of the frames with the given shape
+    def setup(self, shape):
+        (height, width) = shape[:2]
+        if self.roi is None:
+            (startCol, startLin, endCol, endLin) = (0, 0, width, height)
+        else:
+            (startCol, startLin, endCol, endLin) = self.roi
+            (startCol, endCol) = (max(0, startCol), min(width, endCol))
+            (startLin, endLin) = (max(0, startLin), min(height, endLin))
+        self.rows = slice(startLin, endLin)
+        self.cols = slice(startCol, endCol)
+
+        # same output size as imutils.resize(roi, width=max_width)
+        self.scale = self.max_width / float(endCol - startCol)
+        self.width = self.max_width
+        self.height = int((endLin - startLin) * self.scale)
+
+        self.resize = self.width != endCol - startCol
+        self.out = None
+        if self.resize:
+            # output buffer reused by every frame
+            self.out = np.empty((self.height, self.width) + tuple(shape[2:]), dtype=np.uint8)
+        self.shape = shape
+
+    # returns the ROI of the frame at the analysis size; the result is overwritten
+    # by the next call, copy what has to outlive the frame
+    # out: optional buffer the result is written in (e.g. shared memory)
+    def apply(self, frame, out=None):
+        if not self.resize:
+            # the ROI already has the analysis size: just a view of the frame
+            if out is None:
+                return frame[self.rows, self.cols]
+            out[...] = frame[self.rows, self.cols]
+            return out
+        # INTER_AREA as imutils.resize: INTER_LINEAR aliases when downscaling, which
+        # changes the motion mask and what its thresholds detect
+        return cv2.resize(frame[self.rows, self.cols], (self.width, self.height),
+                          dst=self.out if out is None else out, interpolation=cv2.INTER_AREA)
+
+
+class CrossingLines:
+
+    def __init__(self, lines):
+        if len(lines) == 0:
+            raise ValueError('at least one line is required')
+        self.lines = lines
+        self.names = []
+        self.directions = []
+        for (i, line) in enumerate(lines):
+            if len(line['points']) < 2:
+                raise ValueError('line ' + str(line.get('name', i)) + ' needs at least two points')
+            self.names.append(str(line.get('name', 'line-' + str(i))))
+            self.directions.append(line.get('directions', ['left', 'right']))
+        # segments of all lines stacked in two (k, 2) arrays, filled by setup()
+        self.starts = None
+        self.ends = None
+        self.owner = None
+
+    # compute the segments in the pixels of the analysed frame
+    #   width, height: size of the analysed frame
+    #   scale: factor from ROI pixels to analysed frame pixels
+    def setup(self, width, height, scale=1.0):
+        starts = []
+        ends = []
+        owner = []
+        for (i, line) in enumerate(self.lines):
+            pts = np.asarray(line['points'], dtype=np.float64)
+            if line.get('relative', False):
+                pts = pts * np.array([width, height], dtype=np.float64)
+            else:
+                pts = pts * scale
+            starts.append(pts[:-1])
+            ends.append(pts[1:])
+            owner.extend([i] * (len(pts) - 1))
+        self.starts = np.concatenate(starts)
+        self.ends = np.concatenate(ends)
+        self.owner = np.asarray(owner, dtype=np.intp)
+
+    # test n movement segments against every line segment in one pass
+    #   prev, curr: (n, 2) arrays with the previous and current object centroids
+    # returns a list of (object index, line name, line direction), one per crossed line
+    def crossings(self, prev, curr):
+        prev = np.asarray(prev, dtype=np.float64).reshape(-1, 1, 2)
+        curr = np.asarray(curr, dtype=np.float64).reshape(-1, 1, 2)
+        if prev.shape[0] == 0:
+            return []
+        C = self.starts[np.newaxis]
+        D = self.ends[np.newaxis]
+
+        # orientation of the centroids against each line segment and vice versa
+        CD = D - C
+        AB = curr - prev
+        d1 = cross2d(CD, prev - C)
+        d2 = cross2d(CD, curr - C)
+        d3 = cross2d(AB, C - prev)
+        d4 = cross2d(AB, D - prev)
+        # half-open sides (zero is the left side): a centroid landing on the line, or a
+        # movement through the vertex of a polyline, crosses exactly once
+        hits = ((d1 <= 0) != (d2 <= 0)) & ((d3 <= 0) != (d4 <= 0))
+
+        (objs, segs) = np.nonzero(hits)
+        if len(objs) == 0:
+            return []
+
+        # a polyline is crossed once even if the movement cuts several of its segments
+        pairs = objs * len(self.lines) + self.owner[segs]
+        (_, first) = np.unique(pairs, return_index=True)
+        events = []
+        for k in first:
+            (obj, seg) = (objs[k], segs[k])
+            line = self.owner[seg]
+            # image coordinates grow downwards: a negative cross product is the left side
+            side = 0 if d2[obj, seg] <= 0 else 1
+            events.append((int(obj), self.names[line], self.directions[line][side]))
+        return events
+
+
+def cross2d(u, v):
+    return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
@@ -0,0 +1,180 @@
+# Motion analysis of one camera sharded across CPU cores. The analysed frame is
+# split in horizontal stripes, each owned by a worker process with its own
+# background model. Frames are handed over in shared memory slots (no pickled
+# arrays): the producer writes a frame in a free slot and only the slot index goes
+# through the queues. Each worker returns the objects of its stripe, which are
+# merged across the stripe boundaries. Results are collected in submission order,
+# so the tracker sees the frames in the order they were captured.
+# Configured with the 'parallel' block of the device profile:
+#   "parallel": {"workers": 4, "depth": 3}
+#   workers: processes (default: number of CPUs), depth: frames in flight
+
+import signal
+import logging
+import multiprocessing
+from collections import deque
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+import cv2
+import numpy as np
+from workspace import FrameWorkspace
+from background import createBackgroundModel
+
+
+def stripe_worker(index, buffer, shape, depth, rows, halo, config, tasks, results):
+    # the parent process handles the signals and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the cores are used by the other workers
+    cv2.setNumThreads(1)
+
+    frames = np.frombuffer(buffer, dtype=np.uint8).reshape((depth,) + shape)
+    (start, end) = rows
+    # extra rows above and below the stripe, so blur and dilation match the full frame
+    (top, bottom) = (max(0, start - halo), min(shape[0], end + halo))
+    model = createBackgroundModel(FrameWorkspace(), bottom - top, shape[1], config)
+
+    while True:
+        slot = tasks.get()
+        if slot is None:
+            break
+
+        objects = model.objects(frames[slot, top:bottom])
+        if objects is not None:
+            # keep the part of the objects inside the stripe, in frame coordinates
+            clipped = []
+            for (x, y, w, h, area) in objects:
+                (y0, y1) = (max(y + top, start), min(y + top + h, end))
+                if y1 > y0:
+                    clipped.append((x, y0, w, y1 - y0, area * (y1 - y0) / float(h)))
+            objects = clipped
+        results.put((index, slot, objects))
+
+
+# join the parts of the objects cut by the stripe boundaries
+#   parts: list of (x, y, w, h, area) of all stripes
+#   boundaries: first row of every stripe but the first one
+def mergeObjects(parts, boundaries):
+    parent = list(range(len(parts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for row in boundaries:
+        above = [i for (i, p) in enumerate(parts) if p[1] + p[3] == row]
+        below = [i for (i, p) in enumerate(parts) if p[1] == row]
+        for i in above:
+            for j in below:
+                (a, b) = (parts[i], parts[j])
+                # overlapping columns
+                if a[0] < b[0] + b[2] and b[0] < a[0] + a[2]:
+                    parent[find(i)] = find(j)
+
+    groups = {}
+    for (i, (x, y, w, h, area)) in enumerate(parts):
+        root = find(i)
+        if root not in groups:
+            groups[root] = [x, y, x + w, y + h, area]
+        else:
+            g = groups[root]
+            (g[0], g[1], g[2], g[3]) = (min(g[0], x), min(g[1], y), max(g[2], x + w), max(g[3], y + h))
+            g[4] += area
+    return [(g[0], g[1], g[2] - g[0], g[3] - g[1], g[4]) for g in groups.values()]
+
+
+# background model of a stream running in a pool of stripe workers
+class ShardedBackground:
+
+    def __init__(self, height, width, config=None, workers=None, depth=3, channels=3):
+        self.shape = (height, width, channels)
+        self.depth = max(1, int(depth))
+        self.workers = max(1, min(int(workers or multiprocessing.cpu_count()), height))
+
+        # shared memory slots for the frames in flight
+        self.buffer = multiprocessing.RawArray('B', self.depth * height * width * channels)
+        self.frames = np.frombuffer(self.buffer, dtype=np.uint8).reshape((self.depth,) + self.shape)
+        self.free = deque(range(self.depth))
+        self.pending = deque()  # submitted slots, oldest first
+        self.parts = {}  # slot -> objects received from the workers
+
+        # stripes of equal height; the halo covers the blur and dilation radius
+        config = dict(config or {})
+        scale = float(config.get('scale', 1.0))
+        blur = config.get('blur', 21) if config.get('model', 'running_average') == 'running_average' else 0
+        halo = int((blur // 2 + config.get('iterations', 2) + 2) / scale)
+        bounds = [height * i // self.workers for i in range(self.workers + 1)]
+        self.boundaries = bounds[1:-1]
+
+        self.results = multiprocessing.Queue()
+        self.tasks = []
+        self.processes = []
+        for i in range(self.workers):
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(target=stripe_worker,
+                                              args=(i, self.buffer, self.shape, self.depth,
+                                                    (bounds[i], bounds[i + 1]), halo, config,
+                                                    tasks, self.results))
+            process.daemon = True
+            process.start()
+            self.tasks.append(tasks)
+            self.processes.append(process)
+        logging.info('[INFO] motion analysis sharded in ' + str(self.workers) + ' processes')
+
+    # a free slot to write the next frame in, None if every slot is in flight
+    def acquire(self):
+        if len(self.free) == 0:
+            return None
+        return self.free[0]
+
+    # hand the frame written in the slot over to the workers, tag comes back with its objects
+    def submit(self, slot, tag=None):
+        self.free.remove(slot)
+        self.pending.append((slot, tag))
+        self.parts[slot] = []
+        for tasks in self.tasks:
+            tasks.put(slot)
+
+    def inflight(self):
+        return len(self.pending)
+
+    # receive the results of the workers, waiting for one if block is set
+    def receive(self, block):
+        try:
+            (index, slot, objects) = self.results.get(block)
+        except Empty:
+            return False
+        self.parts[slot].append(objects)
+        return True
+
+    # are the objects of the oldest submitted frame available (without waiting)?
+    def ready(self):
+        while self.receive(False):
+            pass
+        return len(self.pending) > 0 and len(self.parts[self.pending[0][0]]) == self.workers
+
+    # wait for the oldest submitted frame and return (slot, tag, objects)
+    # objects is None while the background models start; the frame in the slot can
+    # be read until the next frame is written
+    def collect(self):
+        (slot, tag) = self.pending[0]
+        while len(self.parts[slot]) < self.workers:
+            self.receive(True)
+        self.pending.popleft()
+        parts = self.parts.pop(slot)
+        self.free.append(slot)
+
+        if any(objects is None for objects in parts):
+            return (slot, tag, None)
+        return (slot, tag, mergeObjects([o for objects in parts for o in objects], self.boundaries))
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
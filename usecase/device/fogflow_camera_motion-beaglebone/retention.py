@@ -0,0 +1,153 @@
+# Retention of the images written to disk by the image store (see image_store.py).
+# Files are written in date-sharded subdirectories (images/2019-10-17/...) and kept in
+# an index ordered by age, so finding a file never touches the filesystem and the
+# oldest files are evicted first once the byte or age quota is exceeded.
+# Configured with the 'retention' entry of the 'store' block of the device profile:
+#   "retention": {"max_bytes": 1073741824, "max_age": 604800, "shard": "%Y-%m-%d", "interval": 60}
+#   max_bytes: disk quota, max_age: seconds a file is kept (0: no limit),
+#   interval: seconds between two evictions
+
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+
+class DiskRetention:
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, max_age=7 * 24 * 3600, shard='%Y-%m-%d',
+                 interval=60):
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        self.max_age = max_age
+        self.shard = shard
+        self.interval = interval
+
+        self.index = OrderedDict()  # filename -> (path, size, mtime, etag), oldest first
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.last_eviction = 0.0
+
+        # counters
+        self.added = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self.replaced = 0  # older files of the same name, removed
+        self.failed = 0
+
+        self.load()
+
+    # index the files left by a previous run, only the shard subdirectories are scanned
+    def load(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        files = []
+        for name in os.listdir(self.directory):
+            shard = os.path.join(self.directory, name)
+            if not os.path.isdir(shard):
+                continue
+            for filename in os.listdir(shard):
+                filepath = os.path.join(shard, filename)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, filename, filepath, st.st_size))
+        files.sort()
+        replaced = []
+        for (mtime, filename, filepath, size) in files:
+            # the same name in several shards: only the newest file can be found, the
+            # older ones are removed instead of being counted in the quota forever
+            old = self.index.pop(filename, None)
+            if old is not None:
+                self.nbytes -= old[1]
+                replaced.append(old[0])
+            self.index[filename] = (filepath, size, mtime, None)
+            self.nbytes += size
+        for filepath in replaced:
+            self.remove(filepath)
+            self.replaced += 1
+        if len(files) > 0:
+            logging.info('[INFO] retention: ' + str(len(self.index)) + ' files, ' + str(self.nbytes)
+                         + ' bytes on disk, ' + str(len(replaced)) + ' older duplicates removed')
+
+    # path a new file is written to, its shard is created when needed
+    def path(self, filename, now=None):
+        shard = os.path.join(self.directory, time.strftime(self.shard, time.localtime(now or time.time())))
+        if not os.path.isdir(shard):
+            os.makedirs(shard)
+        return os.path.join(shard, os.path.basename(filename))
+
+    # register a file once it is written, with the entity tag of its content
+    def add(self, filename, filepath, size, mtime=None, etag=None):
+        with self.lock:
+            old = self.index.pop(filename, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self.index[filename] = (filepath, size, mtime or time.time(), etag)
+            self.nbytes += size
+            self.added += 1
+        # written again in another shard, the older file would never be found
+        if old is not None and old[0] != filepath:
+            self.remove(old[0])
+            self.replaced += 1
+
+    # (path, size, mtime, etag) of a file on disk, None if unknown; etag is None until
+    # known for the files of a previous run
+    def find(self, filename):
+        with self.lock:
+            return self.index.get(filename)
+
+    # keep the entity tag of an indexed file, its place in the index is unchanged
+    def tag(self, filename, etag):
+        with self.lock:
+            entry = self.index.get(filename)
+            if entry is not None:
+                self.index[filename] = entry[:3] + (etag,)
+
+    # evict the oldest files beyond the quotas, at most once per interval unless forced
+    def evict(self, force=False):
+        now = time.time()
+        if not force and now - self.last_eviction < self.interval:
+            return 0
+        self.last_eviction = now
+
+        evicted = []
+        with self.lock:
+            while len(self.index) > 0:
+                (filename, (filepath, size, mtime, etag)) = next(iter(self.index.items()))
+                if self.nbytes <= self.max_bytes and (not self.max_age or now - mtime <= self.max_age):
+                    break
+                del self.index[filename]
+                self.nbytes -= size
+                evicted.append((filepath, size))
+
+        # the files are removed outside the lock, lookups go on meanwhile
+        for (filepath, size) in evicted:
+            if self.remove(filepath):
+                self.evicted += 1
+                self.evicted_bytes += size
+        return len(evicted)
+
+    # remove a file, and its shard once it is empty
+    def remove(self, filepath):
+        removed = True
+        try:
+            os.remove(filepath)
+        except OSError as e:
+            removed = False
+            self.failed += 1
+            logging.info('[WARN] retention: failed to remove ' + filepath + ': ' + str(e))
+        try:
+            os.rmdir(os.path.dirname(filepath))
+        except OSError:
+            pass
+        return removed
+
+    def stats(self):
+        with self.lock:
+            (count, nbytes) = (len(self.index), self.nbytes)
+        return {'files': count, 'bytes': nbytes, 'max_bytes': self.max_bytes, 'max_age': self.max_age,
+                'added': self.added, 'evicted': self.evicted, 'evicted_bytes': self.evicted_bytes,
+                'replaced': self.replaced, 'failed': self.failed}
@@ -0,0 +1,80 @@
+# Adaptive analysis rate: while the scene is static only a few frames per second are
+# analysed, as soon as motion appears every frame is analysed again.
+# Configured with the 'scheduler' block of the device profile:
+#   "scheduler": {"idle_fps": 3, "active_frames": 1, "idle_seconds": 2.0}
+#   idle_fps: frames analysed per second while idle
+#   active_frames: consecutive frames with motion needed to switch to the full rate
+#   idle_seconds: time without motion before going back to the idle rate
+
+import time
+import threading
+
+IDLE = 'idle'
+ACTIVE = 'active'
+
+
+class AdaptiveScheduler:
+
+    def __init__(self, idle_fps=3, active_frames=1, idle_seconds=2.0):
+        if idle_fps <= 0:
+            raise ValueError('invalid idle_fps: ' + str(idle_fps))
+        self.idle_interval = 1.0 / idle_fps
+        self.active_frames = max(1, int(active_frames))
+        self.idle_seconds = idle_seconds
+
+        self.lock = threading.Lock()
+        self.state = ACTIVE  # analyse at full rate until the background model has settled
+        self.last_tick = time.time()
+        self.last_analysed = 0.0
+        self.last_motion = self.last_tick
+        self.motion_frames = 0
+
+        # counters per state
+        self.transitions = 0
+        self.counters = {IDLE: {'time': 0.0, 'analysed': 0, 'skipped': 0},
+                         ACTIVE: {'time': 0.0, 'analysed': 0, 'skipped': 0}}
+
+    def tick(self, now):
+        self.counters[self.state]['time'] += now - self.last_tick
+        self.last_tick = now
+
+    def switch(self, state, now):
+        if state != self.state:
+            self.tick(now)
+            self.state = state
+            self.transitions += 1
+
+    # called by the capture loop for every frame: should this frame be analysed?
+    def accept(self):
+        now = time.time()
+        with self.lock:
+            self.tick(now)
+            counters = self.counters[self.state]
+            if self.state == IDLE and now - self.last_analysed < self.idle_interval:
+                counters['skipped'] += 1
+                return False
+            self.last_analysed = now
+            counters['analysed'] += 1
+            return True
+
+    # called by the analysis with the result of an analysed frame
+    def update(self, motion):
+        now = time.time()
+        with self.lock:
+            if motion:
+                self.motion_frames += 1
+                self.last_motion = now
+                if self.motion_frames >= self.active_frames:
+                    self.switch(ACTIVE, now)
+            else:
+                self.motion_frames = 0
+                if self.state == ACTIVE and now - self.last_motion >= self.idle_seconds:
+                    self.switch(IDLE, now)
+
+    def stats(self):
+        with self.lock:
+            self.tick(time.time())
+            stats = {'state': self.state, 'transitions': self.transitions}
+            for (state, counters) in self.counters.items():
+                stats[state] = dict(counters, time=round(counters['time'], 3))
+            return stats
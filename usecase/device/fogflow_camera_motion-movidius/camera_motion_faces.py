@@ -5,21 +5,28 @@ import threading
 import signal
 import sys
 import json
-import urllib
-import requests
 import logging
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from os import path
 # CameraMotion class
 from imutils import resize
 from imutils.video import VideoStream
 import cv2
 from datetime import datetime
+from ngsi import EntityTemplate
+from ngsi_publisher import NGSIPublisher
+from discovery import BrokerDiscovery
+from clock_sync import ClockSync, toDatetime
+from image_store import ImageStore
+from image_server import ImageServer
 
 # Global variables
 discoveryURL = ''
 brokerURL = ''
+discovery = None
+publisher = None
+store = None
+clock = None  # clock of the timestamp server, see clock_sync.py
 profile = {}
+template = None  # EntityTemplate of the device entity
 runThread = True
 
 
@@ -83,7 +90,7 @@ class CameraMotion:
                 timestamp = datetime.now()
                 filename = timestamp.strftime(self.camera_id + '_%Y-%m-%d_%H-%M-%S_%f_' + self.direction + '.jpg')
                 logging.info("[INFO] captured object: {}".format(filename))
-                cv2.imwrite('images/' + filename, orig)
+                store.put_image(filename, orig)
                 publishMySelf(filename, self.direction, boxes)
 
         # cleanup the camera
@@ -94,60 +101,41 @@ class CameraMotion:
 ##########################################
 # FogFlow/Main code:
 
-def getTimestamp(url):
-    # resp = urllib.request.urlopen("http://localhost:5000/timestamp")
-    with urllib.request.urlopen(url) as resp:
-        data = resp.info()
-    return str(data['timestamp'])
-
-
-def loadFile(filename):
-    try:
-        with open(filename, 'rb') as file:
-            return file.read()
-    except Exception as e:
-        logging.info('[ERROR] failed to load file ' + filename)
-        return ''
+# time of the timestamp server, estimated locally instead of asked for every
+# detection (see clock_sync.py); the local clock until the first sync
+def getTimestamp():
+    (now, error) = clock.now() if clock is not None else (None, None)
+    timestamp = toDatetime(now) if now is not None else datetime.now()
+    return timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')
 
 
 def findNearbyBroker():
-    global profile, discoveryURL
-
-    nearby = {}
-    nearby['latitude'] = profile['location']['latitude']
-    nearby['longitude'] = profile['location']['longitude']
-    nearby['limit'] = 1
-
-    discoveryReq = {}
-    discoveryReq['entities'] = [{'type': 'IoTBroker', 'isPattern': True}]
-    discoveryReq['restriction'] = {'scopes': [{'scopeType': 'nearby', 'scopeValue': nearby}]}
+    global profile, discoveryURL, discovery
 
+    # ranked nearby brokers, refreshed in the background with failover (see discovery.py)
     discoveryURL = profile['discoveryURL']
-    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-    response = requests.post(discoveryURL + '/discoverContextAvailability', data=json.dumps(discoveryReq),
-                             headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to find a nearby IoT Broker')
-        return ''
-
-    logging.info('[INFO] registration successed, json response: ' + response.text)
-    registrations = json.loads(response.text)
-
-    for registration in registrations['contextRegistrationResponses']:
-        providerURL = registration['contextRegistration']['providingApplication']
-        if providerURL != '':
-            return providerURL
-
-    return ''
+    discovery = BrokerDiscovery(discoveryURL, profile['location'], **profile.get('discovery', {}))
+    return discovery.refresh()
 
 
 def publishMySelf(filename, direction, boxes):
-    global profile, brokerURL
+    global profile, publisher
 
     faces = []
     for box in boxes:
         faces.append({'box': box})
 
+    url = 'http://' + profile['myIP'] + ':' + str(profile['myPort']) + '/image/' + filename
+    publisher.update(deviceTemplate().encode(url, direction, faces, getTimestamp()))
+
+
+# template of the device entity, its constant part is serialized once and only the
+# values of the detection are encoded afterwards
+def deviceTemplate():
+    global profile, template
+    if template is not None:
+        return template
+
     # device entity
     deviceCtxObj = {}
     deviceCtxObj['entityId'] = {}
@@ -156,25 +144,25 @@ def publishMySelf(filename, direction, boxes):
     deviceCtxObj['entityId']['isPattern'] = False
 
     deviceCtxObj['attributes'] = {}
-    deviceCtxObj['attributes']['image_url'] = {'type': 'string', 'value': 'http://' + profile['myIP'] +
-                                                ':' + str(profile['myPort']) + '/image/' + filename}
-    deviceCtxObj['attributes']['direction'] = {'type': 'string', 'value': direction}
-    deviceCtxObj['attributes']['faces'] = {'type': 'array', 'value': faces}
     deviceCtxObj['attributes']['iconURL'] = {'type': 'string', 'value': profile['iconURL']}
     deviceCtxObj['attributes']['camera_id'] = {'type': 'string', 'value': profile['id']}
-    deviceCtxObj['attributes']['timestamp_facesDetection'] = {'type': 'string',
-                                                               'value': getTimestamp(profile['timestamp_server'])}
     deviceCtxObj['attributes']['faceencoding_server'] = {'type': 'string', 'value': profile['faceencoding_server']}
     deviceCtxObj['attributes']['database'] = {'type': 'string', 'value': profile['database']}
     deviceCtxObj['attributes']['timestamp_server'] = {'type': 'string', 'value': profile['timestamp_server']}
+
     deviceCtxObj['metadata'] = {}
     deviceCtxObj['metadata']['location'] = {'type': 'point', 'value': {'latitude': profile['location']['latitude'],
                                                                        'longitude': profile['location']['longitude']}}
-    updateContext(brokerURL, deviceCtxObj)
+
+    template = EntityTemplate(deviceCtxObj, [('image_url', 'string'), ('direction', 'string'), ('faces', 'array'),
+                                             ('timestamp_facesDetection', 'string')])
+    return template
 
 
 def unpublishMySelf():
-    global profile, brokerURL
+    global profile, publisher
+    if publisher is None:
+        return
 
     # device entity
     deviceCtxObj = {}
@@ -183,85 +171,10 @@ def unpublishMySelf():
     deviceCtxObj['entityId']['type'] = profile['type']
     deviceCtxObj['entityId']['isPattern'] = False
 
-    deleteContext(brokerURL, deviceCtxObj)
-
-
-def object2Element(ctxObj):
-    ctxElement = {}
-
-    ctxElement['entityId'] = ctxObj['entityId']
-
-    ctxElement['attributes'] = []
-    if 'attributes' in ctxObj:
-        for key in ctxObj['attributes']:
-            attr = ctxObj['attributes'][key]
-            ctxElement['attributes'].append({'name': key, 'type': attr['type'], 'value': attr['value']})
-
-    ctxElement['domainMetadata'] = []
-    if 'metadata' in ctxObj:
-        for key in ctxObj['metadata']:
-            meta = ctxObj['metadata'][key]
-            ctxElement['domainMetadata'].append({'name': key, 'type': meta['type'], 'value': meta['value']})
-
-    return ctxElement
-
-
-def updateContext(broker, ctxObj):
-    ctxElement = object2Element(ctxObj)
-
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'UPDATE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-    response = requests.post(broker + '/updateContext', data=json.dumps(updateCtxReq), headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to UPDATE context: ' + response.text)
-
-
-def deleteContext(broker, ctxObj):
-    ctxElement = object2Element(ctxObj)
-
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'DELETE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-    response = requests.post(broker + '/updateContext', data=json.dumps(updateCtxReq), headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to DELETE context: ' + response.text)
-
-
-######
-# HTTP server code
-class RequestHandler(BaseHTTPRequestHandler):
-    # handle GET command
-    def do_GET(self):
-        if self.path == '/timestamp':
-            self.send_response(200)
-            self.send_header
-            self.send_header('timestamp', str(datetime.now()))
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            self.wfile.write(datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f").encode('utf-8'))
-            return
-        elif self.path[:7] == '/image/':
-            # get image file name
-            filename = 'images/' + self.path[7:]
-            if path.exists(filename):
-                self.send_response(200)
-                conttype = 'image/jpg' if '.jpg' in filename else 'application/json'
-                # send header first
-                self.send_header('Content-type', conttype)
-                self.end_headers()
-                # send the image file content to client
-                self.wfile.write(loadFile(filename))
-                return
-        else:
-            self.send_error(404, 'File not Found')
-            return
+    # send the pending updates before deleting the entity
+    publisher.close()
+    logging.info('[INFO] publisher stats: ' + json.dumps(publisher.stats()))
+    publisher.delete(deviceCtxObj)
 
 
 ##############
@@ -274,6 +187,9 @@ def signal_handler(signal, frame):
     # delete my registration and context entity
     logging.info('[EXIT] Unpublishing myself and exiting.')
     unpublishMySelf()
+    # write the pending images
+    if store is not None:
+        store.close()
     sys.exit(0)
 
 
@@ -290,12 +206,21 @@ def thread_function(name):
 
 
 def run():
-    global brokerURL
+    global brokerURL, publisher, store, clock
     brokerURL = findNearbyBroker()
     if brokerURL == '':
         logging.info('[ERROR] failed to find a nearby broker')
         sys.exit(0)
 
+    publisher = NGSIPublisher(brokerURL, discovery=discovery, **profile.get('publisher', {}))
+    publisher.start()
+    discovery.start()
+    clock = ClockSync(profile['timestamp_server'], profile.get('clock_interval', 30))
+    clock.start()
+    # images are served from memory, written to images/ only when persisted (see image_store.py)
+    store = ImageStore(**profile.get('store', {}))
+    store.start()
+
     thread = threading.Thread(target=thread_function, args=(1,))
     thread.start()
 
@@ -304,7 +229,7 @@ def run():
 
     signal.signal(signal.SIGINT, signal_handler)
     server_address = ('0.0.0.0', profile['myPort'])
-    httpd = HTTPServer(server_address, RequestHandler)
+    httpd = ImageServer(server_address, store, prefix='/image/', **profile.get('server', {}))
     httpd.serve_forever()  # blocking function call
 
 
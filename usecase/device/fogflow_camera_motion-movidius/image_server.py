@@ -0,0 +1,206 @@
+# HTTP server of the device images, shared by the device scripts. Requests are
+# handled by a pool of threads, so one slow download does not hold the others
+# (nor /timestamp) back. Connections are kept alive (HTTP/1.1), every response has
+# its Content-Length and an ETag, answered with 304 when the client already has it.
+# Images are sent from the in-memory store (see image_store.py), or with sendfile
+# when they are only on disk. Consumers can ask for a smaller variant of an image,
+# fitting in the box given with its aspect ratio kept, /<name>?w=300 or
+# /<name>?w=300&h=300, and for a byte range (Range: bytes=0-1023).
+# Configured with the 'server' block of the device profile:
+#   "server": {"threads": 8, "keepalive": 5.0}
+#   threads: concurrent requests, keepalive: seconds an idle connection is kept open
+
+import os
+import socket
+import threading
+from datetime import datetime
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from Queue import Queue
+    from urlparse import parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from queue import Queue
+    from urllib.parse import parse_qs
+
+MAX_VARIANT_SIZE = 4096
+
+
+def contentType(filename):
+    return 'image/jpg' if '.jpg' in filename else 'application/json'
+
+
+# requested size of the variant (width, height) from the query, None for the original
+def variantSize(query):
+    params = parse_qs(query)
+    (width, height) = (params.get('w', [None])[0], params.get('h', [None])[0])
+    if width is None and height is None:
+        return None
+    (width, height) = (int(width) if width else None, int(height) if height else None)
+    for value in (width, height):
+        if value is not None and not 0 < value <= MAX_VARIANT_SIZE:
+            raise ValueError('invalid size ' + str(value))
+    return (width, height)
+
+
+# first and last byte of a 'bytes=first-last' range, None to send the whole content
+# and False if the range cannot be satisfied; multiple ranges are not supported
+def byteRange(header, length):
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    (first, sep, last) = header[6:].strip().partition('-')
+    try:
+        if first == '':
+            # suffix range: the last bytes
+            (first, last) = (max(0, length - int(last)), length - 1)
+        else:
+            (first, last) = (int(first), min(int(last), length - 1) if last else length - 1)
+    except ValueError:
+        return None
+    if first > last or first >= length:
+        return False
+    return (first, last)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # idle keep-alive connections are closed after this timeout
+        self.timeout = self.server.keepalive
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        self.send_content(True)
+
+    def do_HEAD(self):
+        self.send_content(False)
+
+    def send_content(self, body):
+        (path, sep, query) = self.path.partition('?')
+        if path == '/timestamp':
+            data = datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f').encode('utf-8')
+            self.send_response(200)
+            self.send_header('timestamp', str(datetime.now()))
+            self.send_header('Content-type', 'text/html')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            if body:
+                self.wfile.write(data)
+            return
+
+        prefix = self.server.prefix
+        if path.startswith(prefix) and len(path) > len(prefix):
+            filename = path[len(prefix):]
+            try:
+                size = variantSize(query)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            store = self.server.store
+            if size is None:
+                (data, etag, filepath) = store.lookup(filename)
+            else:
+                (data, etag, filepath) = store.variant(filename, size[0], size[1])
+            if etag is not None:
+                # the client already has this image
+                if etag in self.headers.get('If-None-Match', ''):
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                if data is not None:
+                    rng = self.send_image(filename, etag, len(data))
+                    if body and rng is not False:
+                        (first, last) = rng
+                        self.wfile.flush()
+                        self.connection.sendall(data[first:last + 1])
+                else:
+                    self.send_file(filename, etag, filepath, body)
+                return
+
+        self.send_error(404, 'File not Found')
+
+    # send the headers of an image, partial when a range is requested
+    # returns the (first, last) bytes to send, False if the range cannot be satisfied
+    def send_image(self, filename, etag, length):
+        rng = byteRange(self.headers.get('Range'), length)
+        if rng is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */' + str(length))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return False
+
+        if rng is None:
+            rng = (0, length - 1)
+            self.send_response(200)
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (rng[0], rng[1], length))
+        self.send_header('Content-type', contentType(filename))
+        self.send_header('Content-Length', str(rng[1] - rng[0] + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return rng
+
+    # send a file of the disk, with sendfile when the platform has it
+    def send_file(self, filename, etag, filepath, body):
+        try:
+            file = open(filepath, 'rb')
+        except (IOError, OSError):
+            self.send_error(404, 'File not Found')
+            return
+        with file:
+            rng = self.send_image(filename, etag, os.fstat(file.fileno()).st_size)
+            if not body or rng is False:
+                return
+            (offset, end) = (rng[0], rng[1] + 1)
+            self.wfile.flush()
+            if hasattr(os, 'sendfile'):
+                while offset < end:
+                    sent = os.sendfile(self.connection.fileno(), file.fileno(), offset, end - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            else:
+                file.seek(offset)
+                while offset < end:
+                    chunk = file.read(min(65536, end - offset))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    offset += len(chunk)
+
+
+# HTTPServer handling the requests in a fixed pool of threads
+class ImageServer(HTTPServer):
+
+    def __init__(self, server_address, store, prefix='/', threads=8, keepalive=5.0):
+        HTTPServer.__init__(self, server_address, RequestHandler)
+        self.store = store
+        self.prefix = prefix  # path of the images, '/' or '/image/'
+        self.keepalive = keepalive
+        self.requests = Queue()
+        for i in range(max(1, int(threads))):
+            thread = threading.Thread(target=self.process_requests, name='image-server-' + str(i))
+            thread.daemon = True
+            thread.start()
+
+    # accepted connections are handed over to the pool
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        while True:
+            (request, client_address) = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except (socket.error, socket.timeout):
+                pass
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
@@ -0,0 +1,267 @@
+# In-memory store of the images served to the FogFlow operators: JPEG frames are
+# encoded once into a bounded LRU of byte buffers keyed by filename and served from
+# memory, so a GET never waits on the SD card. Writing the images to disk is
+# optional and done by a background thread in batches, off the capture path.
+# Configured with the 'store' block of the device profile:
+#   "store": {"max_bytes": 33554432, "quality": 90, "persist": false, "directory": "images",
+#             "batch": 16, "flush_interval": 1.0, "variant_bytes": 4194304, "retention": {...}}
+# resized variants of the images (thumbnails) are generated on demand and kept in a
+# small LRU of variant_bytes
+# persisted images are kept within the disk quotas of 'retention' (see retention.py)
+# the entity tag of an image is the CRC of its content, the same whether it is served
+# from memory or from disk
+
+import time
+import threading
+import logging
+import zlib
+from collections import OrderedDict, deque
+import cv2
+import numpy as np
+from retention import DiskRetention
+
+
+# entity tag of a content, for the conditional requests of the image server
+def contentTag(data):
+    return '"%08x"' % (zlib.crc32(data) & 0xffffffff)
+
+
+class ImageStore(threading.Thread):
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, quality=90, persist=False, directory='images',
+                 batch=16, flush_interval=1.0, max_pending=256, variant_bytes=4 * 1024 * 1024, retention=None):
+        threading.Thread.__init__(self, name='image-store')
+        self.daemon = True
+        self.max_bytes = max(1, int(max_bytes))
+        self.params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+        self.persist = persist
+        self.retention = None
+        if persist:
+            self.retention = DiskRetention(directory, **(retention or {}))
+        self.batch = max(1, int(batch))  # images written per disk batch
+        self.flush_interval = flush_interval  # seconds a pending image may wait for its batch
+        self.max_pending = max(1, int(max_pending))  # pending writes before dropping them
+
+        self.images = OrderedDict()  # filename -> (uint8 buffer, etag), least recently used first
+        self.nbytes = 0
+        self.variants = OrderedDict()  # 'filename?wxh' -> (uint8 buffer, etag), least recently used first
+        self.variant_nbytes = 0
+        self.variant_bytes = max(0, int(variant_bytes))
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.unwritten = {}  # filename -> (uint8 buffer, etag) of the pending writes, served until written
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # counters
+        self.stored = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_reads = 0
+        self.evicted = 0
+        self.variant_hits = 0
+        self.variant_made = 0
+        self.written = 0
+        self.write_batches = 0
+        self.write_failed = 0
+        self.write_dropped = 0
+        self.encode_time = 0.0
+        self.write_time = 0.0
+
+    # encode a frame to JPEG and store it, returns the encoded size
+    def put_image(self, filename, frame):
+        start = time.time()
+        (ok, data) = cv2.imencode('.jpg', frame, self.params)
+        self.encode_time += time.time() - start
+        if not ok:
+            logging.info('[ERROR] failed to encode image ' + filename)
+            return 0
+        self.put(filename, data)
+        return data.nbytes
+
+    # store already encoded content (bytes or a uint8 array)
+    def put(self, filename, data):
+        if not isinstance(data, np.ndarray):
+            data = np.frombuffer(data, dtype=np.uint8)
+        etag = contentTag(data)
+        with self.lock:
+            old = self.images.pop(filename, None)
+            if old is not None:
+                self.nbytes -= old[0].nbytes
+            self.images[filename] = (data, etag)
+            self.nbytes += data.nbytes
+            self.stored += 1
+            # evict the least recently used images beyond the memory budget
+            while self.nbytes > self.max_bytes and len(self.images) > 1:
+                (name, evicted) = self.images.popitem(last=False)
+                self.nbytes -= evicted[0].nbytes
+                self.evicted += 1
+
+        if self.persist:
+            with self.cond:
+                if len(self.pending) >= self.max_pending:
+                    self.write_dropped += 1
+                    return
+                self.pending.append((filename, data, etag, time.time()))
+                with self.lock:
+                    self.unwritten[filename] = (data, etag)
+                if len(self.pending) >= self.batch:
+                    self.cond.notify()
+
+    # content of a stored file as a memoryview (no copy), None if unknown
+    # images evicted from memory are read back from disk when they were persisted
+    def get(self, filename):
+        (data, etag, filepath) = self.lookup(filename)
+        if data is None and filepath is not None:
+            with open(filepath, 'rb') as file:
+                return memoryview(file.read())
+        return data
+
+    # find a stored file: (memoryview, etag, None) when it is in memory,
+    # (None, etag, path) when it is only on disk, (None, None, None) if unknown
+    def lookup(self, filename):
+        with self.lock:
+            entry = self.images.get(filename)
+            if entry is not None:
+                # most recently used
+                self.images[filename] = self.images.pop(filename)
+                self.hits += 1
+                return (memoryview(entry[0]), entry[1], None)
+            # evicted from memory but not written yet
+            entry = self.unwritten.get(filename)
+            if entry is not None:
+                self.hits += 1
+                return (memoryview(entry[0]), entry[1], None)
+            self.misses += 1
+
+        if self.persist:
+            # the retention index knows the files on disk, no filesystem lookup
+            found = self.retention.find(filename)
+            if found is not None:
+                (filepath, size, mtime, etag) = found
+                self.disk_reads += 1
+                if etag is None:
+                    # a file of a previous run, its tag computed once
+                    try:
+                        with open(filepath, 'rb') as file:
+                            etag = contentTag(file.read())
+                    except (IOError, OSError):
+                        return (None, None, None)
+                    self.retention.tag(filename, etag)
+                return (None, etag, filepath)
+        return (None, None, None)
+
+    # JPEG of a stored image resized to fit in width x height (either one may be None),
+    # keeping its aspect ratio, looked up like lookup(); images are never enlarged, the
+    # original is returned when it already fits
+    def variant(self, filename, width=None, height=None):
+        key = '%s?%sx%s' % (filename, width, height)
+        with self.lock:
+            entry = self.variants.get(key)
+            if entry is not None:
+                self.variants[key] = self.variants.pop(key)
+                self.variant_hits += 1
+                return (memoryview(entry[0]), entry[1], None)
+
+        data = self.get(filename)
+        if data is None or not filename.endswith('.jpg'):
+            return self.lookup(filename)
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return self.lookup(filename)
+        (h, w) = image.shape[:2]
+        scale = min(width / float(w) if width else 1.0, height / float(h) if height else 1.0, 1.0)
+        size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        if scale >= 1.0 or size == (w, h):
+            return self.lookup(filename)
+
+        resized = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        (ok, encoded) = cv2.imencode('.jpg', resized, self.params)
+        if not ok:
+            return self.lookup(filename)
+        etag = contentTag(encoded)
+        with self.lock:
+            if key not in self.variants:
+                self.variants[key] = (encoded, etag)
+                self.variant_nbytes += encoded.nbytes
+                self.variant_made += 1
+            while self.variant_nbytes > self.variant_bytes and len(self.variants) > 0:
+                (name, evicted) = self.variants.popitem(last=False)
+                self.variant_nbytes -= evicted[0].nbytes
+        return (memoryview(encoded), etag, None)
+
+    # remove a file from memory and return its content, None if unknown
+    def pop(self, filename):
+        with self.lock:
+            entry = self.images.pop(filename, None)
+            if entry is None:
+                return None
+            self.nbytes -= entry[0].nbytes
+            return memoryview(entry[0])
+
+    # stop the writer once the pending images are written
+    def close(self, timeout=5.0):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while True:
+            # evict the oldest files beyond the disk quotas, off the capture path
+            if self.retention is not None:
+                self.retention.evict()
+
+            with self.cond:
+                # wait for a full batch, the oldest image waiting at most flush_interval
+                wait = 0.5
+                if self.pending:
+                    wait = self.flush_interval - (time.time() - self.pending[0][3])
+                if not self.closed and len(self.pending) < self.batch and wait > 0:
+                    self.cond.wait(wait)
+                if self.closed and not self.pending:
+                    break
+                batch = []
+                if self.pending and (self.closed or len(self.pending) >= self.batch
+                                     or time.time() - self.pending[0][3] >= self.flush_interval):
+                    while self.pending and len(batch) < self.batch:
+                        batch.append(self.pending.popleft())
+
+            if len(batch) > 0:
+                self.write(batch)
+
+    def write(self, batch):
+        start = time.time()
+        for (filename, data, etag, queued_at) in batch:
+            try:
+                filepath = self.retention.path(filename, queued_at)
+                with open(filepath, 'wb') as file:
+                    data.tofile(file)
+                self.retention.add(filename, filepath, data.nbytes, etag=etag)
+                self.written += 1
+            except (IOError, OSError) as e:
+                self.write_failed += 1
+                logging.info('[ERROR] failed to write image ' + filename + ': ' + str(e))
+            with self.lock:
+                # found on disk from now on, unless a newer content is pending
+                if self.unwritten.get(filename, (None,))[0] is data:
+                    del self.unwritten[filename]
+        self.write_time += time.time() - start
+        self.write_batches += 1
+
+    def stats(self):
+        with self.lock:
+            (count, nbytes) = (len(self.images), self.nbytes)
+            (variants, variant_nbytes) = (len(self.variants), self.variant_nbytes)
+        with self.cond:
+            pending = len(self.pending)
+        return {'images': count, 'bytes': nbytes, 'max_bytes': self.max_bytes, 'stored': self.stored,
+                'hits': self.hits, 'misses': self.misses, 'disk_reads': self.disk_reads,
+                'evicted': self.evicted, 'variants': variants, 'variant_bytes': variant_nbytes,
+                'variant_hits': self.variant_hits, 'variant_made': self.variant_made, 'pending': pending, 'written': self.written,
+                'write_batches': self.write_batches, 'write_failed': self.write_failed,
+                'write_dropped': self.write_dropped,
+                'avg_encode': round(self.encode_time / self.stored, 6) if self.stored > 0 else 0.0,
+                'avg_write_batch': round(self.write_time / self.write_batches, 6) if self.write_batches > 0 else 0.0,
+                'retention': self.retention.stats() if self.retention is not None else None}
@@ -6,10 +6,7 @@ import threading
 import signal
 import sys
 import json
-import requests
 import logging
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from os import path
 # CameraMotion class
 from imutils import resize
 from imutils.video import VideoStream
@@ -17,12 +14,21 @@ import cv2
 from collections import deque
 import numpy as np
 from datetime import datetime
+from ngsi import EntityTemplate
+from ngsi_publisher import NGSIPublisher
+from discovery import BrokerDiscovery
+from image_store import ImageStore
+from image_server import ImageServer
 
 
 # Global variables
 discoveryURL = 'http://10.7.40.146/ngsi9'
 brokerURL = ''
+discovery = None
+publisher = None
+store = None
 profile = {}
+template = None  # EntityTemplate of the device entity
 runThread = True
 
 
@@ -183,9 +189,9 @@ class CameraMotion:
                     filename = timestamp.strftime(self.camera_id + '_%Y-%m-%d_%H-%M-%S-%f.jpg')
                     logging.info("[INFO] captured object: {}".format(filename))
                     objects = {'box': [[x, y], [x + w, y + h]], 'direction': direction}
-                    with open(filename.replace('jpg', 'json'), 'w') as write_file:
-                        json.dump(objects, write_file)
-                    cv2.imwrite(filename, frame)
+                    # encoded once and served from memory (see image_store.py)
+                    store.put(filename.replace('jpg', 'json'), json.dumps(objects).encode('utf-8'))
+                    store.put_image(filename, frame)
                     publishMySelf(filename, timestamp.strftime('%Y-%m-%d_%H-%M-%S-%f'), objects)
 
         # cleanup the camera
@@ -201,51 +207,34 @@ def signal_handler(signal, frame):
     runThread = False
     # delete my registration and context entity
     unpublishMySelf()
+    # write the pending images
+    if store is not None:
+        store.close()
     sys.exit(0)
 
 
-def loadFile(filename):
-    try:
-        with open(filename, 'rb') as file:
-            return file.read()
-    except Exception as e:
-        logging.info('[ERROR] failed to load file ' + filename)
-        return ''
-
-
 def findNearbyBroker():
-    global profile, discoveryURL
-
-    nearby = {}
-    nearby['latitude'] = profile['location']['latitude']
-    nearby['longitude'] = profile['location']['longitude']
-    nearby['limit'] = 1
-
-    discoveryReq = {}
-    discoveryReq['entities'] = [{'type': 'IoTBroker', 'isPattern': True}]
-    discoveryReq['restriction'] = {'scopes': [{'scopeType': 'nearby', 'scopeValue': nearby}]}
+    global profile, discoveryURL, discovery
 
+    # ranked nearby brokers, refreshed in the background with failover (see discovery.py)
     discoveryURL = profile['discoveryURL']
-    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-    response = requests.post(discoveryURL + '/discoverContextAvailability', data=json.dumps(discoveryReq),
-                             headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to find a nearby IoT Broker')
-        return ''
+    discovery = BrokerDiscovery(discoveryURL, profile['location'], **profile.get('discovery', {}))
+    return discovery.refresh()
 
-    logging.info('[INFO] registration successed, json response: ' + response.text)
-    registrations = json.loads(response.text)
 
-    for registration in registrations['contextRegistrationResponses']:
-        providerURL = registration['contextRegistration']['providingApplication']
-        if providerURL != '':
-            return providerURL
+def publishMySelf(filename, timestamp, objects):
+    global profile, publisher
 
-    return ''
+    url = 'http://' + profile['myIP'] + ':' + str(profile['myPort']) + '/' + filename
+    publisher.update(deviceTemplate().encode(url, timestamp, objects))
 
 
-def publishMySelf(filename, timestamp, objects):
-    global profile, brokerURL
+# template of the device entity, its constant part is serialized once and only the
+# values of the detection are encoded afterwards
+def deviceTemplate():
+    global profile, template
+    if template is not None:
+        return template
 
     # device entity
     deviceCtxObj = {}
@@ -255,12 +244,6 @@ def publishMySelf(filename, timestamp, objects):
     deviceCtxObj['entityId']['isPattern'] = False
 
     deviceCtxObj['attributes'] = {}
-    deviceCtxObj['attributes']['url'] = {'type': 'string',
-                                         'value': 'http://' + profile['myIP'] + ':' + str(profile['myPort']) + '/' + filename}
-    deviceCtxObj['attributes']['timestamp'] = {'type': 'string',
-                                         'value': timestamp}
-    deviceCtxObj['attributes']['object'] = {'type':'object',
-                                             'value': objects}
     deviceCtxObj['attributes']['iconURL'] = {'type': 'string', 'value': profile['iconURL']}
 
     deviceCtxObj['metadata'] = {}
@@ -268,11 +251,14 @@ def publishMySelf(filename, timestamp, objects):
                                                                        'longitude': profile['location']['longitude']}}
     deviceCtxObj['metadata']['cameraID'] = {'type': 'string', 'value': profile['id']}
 
-    updateContext(brokerURL, deviceCtxObj)
+    template = EntityTemplate(deviceCtxObj, [('url', 'string'), ('timestamp', 'string'), ('object', 'object')])
+    return template
 
 
 def unpublishMySelf():
-    global profile, brokerURL
+    global profile, publisher
+    if publisher is None:
+        return
 
     # device entity
     deviceCtxObj = {}
@@ -281,76 +267,10 @@ def unpublishMySelf():
     deviceCtxObj['entityId']['type'] = profile['type']
     deviceCtxObj['entityId']['isPattern'] = False
 
-    deleteContext(brokerURL, deviceCtxObj)
-
-
-def object2Element(ctxObj):
-    ctxElement = {}
-
-    ctxElement['entityId'] = ctxObj['entityId']
-
-    ctxElement['attributes'] = []
-    if 'attributes' in ctxObj:
-        for key in ctxObj['attributes']:
-            attr = ctxObj['attributes'][key]
-            ctxElement['attributes'].append({'name': key, 'type': attr['type'], 'value': attr['value']})
-
-    ctxElement['domainMetadata'] = []
-    if 'metadata' in ctxObj:
-        for key in ctxObj['metadata']:
-            meta = ctxObj['metadata'][key]
-            ctxElement['domainMetadata'].append({'name': key, 'type': meta['type'], 'value': meta['value']})
-
-    return ctxElement
-
-
-def updateContext(broker, ctxObj):
-    ctxElement = object2Element(ctxObj)
-
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'UPDATE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-    response = requests.post(broker + '/updateContext', data=json.dumps(updateCtxReq), headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to UPDATE context: ' + response.text)
-
-
-def deleteContext(broker, ctxObj):
-    ctxElement = object2Element(ctxObj)
-
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'DELETE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-    response = requests.post(broker + '/updateContext', data=json.dumps(updateCtxReq), headers=headers)
-    if response.status_code != 200:
-        logging.info('[ERROR] failed to DELETE context: ' + response.text)
-
-
-class RequestHandler(BaseHTTPRequestHandler):
-    # handle GET command
-    def do_GET(self):
-        if self.path != '/':
-            # send code 200 response
-            filename = self.path[1:]
-            if path.exists(filename):
-                self.send_response(200)
-                ctype = 'image/jpg' if '.jpg' in filename else 'application/json'
-                # send header first
-                self.send_header('Content-type', ctype)
-                self.end_headers()
-
-                # send the image file content to client
-                self.wfile.write(loadFile(filename))
-                return
-            
-        self.send_error(404, 'File not Found')
-        return
+    # send the pending updates before deleting the entity
+    publisher.close()
+    logging.info('[INFO] publisher stats: ' + json.dumps(publisher.stats()))
+    publisher.delete(deviceCtxObj)
 
 
 def thread_function(name):
@@ -365,12 +285,18 @@ def thread_function(name):
 
 
 def run():
-    global brokerURL
+    global brokerURL, publisher, store
     brokerURL = findNearbyBroker()
     if brokerURL == '':
         logging.info('[ERROR] failed to find a nearby broker')
         sys.exit(0)
 
+    publisher = NGSIPublisher(brokerURL, discovery=discovery, **profile.get('publisher', {}))
+    publisher.start()
+    discovery.start()
+    store = ImageStore(**profile.get('store', {}))
+    store.start()
+
     thread = threading.Thread(target=thread_function, args=(1,))
     thread.start()
 
@@ -378,7 +304,7 @@ def run():
                  + str(profile['myPort']) + '/<filename>')
     signal.signal(signal.SIGINT, signal_handler)
     server_address = ('0.0.0.0', profile['myPort'])
-    httpd = HTTPServer(server_address, RequestHandler)
+    httpd = ImageServer(server_address, store, prefix='/', **profile.get('server', {}))
     httpd.serve_forever() # blocking function call
 
 
@@ -0,0 +1,147 @@
+# Micro-benchmarks of the NGSI codec (see ngsi.py), for every JSON backend installed:
+#   notify: notifications of the device entity decoded per second, reading the
+#           attributes an operator reads
+#   update: updates of the device entity encoded per second, from the context object
+#           and from its EntityTemplate
+# 'legacy' is the dict walk with the json module each script used to have.
+# Usage: python ngsi_bench.py [profile.json] [iterations]
+
+import sys
+import json
+import timeit
+import ngsi
+
+READ = ('url', 'timestamp', 'direction', 'objectID')
+
+
+def legacyElement2Object(element):
+    ctxObj = {}
+    ctxObj['entityId'] = element['entityId']
+    ctxObj['attributes'] = {}
+    if 'attributes' in element:
+        for attr in element['attributes']:
+            ctxObj['attributes'][attr['name']] = {'type': attr['type'], 'value': attr['value']}
+    ctxObj['metadata'] = {}
+    if 'domainMetadata' in element:
+        for meta in element['domainMetadata']:
+            ctxObj['metadata'][meta['name']] = {'type': meta['type'], 'value': meta['value']}
+    return ctxObj
+
+
+def legacyObject2Element(ctxObj):
+    ctxElement = {}
+    ctxElement['entityId'] = ctxObj['entityId']
+    ctxElement['attributes'] = []
+    if 'attributes' in ctxObj:
+        for key in ctxObj['attributes']:
+            attr = ctxObj['attributes'][key]
+            ctxElement['attributes'].append({'name': key, 'type': attr['type'], 'value': attr['value']})
+    ctxElement['domainMetadata'] = []
+    if 'metadata' in ctxObj:
+        for key in ctxObj['metadata']:
+            meta = ctxObj['metadata'][key]
+            ctxElement['domainMetadata'].append({'name': key, 'type': meta['type'], 'value': meta['value']})
+    return ctxElement
+
+
+def buildCtxObj(device, filename, timestamp, object_id, direction, line, side):
+    deviceCtxObj = {}
+    deviceCtxObj['entityId'] = {}
+    deviceCtxObj['entityId']['id'] = 'Device.' + device['type'] + '.' + device['id']
+    deviceCtxObj['entityId']['type'] = device['type']
+    deviceCtxObj['entityId']['isPattern'] = False
+
+    deviceCtxObj['attributes'] = {}
+    deviceCtxObj['attributes']['url'] = {'type': 'string',
+                                         'value': 'http://' + device['myIP'] + ':' + str(device['myPort']) + '/' + filename}
+    deviceCtxObj['attributes']['timestamp'] = {'type': 'string', 'value': timestamp}
+    deviceCtxObj['attributes']['direction'] = {'type': 'string', 'value': direction}
+    deviceCtxObj['attributes']['objectID'] = {'type': 'integer', 'value': object_id}
+    deviceCtxObj['attributes']['line'] = {'type': 'string', 'value': line}
+    deviceCtxObj['attributes']['side'] = {'type': 'string', 'value': side}
+    deviceCtxObj['attributes']['iconURL'] = {'type': 'string', 'value': device['iconURL']}
+
+    deviceCtxObj['metadata'] = {}
+    deviceCtxObj['metadata']['location'] = {'type': 'point', 'value': {'latitude': device['location']['latitude'],
+                                                                       'longitude': device['location']['longitude']}}
+    deviceCtxObj['metadata']['cameraID'] = {'type': 'string', 'value': device['id']}
+    return deviceCtxObj
+
+
+def buildTemplate(device):
+    deviceCtxObj = buildCtxObj(device, '', '', 0, '', '', '')
+    for name in ('url', 'timestamp', 'direction', 'objectID', 'line', 'side'):
+        del deviceCtxObj['attributes'][name]
+    return ngsi.EntityTemplate(deviceCtxObj, [('url', 'string'), ('timestamp', 'string'), ('direction', 'string'),
+                                              ('objectID', 'integer'), ('line', 'string'), ('side', 'string')])
+
+
+# the request with its attributes and metadata by name, their order does not matter
+def decodeRequest(data):
+    updateCtxReq = json.loads(data)
+    for ctxElement in updateCtxReq['contextElements']:
+        for key in ('attributes', 'domainMetadata'):
+            ctxElement[key] = dict((item['name'], item) for item in ctxElement[key])
+    return updateCtxReq
+
+
+def run(name, fn, number):
+    best = min(timeit.repeat(fn, number=number, repeat=3))
+    print('%-22s %12.0f /s %10.2f us' % (name, number / best, best / number * 1e6))
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'profile.json'
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    with open(path) as f:
+        device = json.load(f)
+    device.setdefault('myIP', '127.0.0.1')
+    device.setdefault('myPort', 8080)
+
+    (filename, timestamp, object_id, direction, line, side) = event = (
+        'smart-pole-01_2019-10-17_11-09-18-224879_Down-Left.jpg', '2019-10-17_11-09-18-224879', 42,
+        'Down-Left', 'line-0', 'Down')
+    url = 'http://' + device['myIP'] + ':' + str(device['myPort']) + '/' + filename
+    ctxObj = buildCtxObj(device, *event)
+    notification = json.dumps({'subscriptionId': 'bench', 'originator': '', 'contextResponses': [
+        {'contextElement': legacyObject2Element(ctxObj), 'statusCode': {'code': 200, 'reasonPhrase': 'OK'}}]})
+    expected = [legacyElement2Object(legacyObject2Element(ctxObj))['attributes'][n]['value'] for n in READ]
+
+    def legacyNotify():
+        data = json.loads(notification)
+        objs = [legacyElement2Object(r['contextElement']) for r in data['contextResponses']
+                if r['statusCode']['code'] == 200]
+        return [objs[0]['attributes'][n]['value'] for n in READ]
+
+    def legacyUpdate():
+        return json.dumps({'updateAction': 'UPDATE', 'contextElements': [legacyObject2Element(ctxObj)]})
+
+    def notify():
+        obj = ngsi.readContextElements(notification)[0]
+        return [obj.value(n) for n in READ]
+
+    def update():
+        return ngsi.encodeRequest('UPDATE', [ngsi.object2Element(ctxObj)])
+
+    print('%-22s %15s %13s' % ('', 'ops', 'per op'))
+    run('notify legacy', legacyNotify, number)
+    for backend in sorted(ngsi.BACKENDS):
+        ngsi.setBackend(backend)
+        if notify() != expected:
+            sys.exit(backend + ': the notification is not decoded as before')
+        run('notify ' + backend, notify, number)
+
+    run('update legacy', legacyUpdate, number)
+    for backend in sorted(ngsi.BACKENDS):
+        ngsi.setBackend(backend)
+        template = buildTemplate(device)
+
+        def templated():
+            return ngsi.encodeRequest('UPDATE', [template.encode(url, timestamp, direction, object_id, line, side)])
+
+        # all send the same request
+        for fn in (update, templated):
+            if decodeRequest(fn()) != decodeRequest(legacyUpdate()):
+                sys.exit(backend + ': the update is not encoded as before')
+        run('update ' + backend, update, number)
+        run('update template ' + backend, templated, number)
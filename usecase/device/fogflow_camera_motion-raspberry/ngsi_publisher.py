@@ -0,0 +1,137 @@
+# NGSI publisher shared by the device scripts: context updates are queued off the
+# capture path and sent by a background thread over a pooled keep-alive session.
+# Updates piling up while a request is in flight are coalesced into a single
+# /updateContext request. With a broker discovery (see discovery.py) the requests
+# go to the broker it has selected and their outcome is reported back to it.
+# Entities published over and over with mostly constant attributes can be given
+# encoded by an EntityTemplate (see ngsi.py), the publisher sends them as they are.
+
+import time
+import threading
+import logging
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from ngsi import HEADERS, object2Element, encodeRequest
+
+
+class NGSIPublisher(threading.Thread):
+
+    def __init__(self, broker, max_backlog=256, max_batch=16, pool_size=4, timeout=10, discovery=None):
+        threading.Thread.__init__(self, name='ngsi-publisher')
+        self.daemon = True
+        self.broker = broker
+        self.discovery = discovery
+        self.max_backlog = max(1, int(max_backlog))  # pending elements before rejecting updates
+        self.max_batch = max(1, int(max_batch))  # elements coalesced in one request
+        self.timeout = timeout
+
+        # keep-alive connections reused by every request to the broker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.backlog = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.inflight = 0
+
+        # counters
+        self.queued = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.requests = 0
+        self.wait_time = 0.0
+        self.latency = 0.0
+
+    # queue a context update, never blocks; returns False if the backlog is full
+    # ctxObj is a context object, or an element encoded by an EntityTemplate
+    def update(self, ctxObj):
+        ctxElement = object2Element(ctxObj) if isinstance(ctxObj, dict) else ctxObj
+        with self.cond:
+            if self.closed or len(self.backlog) >= self.max_backlog:
+                self.rejected += 1
+                return False
+            self.backlog.append((ctxElement, time.time()))
+            self.queued += 1
+            self.max_depth = max(self.max_depth, len(self.backlog))
+            self.cond.notify()
+            return True
+
+    # delete a context entity, sent right away on the calling thread
+    def delete(self, ctxObj):
+        return self.post('DELETE', [object2Element(ctxObj)])
+
+    # stop accepting updates and wait until the backlog is sent
+    def close(self, timeout=5.0):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.backlog and not self.closed:
+                    self.cond.wait(0.5)
+                if not self.backlog:
+                    break
+                # coalesce everything pending, up to max_batch elements
+                batch = []
+                while self.backlog and len(batch) < self.max_batch:
+                    batch.append(self.backlog.popleft())
+                self.inflight = len(batch)
+
+            now = time.time()
+            for (ctxElement, queued_at) in batch:
+                self.wait_time += now - queued_at
+            self.post('UPDATE', [ctxElement for (ctxElement, queued_at) in batch])
+            self.inflight = 0
+
+    # a request failing on a broker the discovery has just left is sent again to the new one
+    def post(self, action, ctxElements, retry=True):
+        data = encodeRequest(action, ctxElements)
+
+        broker = self.discovery.current() if self.discovery is not None else self.broker
+        start = time.time()
+        try:
+            response = self.session.post(broker + '/updateContext', data=data,
+                                         headers=HEADERS, timeout=self.timeout)
+            ok = response.status_code == 200
+            error = response.text
+        except requests.RequestException as e:
+            ok = False
+            error = str(e)
+        latency = time.time() - start
+        self.latency += latency
+        self.requests += 1
+        if self.discovery is not None:
+            self.discovery.report(broker, ok, latency)
+
+        if not ok:
+            if retry and self.discovery is not None and self.discovery.current() not in ('', broker):
+                return self.post(action, ctxElements, False)
+            self.failed += len(ctxElements)
+            logging.info('[ERROR] failed to ' + action + ' context: ' + error)
+            return False
+
+        self.sent += len(ctxElements)
+        return True
+
+    def stats(self):
+        with self.cond:
+            depth = len(self.backlog)
+        done = self.sent + self.failed
+        stats = {'depth': depth, 'inflight': self.inflight, 'max_depth': self.max_depth,
+                 'max_backlog': self.max_backlog, 'queued': self.queued, 'rejected': self.rejected,
+                 'sent': self.sent, 'failed': self.failed, 'requests': self.requests,
+                 'avg_batch': round(float(done) / self.requests, 2) if self.requests > 0 else 0.0,
+                 'avg_wait': round(self.wait_time / done, 6) if done > 0 else 0.0,
+                 'avg_latency': round(self.latency / self.requests, 6) if self.requests > 0 else 0.0}
+        if self.discovery is not None:
+            stats['discovery'] = self.discovery.stats()
+        return stats
@@ -0,0 +1,107 @@
+# Staged frame pipeline used by CameraMotion: bounded queues with a drop policy
+# and worker stages with their own counters, so a slow stage never blocks capture.
+
+import time
+import threading
+import logging
+from collections import deque
+
+# drop policies applied when a queue is full
+DROP_OLDEST = 'oldest'  # discard the item waiting the longest, keep the new one
+DROP_NEWEST = 'newest'  # discard the incoming item, keep the queued ones
+
+
+class StageQueue:
+
+    def __init__(self, name, maxsize=4, drop_policy=DROP_OLDEST):
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError('invalid drop policy: ' + str(drop_policy))
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self.drop_policy = drop_policy
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        # counters
+        self.put_count = 0
+        self.get_count = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    # put an item in the queue, never blocks; returns False if an item was dropped
+    def put(self, item):
+        with self.cond:
+            if self.closed:
+                return False
+            dropped = False
+            if len(self.items) >= self.maxsize:
+                self.dropped += 1
+                dropped = True
+                if self.drop_policy == DROP_NEWEST:
+                    return False
+                self.items.popleft()
+            self.items.append(item)
+            self.put_count += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify()
+            return not dropped
+
+    # wait for the next item; returns None once the queue is closed and drained
+    def get(self, poll=0.5):
+        with self.cond:
+            while not self.items:
+                if self.closed:
+                    return None
+                # wait with a timeout so the thread keeps reacting to signals
+                self.cond.wait(poll)
+            self.get_count += 1
+            return self.items.popleft()
+
+    # stop accepting items and wake up the consumers
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def depth(self):
+        with self.cond:
+            return len(self.items)
+
+    def stats(self):
+        with self.cond:
+            return {'depth': len(self.items), 'maxsize': self.maxsize, 'max_depth': self.max_depth,
+                    'put': self.put_count, 'get': self.get_count, 'dropped': self.dropped,
+                    'drop_policy': self.drop_policy}
+
+
+class Stage(threading.Thread):
+
+    def __init__(self, name, inbox, handler):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.inbox = inbox
+        self.handler = handler
+        # counters
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                break
+
+            start = time.time()
+            try:
+                self.handler(item)
+            except Exception as e:
+                self.errors += 1
+                logging.info('[ERROR] stage ' + self.name + ' failed: ' + str(e))
+            self.processed += 1
+            self.busy_time += time.time() - start
+
+    def stats(self):
+        avg = self.busy_time / self.processed if self.processed > 0 else 0.0
+        return {'processed': self.processed, 'errors': self.errors,
+                'busy_time': round(self.busy_time, 3), 'avg_time': round(avg, 6)}
@@ -0,0 +1,165 @@
+# Program to run several CameraMotion streams in a single process. The cameras share
+# one broker discovery, one NGSI publisher (and its connection pool), one image store
+# and one image server. All parameters must be informed in cameras.json: the keys outside 'cameras'
+# are shared by every camera and can be overridden in the camera's own entry.
+#   mode: 'threads' (default) or 'processes', one process per camera
+#   cpus: optional list of CPUs the camera is pinned to
+
+import os
+import sys
+import json
+import signal
+import logging
+import threading
+import functools
+import multiprocessing
+import camera_motion
+from camera_motion import createCamera, findNearbyBroker, publishMySelf, unpublishMySelf
+from ngsi_publisher import NGSIPublisher
+from image_store import ImageStore
+from image_server import ImageServer
+
+# Global variables
+config = {}
+devices = {}  # device profile of each camera by id
+processes = []
+
+
+# build the device profile of every camera from the shared keys and its own entry
+def cameraProfiles(config):
+    shared = dict((key, value) for (key, value) in config.items() if key != 'cameras')
+    profiles = []
+    for camera in config['cameras']:
+        device = dict(shared)
+        device.update(camera)
+        profiles.append(device)
+    return profiles
+
+
+# pin the calling thread (and the threads it starts) or process to the given CPUs
+def pinCPUs(cpus):
+    if not hasattr(os, 'sched_setaffinity'):
+        logging.info('[WARN] CPU pinning is not supported on this platform')
+        return
+    os.sched_setaffinity(0, cpus)
+
+
+def thread_function(device):
+    logging.info('[INFO] camera %s: starting', device['id'])
+    if 'cpus' in device:
+        pinCPUs(device['cpus'])
+
+    camera = createCamera(device, callback=functools.partial(publishMySelf, device=device))
+    if camera is not None:
+        camera.run()
+
+    logging.info('[INFO] camera %s: finishing', device['id'])
+
+
+def process_function(device, events):
+    # the parent process handles the signals and publishes the events
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.info('[INFO] camera %s: starting in process %d', device['id'], os.getpid())
+    if 'cpus' in device:
+        pinCPUs(device['cpus'])
+
+    # the images are served by the parent process: they go along with the events
+    camera_motion.store = ImageStore(**dict(device.get('store', {}), persist=False))
+    camera = createCamera(device, callback=lambda *event: events.put(
+        (device['id'], camera_motion.store.pop(event[0]).tobytes()) + event))
+    if camera is not None:
+        camera.run()
+
+
+# publish the events of the camera processes with the shared publisher
+def publish_function(events):
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        camera_motion.store.put(event[2], event[1])
+        publishMySelf(*event[2:], device=devices[event[0]])
+
+
+def signal_handler(signal, frame):
+    logging.info('[WARN] Signal to stop this process!')
+    # stop the cameras
+    camera_motion.runThread = False
+    for process in processes:
+        process.terminate()
+    # delete the context entities of all cameras
+    for device in devices.values():
+        unpublishMySelf(device)
+    # write the pending images
+    camera_motion.store.close()
+    sys.exit(0)
+
+
+def run():
+    # a single discovery for all cameras, refreshed in the background once started
+    camera_motion.profile = config
+    brokerURL = findNearbyBroker()
+    if brokerURL == '':
+        logging.info('[ERROR] failed to find a nearby broker')
+        sys.exit(0)
+
+    # camera processes are forked before any other thread is started
+    mode = config.get('mode', 'threads')
+    events = None
+    if mode == 'processes':
+        events = multiprocessing.Queue()
+        for device in devices.values():
+            process = multiprocessing.Process(target=process_function, args=(device, events))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+
+    camera_motion.brokerURL = brokerURL
+    camera_motion.publisher = NGSIPublisher(brokerURL, discovery=camera_motion.discovery,
+                                            **config.get('publisher', {}))
+    camera_motion.publisher.start()
+    camera_motion.discovery.start()
+    camera_motion.store = ImageStore(**config.get('store', {}))
+    camera_motion.store.start()
+
+    if mode == 'processes':
+        thread = threading.Thread(target=publish_function, args=(events,))
+        thread.daemon = True
+        thread.start()
+    else:
+        for device in devices.values():
+            thread = threading.Thread(target=thread_function, args=(device,))
+            thread.daemon = True
+            thread.start()
+
+    logging.info('[INFO] local image server at http://' + config['myIP'] + ':'
+                 + str(config['myPort']) + '/<filename>')
+    signal.signal(signal.SIGINT, signal_handler)
+    server_address = ('0.0.0.0', config['myPort'])
+    httpd = ImageServer(server_address, camera_motion.store, prefix='/', **config.get('server', {}))
+    httpd.serve_forever()  # blocking function call
+
+
+if __name__ == '__main__':
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    cfgFileName = 'cameras.json'
+    if len(sys.argv) >= 2:
+        cfgFileName = sys.argv[1]
+
+    try:
+        with open(cfgFileName) as json_file:
+            config = json.load(json_file)
+    except Exception as error:
+        logging.info('[ERROR] failed to load the cameras profile')
+        sys.exit(0)
+
+    for device in cameraProfiles(config):
+        if device['id'] in devices:
+            logging.info('[ERROR] duplicated camera id ' + device['id'])
+            sys.exit(0)
+        devices[device['id']] = device
+
+    run()
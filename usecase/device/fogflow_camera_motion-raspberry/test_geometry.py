@@ -0,0 +1,114 @@
+# Tests of the frame geometry and of the virtual lines crossed by the tracked objects
+# (see geometry.py).
+# Usage: python -m pytest test_geometry.py
+
+import numpy as np
+import imutils
+from geometry import FrameGeometry, CrossingLines, profileLines
+
+
+def noisyFrame(height, width):
+    return np.random.RandomState(0).randint(0, 256, (height, width, 3)).astype(np.uint8)
+
+
+def test_downscaled_roi_as_imutils():
+    frame = noisyFrame(480, 640)
+    geometry = FrameGeometry((100, 50, 600, 450), max_width=300)
+    geometry.setup(frame.shape)
+    expected = imutils.resize(frame[50:450, 100:600], width=300)
+    assert (geometry.width, geometry.height) == (300, 240)
+    assert np.array_equal(geometry.apply(frame), expected)
+    # written in the buffer given
+    out = np.zeros_like(expected)
+    assert geometry.apply(frame, out=out) is out
+    assert np.array_equal(out, expected)
+
+
+def test_roi_at_the_analysis_size_is_a_view():
+    frame = noisyFrame(240, 400)
+    geometry = FrameGeometry((-10, 20, 500, 220), max_width=400)
+    geometry.setup(frame.shape)
+    assert geometry.apply(frame).base is frame
+    assert np.array_equal(geometry.apply(frame), frame[20:220])
+
+
+def crossingLines(lines, width=100, height=100, scale=1.0):
+    crossing = CrossingLines(lines)
+    crossing.setup(width, height, scale)
+    return crossing
+
+
+# the events of a track moving through the points, one movement at a time
+def follow(crossing, points):
+    events = []
+    for (prev, curr) in zip(points[:-1], points[1:]):
+        events.extend((name, direction) for (obj, name, direction) in crossing.crossings([prev], [curr]))
+    return events
+
+
+TRIPWIRE = [{'name': 'wire', 'points': [[0, 50], [100, 50]], 'directions': ['up', 'down']}]
+
+
+def test_tripwire_both_directions():
+    crossing = crossingLines(TRIPWIRE)
+    assert follow(crossing, [(50, 40), (50, 60)]) == [('wire', 'down')]
+    assert follow(crossing, [(50, 60), (50, 40)]) == [('wire', 'up')]
+
+
+def test_no_crossing():
+    crossing = crossingLines(TRIPWIRE)
+    # same side, not moving, beyond the end of the line, along the line
+    assert follow(crossing, [(50, 40), (60, 45), (60, 45)]) == []
+    assert follow(crossing, [(110, 40), (110, 60)]) == []
+    assert follow(crossing, [(10, 50), (90, 50)]) == []
+
+
+def test_centroid_on_the_line_crosses_once():
+    crossing = crossingLines(TRIPWIRE)
+    assert follow(crossing, [(50, 40), (50, 50), (50, 60)]) == [('wire', 'down')]
+    assert follow(crossing, [(50, 60), (50, 50), (50, 40)]) == [('wire', 'up')]
+    # stays on the line for a while
+    assert follow(crossing, [(50, 40), (50, 50), (52, 50), (50, 60)]) == [('wire', 'down')]
+
+
+def test_touching_the_line_and_back():
+    crossing = crossingLines(TRIPWIRE)
+    # reaching the line from above is not a crossing, leaving it downwards is
+    assert follow(crossing, [(50, 60), (50, 50), (50, 60)]) == [('wire', 'up'), ('wire', 'down')]
+    assert follow(crossing, [(50, 40), (50, 50), (50, 40)]) == []
+
+
+def test_movement_through_a_polyline_vertex_crosses_once():
+    # the vertex (50, 50) joins a horizontal and a diagonal segment
+    crossing = crossingLines([{'name': 'lane', 'points': [[0, 50], [50, 50], [100, 0]]}])
+    assert follow(crossing, [(50, 40), (50, 60)]) == [('lane', 'right')]
+    assert follow(crossing, [(50, 60), (50, 40)]) == [('lane', 'left')]
+    # on the vertex itself
+    assert follow(crossing, [(50, 40), (50, 50), (50, 60)]) == [('lane', 'right')]
+
+
+def test_polyline_cut_twice_is_crossed_once():
+    crossing = crossingLines([{'name': 'zigzag', 'points': [[0, 40], [50, 60], [100, 40]]}])
+    assert follow(crossing, [(0, 50), (100, 50)]) == [('zigzag', 'left')]
+
+
+def test_objects_and_lines_at_once():
+    crossing = crossingLines(TRIPWIRE + [{'name': 'exit', 'points': [[0.5, 0], [0.5, 1]], 'relative': True}])
+    events = crossing.crossings([(40, 40), (10, 10), (40, 60)], [(60, 60), (20, 20), (40, 40)])
+    assert sorted(events) == [(0, 'exit', 'left'), (0, 'wire', 'down'), (2, 'wire', 'up')]
+    assert crossing.crossings([], []) == []
+
+
+def test_scaled_lines():
+    crossing = crossingLines([{'name': 'wire', 'points': [[0, 100], [200, 100]]}], scale=0.5)
+    assert follow(crossing, [(50, 45), (50, 55)]) == [('wire', 'right')]
+
+
+def test_legacy_crossline():
+    assert profileLines({'crossline': 2}) == [{'name': 'crossline', 'points': [[0.5, 0], [0.5, 1]],
+                                              'relative': True}]
+    try:
+        profileLines({'crossline': 5})
+        assert False
+    except ValueError:
+        pass
@@ -0,0 +1,141 @@
+# Tests of the image store and of the retention of its files (see image_store.py and
+# retention.py).
+# Usage: python -m pytest test_image_store.py
+
+import os
+import numpy as np
+import cv2
+from image_store import ImageStore
+from retention import DiskRetention
+
+
+def jpeg(height, width, value):
+    return cv2.imencode('.jpg', np.full((height, width, 3), value, dtype=np.uint8))[1]
+
+
+# a store persisting its images in tmpdir, which keeps a single image in memory and
+# writes only when flushed
+def persistingStore(tmpdir, **kwargs):
+    return ImageStore(max_bytes=1, persist=True, directory=str(tmpdir.join('images')), batch=100,
+                      flush_interval=3600, **kwargs)
+
+
+def flush(store):
+    batch = list(store.pending)
+    store.pending.clear()
+    store.write(batch)
+
+
+def test_etag_from_memory_and_disk(tmpdir):
+    store = persistingStore(tmpdir)
+    store.put('a.jpg', jpeg(20, 20, 10))
+    (data, etag, filepath) = store.lookup('a.jpg')
+    assert filepath is None
+    flush(store)
+    store.put('b.jpg', jpeg(20, 20, 20))
+
+    # evicted from memory, the same tag from disk
+    (data, diskEtag, filepath) = store.lookup('a.jpg')
+    assert data is None and filepath is not None
+    assert diskEtag == etag
+    assert bytes(store.get('a.jpg')) == jpeg(20, 20, 10).tobytes()
+
+
+def test_etag_of_the_files_of_a_previous_run(tmpdir):
+    store = persistingStore(tmpdir)
+    store.put('a.jpg', jpeg(20, 20, 10))
+    etag = store.lookup('a.jpg')[1]
+    flush(store)
+
+    restarted = persistingStore(tmpdir)
+    assert restarted.lookup('a.jpg')[1] == etag
+    assert restarted.retention.find('a.jpg')[3] == etag
+
+
+def test_pending_write_evicted_from_memory(tmpdir):
+    store = persistingStore(tmpdir)
+    store.put('a.jpg', jpeg(20, 20, 10))
+    etag = store.lookup('a.jpg')[1]
+    store.put('b.jpg', jpeg(20, 20, 20))
+
+    # not in memory, not on disk yet
+    assert 'a.jpg' not in store.images and store.retention.find('a.jpg') is None
+    (data, pendingEtag, filepath) = store.lookup('a.jpg')
+    assert bytes(data) == jpeg(20, 20, 10).tobytes() and pendingEtag == etag
+    assert bytes(store.get('a.jpg')) == bytes(data)
+
+    flush(store)
+    assert store.unwritten == {}
+    assert store.lookup('a.jpg')[2] is not None
+
+
+def test_unknown_image(tmpdir):
+    store = persistingStore(tmpdir)
+    assert store.lookup('missing.jpg') == (None, None, None)
+    assert store.get('missing.jpg') is None
+
+
+def test_variant_fits_in_the_box(tmpdir):
+    store = ImageStore()
+    store.put('a.jpg', jpeg(200, 400, 10))
+    original = store.lookup('a.jpg')[1]
+
+    def variantSize(width, height):
+        (data, etag, filepath) = store.variant('a.jpg', width, height)
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return (image.shape[1], image.shape[0], etag == original)
+
+    # aspect ratio kept, the smallest scale of both sides
+    assert variantSize(300, 300) == (300, 150, False)
+    assert variantSize(100, 20) == (40, 20, False)
+    assert variantSize(200, None) == (200, 100, False)
+    assert variantSize(None, 50) == (100, 50, False)
+    # never enlarged: one side larger, or both
+    assert variantSize(800, 100) == (200, 100, False)
+    assert variantSize(800, 600) == (400, 200, True)
+    assert variantSize(400, None) == (400, 200, True)
+    assert store.variant('missing.jpg', 100, 100) == (None, None, None)
+
+
+def writeFile(directory, shard, filename, size, mtime):
+    path = directory.join(shard).ensure(filename)
+    path.write('x' * size)
+    os.utime(str(path), (mtime, mtime))
+    return str(path)
+
+
+def test_same_name_in_two_shards(tmpdir):
+    images = tmpdir.join('images')
+    older = writeFile(images, '2019-10-16', 'a.jpg', 100, 1000)
+    newer = writeFile(images, '2019-10-17', 'a.jpg', 30, 2000)
+    writeFile(images, '2019-10-17', 'b.jpg', 10, 1500)
+
+    retention = DiskRetention(str(images), max_bytes=1000, max_age=0)
+    # the shadowed file is removed and no longer counted
+    assert retention.find('a.jpg')[0] == newer
+    assert not os.path.exists(older) and not os.path.exists(os.path.dirname(older))
+    assert retention.stats()['bytes'] == 40 and retention.stats()['replaced'] == 1
+
+
+def test_written_again_in_another_shard(tmpdir):
+    images = tmpdir.join('images')
+    retention = DiskRetention(str(images), max_bytes=1000, max_age=0)
+    older = writeFile(images, '2019-10-16', 'a.jpg', 100, 1000)
+    retention.add('a.jpg', older, 100)
+    newer = writeFile(images, '2019-10-17', 'a.jpg', 30, 2000)
+    retention.add('a.jpg', newer, 30)
+    assert not os.path.exists(older)
+    assert retention.stats()['bytes'] == 30
+    # the same path again is only registered
+    retention.add('a.jpg', newer, 30)
+    assert os.path.exists(newer) and retention.stats()['bytes'] == 30
+
+
+def test_oldest_files_evicted_beyond_the_quota(tmpdir):
+    images = tmpdir.join('images')
+    paths = [writeFile(images, '2019-10-17', name, 40, mtime)
+             for (name, mtime) in (('a.jpg', 1000), ('b.jpg', 3000), ('c.jpg', 2000))]
+    retention = DiskRetention(str(images), max_bytes=80, max_age=0)
+    assert retention.evict(force=True) == 1
+    assert not os.path.exists(paths[0]) and os.path.exists(paths[1]) and os.path.exists(paths[2])
+    assert retention.stats()['bytes'] == 80
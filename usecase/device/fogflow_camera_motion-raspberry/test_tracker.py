@@ -0,0 +1,81 @@
+# Tests of the matching of the moving objects across frames (see tracker.py).
+# Usage: python -m pytest test_tracker.py
+
+from tracker import ObjectTracker
+
+
+# box (x, y, w, h) centered on a centroid
+def box(cx, cy):
+    return (cx - 5, cy - 5, 10, 10)
+
+
+# the ids of the tracks updated with the boxes centered on the centroids, in the order
+# of the centroids
+def frame(tracker, centroids):
+    tracks = tracker.update([box(cx, cy) for (cx, cy) in centroids])
+    byCentroid = dict((track.centroid, track.id) for track in tracks)
+    return [byCentroid[c] for c in centroids]
+
+
+def test_new_objects_then_matched():
+    tracker = ObjectTracker(max_distance=80)
+    assert frame(tracker, [(100, 100), (300, 100)]) == [0, 1]
+    assert tracker.tracks[0].previous() is None
+    assert frame(tracker, [(310, 110), (120, 90)]) == [1, 0]
+    assert tracker.tracks[0].previous() == (100, 100)
+    assert tracker.tracks[0].box == box(120, 90)
+
+
+def test_closest_pairs_first():
+    tracker = ObjectTracker(max_distance=80)
+    frame(tracker, [(0, 0), (50, 0)])
+    # both boxes are within reach of both objects
+    assert frame(tracker, [(45, 0), (10, 0)]) == [1, 0]
+
+
+def test_max_distance_boundary():
+    tracker = ObjectTracker(max_distance=80)
+    frame(tracker, [(100, 100), (400, 400)])
+    # exactly the maximum distance still matches, one pixel more does not
+    assert frame(tracker, [(180, 100), (400, 481)]) == [0, 2]
+
+
+def test_matched_across_grid_cells():
+    tracker = ObjectTracker(max_distance=80)
+    # the cells are 80 pixels wide: moves into the diagonal, the same and the vertical
+    # neighbouring cells
+    frame(tracker, [(79, 79)])
+    assert frame(tracker, [(81, 81)]) == [0]
+    assert frame(tracker, [(159, 81)]) == [0]
+    assert frame(tracker, [(159, 160)]) == [0]
+    assert frame(tracker, [(80, 160)]) == [0]
+
+
+def test_one_box_per_object():
+    tracker = ObjectTracker(max_distance=80)
+    frame(tracker, [(100, 100)])
+    # the second box is a new object even though it is within reach
+    assert frame(tracker, [(130, 100), (110, 100)]) == [1, 0]
+
+
+def test_missed_frames():
+    tracker = ObjectTracker(max_distance=80, max_missed=2)
+    frame(tracker, [(100, 100)])
+    frame(tracker, [])
+    frame(tracker, [])
+    # seen again within max_missed frames: same object
+    assert frame(tracker, [(110, 100)]) == [0]
+    assert tracker.tracks[0].missed == 0
+    for i in range(3):
+        frame(tracker, [])
+    # dropped after max_missed frames
+    assert tracker.tracks == {}
+    assert frame(tracker, [(110, 100)]) == [1]
+
+
+def test_trajectory_bounded():
+    tracker = ObjectTracker(max_distance=80, history=3)
+    for x in range(0, 50, 10):
+        frame(tracker, [(x, 0)])
+    assert list(tracker.tracks[0].trajectory) == [(20, 0), (30, 0), (40, 0)]
+    assert tracker.tracks[0].previous() == (30, 0)
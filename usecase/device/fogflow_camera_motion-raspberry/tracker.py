@@ -0,0 +1,96 @@
+# Multi-object centroid tracker: every moving blob gets an ID that is kept across
+# frames by matching the new boxes with the known objects by centroid distance.
+# Candidate pairs are looked up in a spatial grid, so matching costs O(n log n)
+# per frame instead of building the full n x m cost matrix.
+
+from collections import deque
+
+
+class Track:
+
+    def __init__(self, object_id, box, centroid, history):
+        self.id = object_id
+        self.box = box
+        self.centroid = centroid
+        # short trajectory of the object, latest centroid last
+        self.trajectory = deque([centroid], maxlen=history)
+        self.missed = 0
+        # lines already crossed by this object
+        self.crossed = set()
+
+    # centroid before the last update, None for a new object
+    def previous(self):
+        if len(self.trajectory) < 2:
+            return None
+        return self.trajectory[-2]
+
+    def update(self, box, centroid):
+        self.box = box
+        self.centroid = centroid
+        self.trajectory.append(centroid)
+        self.missed = 0
+
+
+class ObjectTracker:
+
+    def __init__(self, max_distance=80, max_missed=5, history=16):
+        self.max_distance = max_distance  # maximum centroid displacement between two frames
+        self.max_missed = max_missed  # frames an object can disappear before it is dropped
+        self.history = history  # length of the kept trajectories
+        self.next_id = 0
+        self.tracks = {}
+
+    # match the boxes (x, y, w, h) of a new frame with the tracked objects
+    # returns the tracks updated in this frame
+    def update(self, boxes):
+        centroids = [(x + w // 2, y + h // 2) for (x, y, w, h) in boxes]
+
+        # spatial grid of the known objects, with cells as large as the maximum distance
+        cell = float(self.max_distance)
+        grid = {}
+        for track in self.tracks.values():
+            key = (int(track.centroid[0] // cell), int(track.centroid[1] // cell))
+            grid.setdefault(key, []).append(track)
+
+        # sparse cost matrix: only pairs in neighbouring cells can be matched
+        pairs = []
+        for (i, (cx, cy)) in enumerate(centroids):
+            (gx, gy) = (int(cx // cell), int(cy // cell))
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for track in grid.get((gx + dx, gy + dy), ()):
+                        dist = ((track.centroid[0] - cx) ** 2 + (track.centroid[1] - cy) ** 2) ** 0.5
+                        if dist <= self.max_distance:
+                            pairs.append((dist, track.id, i))
+
+        # greedy assignment, closest pairs first
+        pairs.sort()
+        updated = []
+        matched_tracks = set()
+        matched_boxes = set()
+        for (dist, track_id, i) in pairs:
+            if track_id in matched_tracks or i in matched_boxes:
+                continue
+            matched_tracks.add(track_id)
+            matched_boxes.add(i)
+            track = self.tracks[track_id]
+            track.update(boxes[i], centroids[i])
+            updated.append(track)
+
+        # objects not seen in this frame are dropped after max_missed frames
+        for track_id in list(self.tracks.keys()):
+            if track_id not in matched_tracks:
+                track = self.tracks[track_id]
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    del self.tracks[track_id]
+
+        # new objects
+        for (i, box) in enumerate(boxes):
+            if i not in matched_boxes:
+                track = Track(self.next_id, box, centroids[i], self.history)
+                self.next_id += 1
+                self.tracks[track.id] = track
+                updated.append(track)
+
+        return updated
@@ -0,0 +1,52 @@
+# Buffers of the motion detection, allocated once at the stream's analysis size and
+# passed as dst to every OpenCV call, so the per-frame path does not allocate images.
+# Any buffer OpenCV has to reallocate is counted, so regressions show up in the stats.
+
+import logging
+import numpy as np
+
+
+class FrameWorkspace:
+
+    def __init__(self):
+        self.buffers = {}
+
+        # allocation counters
+        self.frames = 0
+        self.allocated = 0  # bytes allocated by the per-frame path
+        self.last_allocated = 0
+        self.warned = False
+
+    # get a named buffer, allocated the first time or when its shape changes
+    def buffer(self, name, shape, dtype=np.uint8):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buf
+        return buf
+
+    # keep the array returned by OpenCV, counting it if it is not the expected buffer
+    def keep(self, name, result):
+        if result is not self.buffers.get(name):
+            self.last_allocated += result.nbytes
+            self.buffers[name] = result
+        return result
+
+    # bracket the processing of one frame
+    def begin(self):
+        self.last_allocated = 0
+
+    def end(self):
+        self.frames += 1
+        self.allocated += self.last_allocated
+        if self.last_allocated > 0 and not self.warned:
+            logging.info('[WARN] frame workspace allocated ' + str(self.last_allocated) + ' bytes in one frame')
+            self.warned = True
+
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self.buffers.values())
+
+    def stats(self):
+        return {'frames': self.frames, 'buffer_bytes': self.nbytes(), 'allocated_bytes': self.allocated,
+                'last_frame_bytes': self.last_allocated,
+                'bytes_per_frame': round(float(self.allocated) / self.frames, 1) if self.frames > 0 else 0.0}
@@ -1,11 +1,22 @@
 from flask import Flask, jsonify, abort, request, make_response
-import requests
 import json
 import threading
 import os
-import urllib
-import sys
+import base64
 import signal
+import time
+import ngsi
+from model import ModelManager
+from work_queue import WorkQueue
+from multiprocessing.pool import ThreadPool
+try:
+    from Queue import Queue, Empty
+    from urllib2 import urlopen
+    from urlparse import urlparse
+except ImportError:
+    from queue import Queue, Empty
+    from urllib.request import urlopen
+    from urllib.parse import urlparse
 
 # import the necessary packages
 import cv2
@@ -17,8 +28,16 @@ CLASSES = ["background", "aeroplane", "bicycle", "bird", "boat",
            "bottle", "bus", "car", "cat", "chair", "cow", "diningtable",
            "dog", "horse", "motorbike", "person", "pottedplant", "sheep",
            "sofa", "train", "tvmonitor"]
-net = cv2.dnn.readNetFromCaffe(
-    "MobileNetSSD_deploy.prototxt.txt", "MobileNetSSD_deploy.caffemodel")
+PROTOTXT = "MobileNetSSD_deploy.prototxt.txt"
+CAFFEMODEL = "MobileNetSSD_deploy.caffemodel"
+# input size of the network, the device sends the image already resized
+INPUT_SIZE = (300, 300)
+# detections published as vehicles, changed with the confidence and vehicleClasses
+# environment variables
+MIN_CONFIDENCE = 0.5
+VEHICLE_CLASSES = ["bicycle", "bus", "car", "motorbike"]
+# seconds to download an image, changed with the imageTimeout environment variable
+IMAGE_TIMEOUT = 5
 
 # HTTP server
 app = Flask(__name__, static_url_path="")
@@ -27,7 +46,14 @@ app = Flask(__name__, static_url_path="")
 brokerURL = ''
 outputs = []
 timer = None
-lock = threading.Lock()
+model = None  # loaded in the background, see model.py
+batcher = None
+workQueue = None
+minConfidence = MIN_CONFIDENCE
+isVehicle = np.array([c in VEHICLE_CLASSES for c in CLASSES])  # by class index
+imageVariants = False  # the devices serve resized variants (?w=&h=), see image_server.py
+imageTimeout = IMAGE_TIMEOUT
+plainHosts = set()  # devices which failed a variant request, asked for the plain image since
 
 
 def signal_handler(signal, frame):
@@ -54,17 +80,7 @@ def deleteContext(ctxObj):
     if brokerURL == '':
         return
     print('===============unpublish context entity====================')
-    ctxElement = object2Element(ctxObj)
-
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'DELETE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept': 'application/json',
-               'Content-Type': 'application/json'}
-    response = requests.post(brokerURL + '/updateContext',
-                             data=json.dumps(updateCtxReq), headers=headers)
+    response = ngsi.deleteContext(brokerURL, [ctxObj])
     if response.status_code != 200:
         print('failed to delete context')
         print(response.text)
@@ -93,79 +109,55 @@ def admin():
 
 @app.route('/notifyContext', methods=['POST'])
 def notifyContext():
-    lock.acquire()
     print("=============notify=============")
 
-    if not request.json:
+    # decoded with the fastest JSON backend, the attributes when they are used (see ngsi.py)
+    try:
+        objs = ngsi.readContextElements(request.get_data())
+    except (ValueError, KeyError, TypeError):
         abort(400)
-
-    objs = readContextElements(request.json)
     # print(objs)
 
-    handleNotify(objs)
-    lock.release()
-    return jsonify({'responseCode': 200})
-
-
-def element2Object(element):
-    ctxObj = {}
-
-    ctxObj['entityId'] = element['entityId']
-
-    ctxObj['attributes'] = {}
-    if 'attributes' in element:
-        for attr in element['attributes']:
-            ctxObj['attributes'][attr['name']] = {
-                'type': attr['type'], 'value': attr['value']}
-
-    ctxObj['metadata'] = {}
-    if 'domainMetadata' in element:
-        for meta in element['domainMetadata']:
-            ctxObj['metadata'][meta['name']] = {
-                'type': meta['type'], 'value': meta['value']}
-
-    return ctxObj
-
-
-def object2Element(ctxObj):
-    ctxElement = {}
-
-    ctxElement['entityId'] = ctxObj['entityId']
-
-    ctxElement['attributes'] = []
-    if 'attributes' in ctxObj:
-        for key in ctxObj['attributes']:
-            attr = ctxObj['attributes'][key]
-            ctxElement['attributes'].append(
-                {'name': key, 'type': attr['type'], 'value': attr['value']})
-
-    ctxElement['domainMetadata'] = []
-    if 'metadata' in ctxObj:
-        for key in ctxObj['metadata']:
-            meta = ctxObj['metadata'][key]
-            ctxElement['domainMetadata'].append(
-                {'name': key, 'type': meta['type'], 'value': meta['value']})
-
-    return ctxElement
+    # not advertised before the model is loaded and warmed up
+    if model is None or not model.ready.is_set():
+        return make_response(jsonify({'responseCode': 503}), 503)
 
+    # acknowledged right away, the entities are processed by the workers
+    if workQueue is None:
+        handleNotify(objs)
+    elif not workQueue.submit(objs):
+        return make_response(jsonify({'responseCode': 503}), 503)
+    return jsonify({'responseCode': 200})
 
-def readContextElements(data):
-    # print(data)
 
-    ctxObjects = []
+@app.route('/ready', methods=['GET'])
+def ready():
+    if model is None or not model.ready.is_set():
+        return make_response(jsonify({'ready': False, 'error': model.error if model is not None else None}), 503)
+    return jsonify({'ready': True})
 
-    for response in data['contextResponses']:
-        if response['statusCode']['code'] == 200:
-            ctxObj = element2Object(response['contextElement'])
-            ctxObjects.append(ctxObj)
 
-    return ctxObjects
+@app.route('/stats', methods=['GET'])
+def stats():
+    stats = {}
+    if model is not None:
+        stats['model'] = model.stats()
+    if workQueue is not None:
+        stats['queue'] = workQueue.stats()
+    if batcher is not None:
+        stats['batcher'] = batcher.stats()
+    return jsonify(stats)
 
 
 def handleNotify(contextObjs):
     #print("TODO O OBJETO")
     #print(json.dumps(contextObjs, indent=3))
 
+    # batching mode: processed with the entities of the concurrent notifications
+    if batcher is not None:
+        batcher.process(contextObjs)
+        return
+
     for ctxObj in contextObjs:
         # if(ctxObj['entityId']):
         processInputStreamData(ctxObj)
@@ -173,53 +165,196 @@ def handleNotify(contextObjs):
 
 def processInputStreamData(obj):
     print('===============receive context entity====================')
-    print(json.dumps(obj, indent=3))
+    print(json.dumps(obj.toObject(), indent=3))
     # print(obj)
-    url = ''
-    if 'attributes' in obj:
-        att = obj['attributes']
-        if 'url' in att:
-            urll = att['url']
-            if 'value' in urll:
-                url = urll['value']
-
-    #url = obj["attributes"]["url"]["value"]
-    if url:
-        # run the object detector neural network
-        print('===============retrieve image from====================')
-        print(url)
-        image = url2Image(url)
-        (h, w) = image.shape[:2]
-        blob = cv2.dnn.blobFromImage(cv2.resize(
-            image, (300, 300)), 0.007843, (300, 300), 127.5)
-        net.setInput(blob)
-        detections = net.forward()
-        #confidence = detections[0, 0, 0, 2]
-        idx = int(detections[0, 0, 0, 1])
-        #box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-        #(startX, startY, endX, endY) = box.astype("int")
-        # display the prediction
-        objclass = CLASSES[idx]
-
-    # publish the counting result
-    entity = {}
-    # + obj["entityId"]["id"].split('.')[-1]
-    entity['id'] = "Stream.VehicleType"
-    entity['type'] = "VehicleType"
-    entity['url'] = url
-    entity['timestamp'] = obj["attributes"]["timestamp"]["value"]
-    entity['direction'] = obj["attributes"]["direction"]["value"]
-    entity['class'] = objclass
-    metadata = obj["metadata"]
-    publishResult(entity, metadata)
+    processBatch([obj])
+
+
+# Batches of the entities notified concurrently, collected for up to size entities
+# or timeout seconds after the first one: their images are downloaded concurrently,
+# classified by a single net.forward() and the results published in one update.
+# Enabled with the batchSize (> 1) and batchTimeout (ms) environment variables.
+class Batcher(threading.Thread):
+
+    def __init__(self, size, timeout):
+        threading.Thread.__init__(self, name='batcher')
+        self.daemon = True
+        self.size = size
+        self.timeout = timeout
+        self.queue = Queue()
+        self.pool = ThreadPool(size)  # image downloads
+
+        # counters
+        self.batches = 0
+        self.entities = 0
+        self.failed = 0  # entities whose image could not be loaded
+
+    # process the entities of a notification, returns once their batch is published
+    def process(self, objs):
+        done = threading.Event()
+        self.queue.put((objs, done))
+        done.wait()
+
+    def run(self):
+        while True:
+            units = [self.queue.get()]
+            count = len(units[0][0])
+            deadline = time.time() + self.timeout
+            while count < self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    units.append(self.queue.get(timeout=remaining))
+                except Empty:
+                    break
+                count += len(units[-1][0])
+
+            objs = [obj for (unitObjs, done) in units for obj in unitObjs]
+            print('===============process a batch of ' + str(len(objs)) + ' entities====================')
+            try:
+                self.failed += processBatch(objs, self.pool.map)
+                self.batches += 1
+                self.entities += len(objs)
+            except Exception as e:
+                print('failed to process the batch: ' + str(e))
+            for (unitObjs, done) in units:
+                done.set()
+
+    def stats(self):
+        return {'size': self.size, 'timeout': self.timeout, 'batches': self.batches, 'entities': self.entities,
+                'failed': self.failed,
+                'avg_batch': round(float(self.entities) / self.batches, 2) if self.batches > 0 else 0.0}
+
+
+# classify the images of the entities together and publish the results in one update;
+# the entities whose image cannot be loaded are dropped, returns their number
+def processBatch(objs, mapper=map):
+    objs = [obj for obj in objs if obj.value('url', '')]
+    if len(objs) == 0:
+        return 0
+    images = list(mapper(tryLoadImage, objs))
+    loaded = [(obj, image) for (obj, image) in zip(objs, images) if image is not None]
+    if len(loaded) == 0:
+        return len(objs)
+    detected = detect([image for (obj, image) in loaded])
+
+    results = []
+    for ((obj, image), (objclass, vehicles)) in zip(loaded, detected):
+        # publish the counting result
+        entity = {}
+        # + obj["entityId"]["id"].split('.')[-1]
+        entity['id'] = "Stream.VehicleType"
+        entity['type'] = "VehicleType"
+        entity['url'] = obj.value('url')
+        entity['timestamp'] = obj["attributes"]["timestamp"]["value"]
+        entity['direction'] = obj["attributes"]["direction"]["value"]
+        entity['class'] = objclass
+        entity['vehicles'] = vehicles
+        metadata = obj["metadata"]
+        results.append(resultObject(entity, metadata))
+    # publish the real time results as context updates
+    updateContext(results)
+    return len(objs) - len(loaded)
 
 
-def url2Image(url):
-    resp = urllib.urlopen(url)
-    data = resp.read()
+# image of an entity at the input size of the network
+def loadImage(obj):
+    url = obj.value('url', '')
 
+    # image sent inline by the device, no need to fetch it
+    data = obj.value('image', '')
+    if data:
+        image = base642Image(data)
+    else:
+        print('===============retrieve image from====================')
+        print(url)
+        image = url2Image(url, INPUT_SIZE)
+    (h, w) = image.shape[:2]
+    if (w, h) != INPUT_SIZE:
+        image = cv2.resize(image, INPUT_SIZE)
+    return image
+
+
+# image of an entity, None when it cannot be loaded
+def tryLoadImage(obj):
+    try:
+        return loadImage(obj)
+    except Exception as e:
+        print('failed to load the image of ' + obj.value('url', '') + ': ' + str(e))
+        return None
+
+
+# run the object detector neural network on the images stacked in one NCHW blob,
+# returns the class of the top detection and the vehicles of each image
+def detect(images):
+    blob = cv2.dnn.blobFromImages(images, 0.007843, INPUT_SIZE, 127.5)
+    net = model.net()
+    net.setInput(blob)
+    detections = net.forward()
+    return decodeDetections(detections, len(images))
+
+
+# all the detections of a batch decoded at once; a row of the tensor is the index of
+# the image in the batch, the class, the confidence and the box relative to the image
+def decodeDetections(detections, n):
+    rows = detections.reshape(-1, 7).astype(np.float64)
+    ids = rows[:, 0].astype(np.int32)
+    rows = rows[(ids >= 0) & (ids < n) & (rows[:, 1] >= 0)]
+    ids = rows[:, 0].astype(np.int32)
+    labels = rows[:, 1].astype(np.int32)
+
+    # class of the top detection of each image, background when there is none
+    top = np.zeros(n, dtype=np.int32)
+    (present, first) = np.unique(ids, return_index=True)
+    top[present] = labels[first]
+
+    # vehicles above the confidence, by image and the most confident first
+    keep = (rows[:, 2] >= minConfidence) & isVehicle[labels]
+    (rows, ids, labels) = (rows[keep], ids[keep], labels[keep])
+    order = np.lexsort((-rows[:, 2], ids))
+    (rows, ids, labels) = (rows[order], ids[order], labels[order])
+    bounds = np.searchsorted(ids, np.arange(n + 1)).tolist()
+    names = np.array(CLASSES)[labels].tolist()
+    confidences = np.round(rows[:, 2], 3).tolist()
+    boxes = np.round(np.clip(rows[:, 3:7], 0.0, 1.0), 4).tolist()
+
+    results = []
+    for i in range(n):
+        vehicles = [{'class': names[j], 'confidence': confidences[j], 'box': boxes[j]}
+                    for j in range(bounds[i], bounds[i + 1])]
+        results.append((CLASSES[top[i]], vehicles))
+    return results
+
+
+def url2Image(url, size=None):
+    # ask the device for a variant of the image at the size it is used when the devices
+    # serve them (enabled with the imageVariants environment variable); a device which
+    # does not gets asked for the plain image from then on
+    host = urlparse(url).netloc
+    if imageVariants and size is not None and host not in plainHosts:
+        try:
+            return bytes2Image(fetch(url + ('&' if '?' in url else '?') + 'w=%d&h=%d' % size))
+        except Exception as e:
+            plainHosts.add(host)
+            print('no image variant from ' + host + ', retrying the plain url: ' + str(e))
+    return bytes2Image(fetch(url))
+
+
+def fetch(url):
+    resp = urlopen(url, timeout=imageTimeout)
+    return resp.read()
+
+
+def base642Image(value):
+    return bytes2Image(base64.b64decode(value))
+
+
+def bytes2Image(data):
     image = np.asarray(bytearray(data), dtype=np.uint8)
     image = cv2.imdecode(image, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('the data is not an image')
     rgbImg = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     return rgbImg
 
@@ -234,7 +369,7 @@ def handleConfig(configurations):
             outputs.append({'id': config['id'], 'type': config['type']})
 
 
-def publishResult(result, metadata):
+def resultObject(result, metadata):
     resultCtxObj = {}
 
     resultCtxObj['entityId'] = {}
@@ -245,6 +380,8 @@ def publishResult(result, metadata):
     resultCtxObj['attributes'] = {}
     resultCtxObj['attributes']['class'] = {
         'type': 'string', 'value': result['class']}
+    resultCtxObj['attributes']['vehicles'] = {
+        'type': 'array', 'value': result['vehicles']}
     resultCtxObj['attributes']['url'] = {
         'type': 'string', 'value': result['url']}
     resultCtxObj['attributes']['timestamp'] = {
@@ -253,29 +390,19 @@ def publishResult(result, metadata):
         'type': 'string', 'value': result['direction']}
 
     resultCtxObj['metadata'] = metadata
-
-    # publish the real time results as context updates
-    updateContext(resultCtxObj)
+    return resultCtxObj
 
 
-def updateContext(ctxObj):
+# publish context objects in one update
+def updateContext(ctxObjs):
     print('===============update context entity====================')
-    print(json.dumps(ctxObj, indent=3))
+    for ctxObj in ctxObjs:
+        print(json.dumps(ctxObj, indent=3))
     global brokerURL
     if brokerURL == '':
         return
 
-    ctxElement = object2Element(ctxObj)
-
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'UPDATE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept': 'application/json',
-               'Content-Type': 'application/json'}
-    response = requests.post(brokerURL + '/updateContext',
-                             data=json.dumps(updateCtxReq), headers=headers)
+    response = ngsi.updateContext(brokerURL, ctxObjs)
     if response.status_code != 200:
         print('failed to update context')
         print(response.text)
@@ -287,6 +414,34 @@ if __name__ == '__main__':
     myCfg = os.environ['adminCfg']
     adminCfg = json.loads(myCfg)
     handleConfig(adminCfg)
+
+    # detections published as vehicles
+    minConfidence = float(os.environ.get('confidence', MIN_CONFIDENCE))
+    vehicleClasses = os.environ.get('vehicleClasses', ','.join(VEHICLE_CLASSES)).split(',')
+    isVehicle = np.zeros(len(CLASSES), dtype=bool)
+    isVehicle[[CLASSES.index(c.strip()) for c in vehicleClasses]] = True
+
+    # image downloads, see url2Image
+    imageVariants = os.environ.get('imageVariants', 'false').lower() in ('1', 'true', 'yes')
+    imageTimeout = float(os.environ.get('imageTimeout', IMAGE_TIMEOUT))
+
+    # batching mode, see Batcher
+    batchSize = int(os.environ.get('batchSize', '1'))
+    if batchSize > 1:
+        batcher = Batcher(batchSize, float(os.environ.get('batchTimeout', '50')) / 1000.0)
+        batcher.start()
+
+    # notifications processed by a pool of workers, see work_queue.py; in batching mode
+    # each worker waits for its batch, a batch gathers the notifications of the workers
+    workers = int(os.environ.get('workers', max(2, batchSize)))
+    workQueue = WorkQueue(handleNotify, workers, int(os.environ.get('queueSize', '64')))
+
+    # one net per thread running inferences: the batcher, or each worker
+    model = ModelManager(PROTOTXT, CAFFEMODEL, INPUT_SIZE, int(os.environ.get('warmup', '2')), batchSize)
+    loader = threading.Thread(target=model.load, args=(1 if batcher is not None else workers,), name='model-loader')
+    loader.daemon = True
+    loader.start()
+
     signal.signal(signal.SIGINT, signal_handler)
     app.run(host='0.0.0.0', port=myport)
 
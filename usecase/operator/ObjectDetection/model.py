@@ -0,0 +1,104 @@
+# Model of the object detector. The files of the network are read once; every thread
+# running inferences gets its own cv2.dnn net built from them (a net is not thread
+# safe, a single global net would serialize the workers). The nets are warmed up
+# before the operator is ready: OpenCV initializes a net lazily on its first forward,
+# which would otherwise be paid by the first notification. A model which fails to load
+# is reported by /ready and /stats, and the threads asking for a net get an error
+# instead of waiting for it.
+# Configured with the warmup environment variable (inferences per net).
+
+import time
+import threading
+import numpy as np
+import cv2
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+class ModelManager:
+
+    def __init__(self, prototxt, caffemodel, input_size, warmup=2, batch=1, timeout=300):
+        self.prototxt = prototxt
+        self.caffemodel = caffemodel
+        self.input_size = input_size
+        self.warmup = max(0, int(warmup))  # inferences run on each new net
+        self.batch = batch  # images per inference, the blob shape the nets are warmed up with
+        self.timeout = timeout  # seconds net() waits for the model to load
+
+        self.proto = None
+        self.model = None
+        self.local = threading.local()
+        self.spare = Queue()  # nets built and warmed up, not yet used by a thread
+        self.ready = threading.Event()
+        self.done = threading.Event()  # loaded or failed
+        self.error = None  # why the model failed to load
+        self.lock = threading.Lock()
+
+        # counters
+        self.nets = 0
+        self.load_time = 0.0
+        self.warmup_time = 0.0
+
+    # read the files and prepare the nets of the threads, then the model is ready
+    def load(self, nets=1):
+        start = time.time()
+        try:
+            with open(self.prototxt, 'rb') as f:
+                self.proto = np.frombuffer(f.read(), dtype=np.uint8)
+            with open(self.caffemodel, 'rb') as f:
+                self.model = np.frombuffer(f.read(), dtype=np.uint8)
+            for i in range(max(1, nets)):
+                self.spare.put(self.build())
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+            print('failed to load the model: ' + self.error)
+            return False
+        finally:
+            self.load_time = time.time() - start
+            self.done.set()
+        self.ready.set()
+        print('model ready: ' + str(self.nets) + ' nets in ' + str(round(self.load_time, 3)) + 's')
+        return True
+
+    # a new net from the files in memory, warmed up
+    def build(self):
+        try:
+            net = cv2.dnn.readNetFromCaffe(self.proto, self.model)
+        except (cv2.error, TypeError):
+            # OpenCV without the in-memory loader
+            net = cv2.dnn.readNetFromCaffe(self.prototxt, self.caffemodel)
+
+        start = time.time()
+        for batch in sorted(set([1, self.batch])):
+            blob = np.zeros((batch, 3, self.input_size[1], self.input_size[0]), dtype=np.float32)
+            for i in range(self.warmup):
+                net.setInput(blob)
+                net.forward()
+        with self.lock:
+            self.nets += 1
+            self.warmup_time += time.time() - start
+        return net
+
+    # net of the calling thread
+    def net(self):
+        net = getattr(self.local, 'net', None)
+        if net is None:
+            self.done.wait(self.timeout)
+            if self.error is not None:
+                raise RuntimeError('the model failed to load: ' + self.error)
+            if not self.ready.is_set():
+                raise RuntimeError('the model is not loaded yet')
+            try:
+                net = self.spare.get_nowait()
+            except Empty:
+                net = self.build()
+            self.local.net = net
+        return net
+
+    def stats(self):
+        with self.lock:
+            return {'ready': self.ready.is_set(), 'error': self.error, 'nets': self.nets, 'spare': self.spare.qsize(),
+                    'warmup': self.warmup, 'load_time': round(self.load_time, 6),
+                    'warmup_time': round(self.warmup_time, 6)}
@@ -0,0 +1,214 @@
+# Tests of the image downloads and batches of the operator, against devices served
+# locally and a fake net, and of the decoding of the detections.
+# Usage: python -m pytest test_main.py
+
+import time
+import threading
+import cv2
+import numpy as np
+import main
+import ngsi
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+IMAGE = cv2.imencode('.jpg', np.full((480, 640, 3), 128, dtype=np.uint8))[1].tobytes()
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# the handler of fakecamera.py before it ignored the query string: no answer at all
+class PlainCamera(BaseHTTPRequestHandler):
+    paths = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        if self.path == '/image':
+            self.send_response(200)
+            self.send_header('Content-type', 'image/png')
+            self.end_headers()
+            self.wfile.write(IMAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+# a device which answers 404 to the query strings it does not know
+class StrictCamera(PlainCamera):
+    paths = []
+
+    def do_GET(self):
+        if '?' in self.path:
+            self.paths.append(self.path)
+            self.send_error(404, 'not found')
+            return
+        PlainCamera.do_GET(self)
+
+
+# a device whose /slow image takes longer than the download timeout
+class SlowCamera(PlainCamera):
+
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(3)
+            return
+        PlainCamera.do_GET(self)
+
+
+# a car detected in each image of the blob
+class FakeNet:
+
+    def setInput(self, blob):
+        self.n = blob.shape[0]
+
+    def forward(self):
+        return np.array([[[[i, 7, 0.9, 0.1, 0.1, 0.5, 0.5] for i in range(self.n)]]])
+
+
+class FakeModel:
+
+    def net(self):
+        return FakeNet()
+
+
+def serve(handler):
+    server = Server(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# the image fetched `times` from a device served by handler, and the time it took
+def fetchImage(handler, variants, times=1):
+    del handler.paths[:]
+    main.plainHosts.clear()
+    (main.imageVariants, main.imageTimeout) = (variants, 2)
+    server = serve(handler)
+    try:
+        url = 'http://127.0.0.1:%d/image' % server.server_address[1]
+        start = time.time()
+        for i in range(times):
+            image = main.url2Image(url, main.INPUT_SIZE)
+        return (image, time.time() - start)
+    finally:
+        server.shutdown()
+        server.server_close()
+        main.imageVariants = False
+
+
+def test_plain_url_by_default():
+    (image, elapsed) = fetchImage(PlainCamera, False)
+    assert image.shape == (480, 640, 3)
+    assert PlainCamera.paths == ['/image']
+
+
+def test_variant_unsupported_falls_back_to_plain_url():
+    for handler in (PlainCamera, StrictCamera):
+        (image, elapsed) = fetchImage(handler, True)
+        assert image.shape == (480, 640, 3)
+        assert handler.paths[0] == '/image?w=300&h=300'
+        assert elapsed < main.imageTimeout
+        assert len(main.plainHosts) == 1
+
+
+def test_plain_url_once_the_variant_failed():
+    fetchImage(PlainCamera, True, 3)
+    assert PlainCamera.paths == ['/image?w=300&h=300', '/image', '/image', '/image']
+
+
+def entities(urls):
+    ctxObjs = []
+    for (i, url) in enumerate(urls):
+        ctxObjs.append({'entityId': {'id': 'Device.Camera.' + str(i), 'type': 'Camera', 'isPattern': False},
+                        'attributes': {'url': {'type': 'string', 'value': url},
+                                       'timestamp': {'type': 'string', 'value': str(i)},
+                                       'direction': {'type': 'string', 'value': 'Up'}},
+                        'metadata': {}})
+    notification = {'contextResponses': [{'contextElement': ngsi.object2Element(ctxObj),
+                                          'statusCode': {'code': 200}} for ctxObj in ctxObjs]}
+    return ngsi.readContextElements(notification)
+
+
+# the urls of the updates published while processing the entities of urls with fn
+def publishedUrls(monkeypatch, handler, urls, fn):
+    published = []
+    monkeypatch.setattr(main, 'model', FakeModel())
+    monkeypatch.setattr(main, 'updateContext', lambda ctxObjs: published.extend(ctxObjs))
+    monkeypatch.setattr(main, 'imageTimeout', 1)
+    server = serve(handler)
+    try:
+        base = 'http://127.0.0.1:%d' % server.server_address[1]
+        result = fn(entities([url.format(device=base) for url in urls]))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return (result, [ctxObj['attributes']['url']['value'].split('/')[-1] for ctxObj in published])
+
+
+def test_batch_without_the_image_of_an_entity(monkeypatch):
+    urls = ['{device}/image', '{device}/missing', 'http://127.0.0.1:1/image', '{device}/image?a=1']
+    (failed, published) = publishedUrls(monkeypatch, StrictCamera, urls, main.processBatch)
+    assert failed == 3
+    assert published == ['image']
+
+
+def test_batch_with_a_slow_device(monkeypatch):
+    batcher = main.Batcher(3, 0.05)
+    batcher.start()
+    start = time.time()
+    (result, published) = publishedUrls(monkeypatch, SlowCamera, ['{device}/slow', '{device}/image'],
+                                        batcher.process)
+    assert time.time() - start < 2.5
+    assert published == ['image']
+    assert batcher.stats()['failed'] == 1
+
+
+# detections tensor of the rows (image, class name, confidence, box)
+def detections(rows):
+    return np.array([[[[i, main.CLASSES.index(name), confidence] + list(box)
+                       for (i, name, confidence, box) in rows]]], dtype=np.float32)
+
+
+BOX = (0.1, 0.2, 0.3, 0.4)
+
+
+def test_decode_vehicles_by_image():
+    decoded = main.decodeDetections(detections([
+        (0, 'person', 0.95, BOX),
+        (0, 'car', 0.6, BOX),
+        (1, 'bus', 0.7, BOX),
+        (0, 'motorbike', 0.9, BOX),
+        (1, 'car', 0.8, (-0.2, 0.5, 1.3, 0.9)),
+    ]), 3)
+    # the class of the first detection, the vehicles the most confident first
+    assert [objclass for (objclass, vehicles) in decoded] == ['person', 'bus', 'background']
+    assert [[v['class'] for v in vehicles] for (objclass, vehicles) in decoded] == [
+        ['motorbike', 'car'], ['car', 'bus'], []]
+    # boxes clipped to the image
+    assert decoded[1][1][0] == {'class': 'car', 'confidence': 0.8, 'box': [0.0, 0.5, 1.0, 0.9]}
+
+
+def test_decode_thresholds(monkeypatch):
+    rows = [(0, 'car', 0.5, BOX), (0, 'bicycle', 0.49, BOX), (0, 'dog', 0.99, BOX)]
+    decoded = main.decodeDetections(detections(rows), 1)
+    assert decoded == [('car', [{'class': 'car', 'confidence': 0.5, 'box': [0.1, 0.2, 0.3, 0.4]}])]
+
+    monkeypatch.setattr(main, 'minConfidence', 0.2)
+    monkeypatch.setattr(main, 'isVehicle', np.array([c in ('bicycle', 'dog') for c in main.CLASSES]))
+    decoded = main.decodeDetections(detections(rows), 1)
+    assert [v['class'] for v in decoded[0][1]] == ['dog', 'bicycle']
+
+
+def test_decode_padding_and_other_images():
+    # the rows of the images outside the batch and the padding (negative index or class)
+    # are ignored
+    padding = np.array([[[[-1, 0, 0, 0, 0, 0, 0], [0, -1, 0.9, 0, 0, 1, 1]]]], dtype=np.float32)
+    tensor = np.concatenate([detections([(2, 'car', 0.9, BOX)]), padding], axis=2)
+    assert main.decodeDetections(tensor, 2) == [('background', []), ('background', [])]
+    assert main.decodeDetections(np.zeros((1, 1, 0, 7), dtype=np.float32), 1) == [('background', [])]
@@ -0,0 +1,80 @@
+# Tests of the loading of the model (see model.py), with a fake cv2.dnn net.
+# Usage: python -m pytest test_model.py
+
+import time
+import threading
+import cv2
+import pytest
+import main
+from model import ModelManager
+
+
+class FakeNet:
+
+    def __init__(self):
+        self.forwards = 0
+
+    def setInput(self, blob):
+        self.shape = blob.shape
+
+    def forward(self):
+        self.forwards += 1
+
+
+def modelFiles(tmpdir):
+    (prototxt, caffemodel) = (tmpdir.join('model.prototxt'), tmpdir.join('model.caffemodel'))
+    prototxt.write('proto')
+    caffemodel.write('model')
+    return (str(prototxt), str(caffemodel))
+
+
+def test_load_and_warm_up(tmpdir, monkeypatch):
+    monkeypatch.setattr(cv2.dnn, 'readNetFromCaffe', lambda proto, model: FakeNet(), raising=False)
+    model = ModelManager(*modelFiles(tmpdir), input_size=(300, 300), warmup=2, batch=4)
+    assert model.load(nets=2)
+    assert model.ready.is_set() and model.error is None
+    net = model.net()
+    # warmed up at both blob sizes
+    assert net.forwards == 4 and net.shape == (4, 3, 300, 300)
+    assert model.net() is net
+    assert model.stats()['nets'] == 2 and model.stats()['spare'] == 1
+
+
+def test_missing_files(tmpdir):
+    model = ModelManager(str(tmpdir.join('missing.prototxt')), str(tmpdir.join('missing.caffemodel')), (300, 300))
+    assert not model.load()
+    assert not model.ready.is_set() and 'missing.prototxt' in model.error
+    assert model.stats()['error'] == model.error
+    start = time.time()
+    with pytest.raises(RuntimeError):
+        model.net()
+    assert time.time() - start < 1
+
+
+def test_invalid_model(tmpdir):
+    model = ModelManager(*modelFiles(tmpdir), input_size=(300, 300))
+    assert not model.load()
+    assert model.error
+    with pytest.raises(RuntimeError):
+        model.net()
+
+
+def test_net_before_the_model_is_loaded(tmpdir):
+    model = ModelManager(*modelFiles(tmpdir), input_size=(300, 300), timeout=0.1)
+    with pytest.raises(RuntimeError):
+        model.net()
+
+
+def test_ready_endpoint(tmpdir, monkeypatch):
+    model = ModelManager(str(tmpdir.join('missing.prototxt')), str(tmpdir.join('missing.caffemodel')), (300, 300))
+    monkeypatch.setattr(main, 'model', model)
+    client = main.app.test_client()
+    assert client.get('/ready').status_code == 503
+
+    loader = threading.Thread(target=model.load)
+    loader.start()
+    loader.join()
+    response = client.get('/ready')
+    assert response.status_code == 503
+    assert 'missing.prototxt' in response.get_json()['error']
+    assert client.get('/stats').get_json()['model']['error'] == model.error
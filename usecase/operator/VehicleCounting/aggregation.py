@@ -0,0 +1,245 @@
+# Streaming aggregation of the vehicle counts, keyed by (camera, class, direction).
+# Every key has its running total and two windows:
+#   sliding: the vehicles of the last `sliding` seconds, a ring buffer of per-bucket
+#            counters (`resolution` seconds each) whose sum is kept up to date
+#   tumbling: the vehicles of the current period of `tumbling` seconds, and of the
+#            previous one once it is closed
+# Counting is O(1): buckets are only expired when time moves forward. The state can
+# be saved to a file and loaded again, so the counts survive a restart.
+# Every thread counts in its own shard, whose lock is only contended while a snapshot
+# is taken: the workers never wait for each other. Snapshots lock all the shards at
+# once, copy them and merge the copies after releasing them.
+
+import os
+import json
+import time
+import threading
+
+
+class SlidingCounter:
+
+    def __init__(self, size):
+        self.size = size
+        self.buckets = [0] * size
+        self.head = 0  # absolute index of the latest bucket
+        self.total = 0  # sum of the buckets
+
+    # expire the buckets that fall out of the window
+    def advance(self, bucket):
+        steps = bucket - self.head
+        if steps <= 0:
+            return
+        if steps >= self.size:
+            self.buckets = [0] * self.size
+            self.total = 0
+        else:
+            for i in range(self.head + 1, bucket + 1):
+                index = i % self.size
+                self.total -= self.buckets[index]
+                self.buckets[index] = 0
+        self.head = bucket
+
+    def add(self, bucket, count=1):
+        self.advance(bucket)
+        if bucket <= self.head - self.size:
+            return  # older than the window
+        self.buckets[bucket % self.size] += count
+        self.total += count
+
+    def value(self, bucket):
+        self.advance(bucket)
+        return self.total
+
+
+class TumblingCounter:
+
+    def __init__(self):
+        self.period = 0
+        self.count = 0
+        self.previous = 0  # count of the last closed period
+
+    def advance(self, period):
+        if period > self.period:
+            self.previous = self.count if period == self.period + 1 else 0
+            self.count = 0
+            self.period = period
+
+    def add(self, period, count=1):
+        self.advance(period)
+        if period == self.period:
+            self.count += count
+
+
+class WindowCounts:
+
+    def __init__(self, size):
+        self.total = 0
+        self.sliding = SlidingCounter(size)
+        self.tumbling = TumblingCounter()
+
+
+# counts and latest events of one thread
+class Shard:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}  # (camera, class, direction) -> WindowCounts
+        self.latest = {}  # camera -> (time, event)
+        self.events = 0
+
+
+class CountingEngine:
+
+    def __init__(self, sliding=300, tumbling=60, resolution=1):
+        self.resolution = float(resolution)
+        self.size = max(1, int(round(sliding / self.resolution)))  # buckets of the sliding window
+        self.sliding = self.size * self.resolution
+        self.tumbling = tumbling
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()  # only taken to add a shard
+
+    # shard of the calling thread
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.addShard()
+            self.local.shard = shard
+        return shard
+
+    def addShard(self):
+        shard = Shard()
+        with self.lock:
+            self.shards.append(shard)
+        return shard
+
+    def count(self, camera, vehicleClass, direction, count=1, now=None):
+        now = time.time() if now is None else now
+        key = (camera, vehicleClass, direction)
+        shard = self.shard()
+        with shard.lock:
+            counts = shard.counts.get(key)
+            if counts is None:
+                counts = shard.counts[key] = WindowCounts(self.size)
+            counts.total += count
+            counts.sliding.add(int(now / self.resolution), count)
+            counts.tumbling.add(int(now / self.tumbling), count)
+            shard.events += 1
+
+    # keep the latest event of a camera, published with its counts
+    def update(self, camera, event, now=None):
+        now = time.time() if now is None else now
+        shard = self.shard()
+        with shard.lock:
+            shard.latest[camera] = (now, event)
+
+    # call fn with every shard, all of them locked
+    def frozen(self, fn):
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            shard.lock.acquire()
+        try:
+            return [fn(shard) for shard in shards]
+        finally:
+            for shard in shards:
+                shard.lock.release()
+
+    # consistent view of the counts and latest events:
+    # ({camera: [{class, direction, total, sliding, tumbling, previous}]}, {camera: event})
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        (bucket, period) = (int(now / self.resolution), int(now / self.tumbling))
+
+        def copy(shard):
+            rows = []
+            for (key, counts) in shard.counts.items():
+                counts.tumbling.advance(period)
+                rows.append((key, counts.total, counts.sliding.value(bucket), counts.tumbling.count,
+                             counts.tumbling.previous))
+            return (rows, list(shard.latest.items()))
+        copies = self.frozen(copy)
+
+        # merged once the shards are released
+        merged = {}
+        latest = {}
+        for (rows, events) in copies:
+            for (key, total, sliding, tumbling, previous) in rows:
+                row = merged.get(key)
+                if row is None:
+                    row = merged[key] = {'class': key[1], 'direction': key[2], 'total': 0, 'sliding': 0,
+                                         'tumbling': 0, 'previous': 0}
+                row['total'] += total
+                row['sliding'] += sliding
+                row['tumbling'] += tumbling
+                row['previous'] += previous
+            for (camera, (when, event)) in events:
+                if camera not in latest or latest[camera][0] < when:
+                    latest[camera] = (when, event)
+
+        cameras = {}
+        for (key, row) in merged.items():
+            cameras.setdefault(key[0], []).append(row)
+        for rows in cameras.values():
+            rows.sort(key=lambda row: (row['class'], row['direction']))
+        return (cameras, dict((camera, event) for (camera, (when, event)) in latest.items()))
+
+    def stats(self):
+        counts = self.frozen(lambda shard: (shard.events, list(shard.counts)))
+        keys = set()
+        for (events, shardKeys) in counts:
+            keys.update(shardKeys)
+        return {'events': sum(events for (events, shardKeys) in counts), 'keys': len(keys),
+                'shards': len(counts), 'sliding': self.sliding, 'tumbling': self.tumbling,
+                'resolution': self.resolution}
+
+    # the counts of the shards merged, their windows aligned on now
+    def save(self, path, now=None):
+        now = time.time() if now is None else now
+        (bucket, period) = (int(now / self.resolution), int(now / self.tumbling))
+
+        def copy(shard):
+            rows = []
+            for (key, counts) in shard.counts.items():
+                counts.sliding.advance(bucket)
+                counts.tumbling.advance(period)
+                rows.append((key, counts.total, counts.sliding.head, list(counts.sliding.buckets),
+                             counts.tumbling.period, counts.tumbling.count, counts.tumbling.previous))
+            return rows
+        merged = {}
+        for rows in self.frozen(copy):
+            for (key, total, head, buckets, tumblingPeriod, count, previous) in rows:
+                item = merged.get(key)
+                if item is None:
+                    merged[key] = {'key': list(key), 'total': total, 'sliding': [head, buckets],
+                                   'tumbling': [tumblingPeriod, count, previous]}
+                    continue
+                item['total'] += total
+                item['sliding'][1] = [a + b for (a, b) in zip(item['sliding'][1], buckets)]
+                item['tumbling'][1] += count
+                item['tumbling'][2] += previous
+        state = {'resolution': self.resolution, 'size': self.size, 'tumbling': self.tumbling,
+                 'counts': list(merged.values())}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        # replaced at once, a crash never leaves a partial file
+        os.rename(path + '.tmp', path)
+
+    # the counts of the file in a shard of their own
+    def load(self, path):
+        with open(path) as f:
+            state = json.load(f)
+        # the windows are only restored with the same configuration
+        sameWindows = (state['resolution'] == self.resolution and state['size'] == self.size
+                       and state['tumbling'] == self.tumbling)
+        shard = self.addShard()
+        with shard.lock:
+            for item in state['counts']:
+                counts = WindowCounts(self.size)
+                counts.total = item['total']
+                if sameWindows:
+                    (counts.sliding.head, counts.sliding.buckets) = item['sliding']
+                    counts.sliding.total = sum(counts.sliding.buckets)
+                    (counts.tumbling.period, counts.tumbling.count, counts.tumbling.previous) = item['tumbling']
+                shard.counts[tuple(item['key'])] = counts
+        return len(state['counts'])
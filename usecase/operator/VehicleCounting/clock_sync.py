@@ -0,0 +1,129 @@
+# Clock of the timestamp server, estimated locally. A background thread exchanges
+# with the server every `interval` seconds, NTP-like: the server time is taken
+# halfway between the local send and receive times, and of `samples` exchanges the
+# one with the shortest round trip is kept. The offset between the local monotonic
+# clock and the server clock is fitted over the last `history` syncs, so its drift
+# is followed between two syncs. Reading the server time is then a local computation,
+# with its error bound: half the round trip of the sync, plus what the drift
+# estimate may be off since.
+# Configured with the timestampServer and clockInterval environment variables.
+
+import time
+import datetime
+import threading
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+# monotonic clock, the wall clock on python 2 (no time.monotonic)
+monotonic = getattr(time, 'monotonic', time.time)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+DATETIME_FORMAT = '%Y-%m-%d_%H-%M-%S-%f'
+MAX_DRIFT = 500e-6  # larger drifts are estimation noise
+DRIFT_ERROR = 50e-6  # uncertainty of the drift, grows the error bound between syncs
+
+
+# seconds of a naive datetime of the server, timezone-free so both ends agree
+def toSeconds(dt):
+    return (dt - EPOCH).total_seconds()
+
+
+def toDatetime(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+class ClockSync(threading.Thread):
+
+    def __init__(self, url, interval=30, samples=4, history=8, timeout=2):
+        threading.Thread.__init__(self, name='clock-sync')
+        self.daemon = True
+        self.url = url
+        self.interval = interval
+        self.samples = max(1, int(samples))
+        self.history = max(2, int(history))
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.syncs = []  # (local time, offset, round trip) of the recent syncs
+        self.reference = None  # (local time, offset, error) the estimate starts from
+        self.drift = 0.0
+
+        # counters
+        self.exchanges = 0
+        self.failures = 0
+
+    # one exchange with the server: (local time, offset, round trip)
+    def exchange(self):
+        t0 = monotonic()
+        response = urlopen(self.url, timeout=self.timeout)
+        body = response.read()
+        t1 = monotonic()
+        try:
+            server = datetime.datetime.strptime(body.decode('utf-8').strip(), DATETIME_FORMAT)
+        except ValueError:
+            server = datetime.datetime.strptime(response.info()['timestamp'], '%Y-%m-%d %H:%M:%S.%f')
+        middle = (t0 + t1) / 2.0
+        return (middle, toSeconds(server) - middle, t1 - t0)
+
+    def sync(self):
+        best = None
+        for i in range(self.samples):
+            try:
+                sample = self.exchange()
+            except Exception as e:
+                self.failures += 1
+                print('failed to reach the timestamp server: ' + str(e))
+                continue
+            self.exchanges += 1
+            if best is None or sample[2] < best[2]:
+                best = sample
+        if best is None:
+            return False
+
+        self.syncs = (self.syncs + [best])[-self.history:]
+        drift = 0.0
+        if len(self.syncs) >= 2:
+            # least squares slope of the offset over the local time
+            n = float(len(self.syncs))
+            meanT = sum(s[0] for s in self.syncs) / n
+            meanO = sum(s[1] for s in self.syncs) / n
+            var = sum((s[0] - meanT) ** 2 for s in self.syncs)
+            if var > 0:
+                drift = sum((s[0] - meanT) * (s[1] - meanO) for s in self.syncs) / var
+                drift = max(-MAX_DRIFT, min(MAX_DRIFT, drift))
+        with self.lock:
+            self.reference = (best[0], best[1], best[2] / 2.0)
+            self.drift = drift
+        return True
+
+    # (server time in seconds, error bound), (None, None) before the first sync
+    def now(self):
+        with self.lock:
+            (reference, drift) = (self.reference, self.drift)
+        if reference is None:
+            return (None, None)
+        (t, offset, error) = reference
+        local = monotonic()
+        elapsed = local - t
+        return (local + offset + drift * elapsed, error + DRIFT_ERROR * abs(elapsed))
+
+    def close(self):
+        self.event.set()
+
+    def run(self):
+        while True:
+            synced = self.sync()
+            # retried sooner until the server answers
+            if self.event.wait(self.interval if synced or self.reference is not None else min(5, self.interval)):
+                break
+
+    def stats(self):
+        with self.lock:
+            (reference, drift) = (self.reference, self.drift)
+        (now, error) = self.now()
+        return {'synced': reference is not None, 'syncs': len(self.syncs), 'exchanges': self.exchanges,
+                'failures': self.failures, 'offset': round(reference[1], 6) if reference else None,
+                'drift_ppm': round(drift * 1e6, 3), 'error': round(error, 6) if error is not None else None}
@@ -3,8 +3,10 @@ import json
 import os
 import threading
 import time
-import requests
-import urllib
+import ngsi
+from aggregation import CountingEngine
+from clock_sync import ClockSync, toDatetime
+from work_queue import WorkQueue
 from flask import Flask, abort, jsonify, make_response, request
 
 
@@ -14,10 +16,15 @@ app = Flask(__name__, static_url_path="")
 brokerURL = ''
 outputs = []
 timer = None
-lock = threading.Lock()
+workQueue = None
 
-carCounter = 0
-motorbikeCounter = 0
+# vehicle counts, see aggregation.py; published every publishInterval seconds
+engine = CountingEngine()
+publishInterval = 5.0
+stateFile = ''
+published = {}  # camera -> counts last published
+publications = 0
+clock = None  # clock of the timestamp server, see clock_sync.py
 
 
 @app.errorhandler(400)
@@ -45,18 +52,35 @@ def admin():
 def notifyContext():
    # print '=============notify============='
 
-    if not request.json:
+    # decoded with the fastest JSON backend, the attributes when they are used (see ngsi.py)
+    try:
+        objs = ngsi.readContextElements(request.get_data())
+    except (ValueError, KeyError, TypeError):
         abort(400)
 
-    objs = readContextElements(request.json)
-
     # print(objs)
 
-    handleNotify(objs)
+    # acknowledged right away, the entities are processed by the workers
+    if workQueue is None:
+        handleNotify(objs)
+    elif not workQueue.submit(objs):
+        return make_response(jsonify({'responseCode': 503}), 503)
 
     return jsonify({'responseCode': 200})
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    stats = {}
+    if workQueue is not None:
+        stats['queue'] = workQueue.stats()
+    stats['engine'] = engine.stats()
+    stats['engine']['publications'] = publications
+    if clock is not None:
+        stats['clock'] = clock.stats()
+    return jsonify(stats)
+
+
 def signal_handler(signal, frame):
     print('Signal to stop this process!')
     # delete my registration and context entity
@@ -64,61 +88,6 @@ def signal_handler(signal, frame):
     sys.exit(0)
 
 
-def element2Object(element):
-    ctxObj = {}
-
-    ctxObj['entityId'] = element['entityId']
-
-    ctxObj['attributes'] = {}
-    if 'attributes' in element:
-        for attr in element['attributes']:
-            ctxObj['attributes'][attr['name']] = {
-                'type': attr['type'], 'value': attr['value']}
-
-    ctxObj['metadata'] = {}
-    if 'domainMetadata' in element:
-        for meta in element['domainMetadata']:
-            ctxObj['metadata'][meta['name']] = {
-                'type': meta['type'], 'value': meta['value']}
-
-    return ctxObj
-
-
-def object2Element(ctxObj):
-    ctxElement = {}
-
-    ctxElement['entityId'] = ctxObj['entityId']
-
-    ctxElement['attributes'] = []
-    if 'attributes' in ctxObj:
-        for key in ctxObj['attributes']:
-            attr = ctxObj['attributes'][key]
-            ctxElement['attributes'].append(
-                {'name': key, 'type': attr['type'], 'value': attr['value']})
-
-    ctxElement['domainMetadata'] = []
-    if 'metadata' in ctxObj:
-        for key in ctxObj['metadata']:
-            meta = ctxObj['metadata'][key]
-            ctxElement['domainMetadata'].append(
-                {'name': key, 'type': meta['type'], 'value': meta['value']})
-
-    return ctxElement
-
-
-def readContextElements(data):
-    #print (data)
-
-    ctxObjects = []
-
-    for response in data['contextResponses']:
-        if response['statusCode']['code'] == 200:
-            ctxObj = element2Object(response['contextElement'])
-            ctxObjects.append(ctxObj)
-
-    return ctxObjects
-
-
 def handleNotify(contextObjs):
     for ctxObj in contextObjs:
         #entityId = ctxObj['entityId']
@@ -128,75 +97,110 @@ def handleNotify(contextObjs):
 
 def processInputStreamData(obj):
     print('===============Receive a Context Entity====================')
-    print(json.dumps(obj, indent=4))
-
-    global carCounter
-    global motorbikeCounter
-
-    resultCtxObj = {}
-    resultCtxObj['entityId'] = {}
-    resultCtxObj['entityId']['id'] = "Stream.VehicleCounting." + \
-        str(obj['entityId']['id']).split('.')[-1]
-    resultCtxObj['entityId']['type'] = "VehicleCounting"
-    resultCtxObj['entityId']['isPattern'] = False
-
-    if str(obj['attributes']['class']['value']) == "car":
-        carCounter = carCounter + 1
-        print('carCounter = ' + str(carCounter))
-
-    if str(obj['attributes']['class']['value']) == "motorbike":
-        motorbikeCounter = motorbikeCounter + 1
-        print('motorbikeCounter = ' + str(motorbikeCounter))
+    print(json.dumps(obj.toObject(), indent=4))
 
-    resultCtxObj['attributes'] = {}
-    resultCtxObj['attributes']['cars'] = {
-        'type': 'integer', 'value': str(carCounter)}
-    resultCtxObj['attributes']['motorbikes'] = {
-        'type': 'integer', 'value': str(motorbikeCounter)}
-    resultCtxObj['attributes']['timestamp'] = obj['attributes']['timestamp']
-    resultCtxObj['attributes']['direction'] = obj['attributes']['direction']
-    resultCtxObj['attributes']['url'] = obj['attributes']['url']
-    resultCtxObj['metadata'] = {}
-    resultCtxObj['metadata'] = obj['metadata']
+    camera = cameraID(obj)
+    direction = str(obj['attributes']['direction']['value'])
 
-    url = "http://10.7.162.10:8090/timestamp"
+    # every vehicle detected in the frame, only its top detection for the
+    # detectors that do not publish the vehicles
+    vehicles = obj.value('vehicles')
+    if vehicles is None:
+        classes = [str(obj['attributes']['class']['value'])]
+    else:
+        classes = [str(vehicle['class']) for vehicle in vehicles]
+    for vehicleClass in set(classes):
+        engine.count(camera, vehicleClass, direction, classes.count(vehicleClass))
 
     # Data format from VehicleType Entity %Y-%m-%d_%H-%M-%S-%f
-                    
     datetimeFormat = '%Y-%m-%d_%H-%M-%S-%f'
-    #print("TODO ATRIBUTO", obj['attributes'])
-    #initial_timestamp = datetime.datetime.strptime(obj['attributes']['timestamp'], datetimeFormat)
 
     timestamp = obj['attributes']['timestamp']
-    #print('Full timestamp')
-    #print(timestamp)
-    #print(type(timestamp))
-
     initial_timestamp = datetime.datetime.strptime(timestamp['value'], datetimeFormat)
-    #print('Initial timestamp')
-    #print(initial_timestamp)
-    #print(type(initial_timestamp))
 
-    actual_timetamp = getTimestamp(url)
-    actual_timetamp = datetime.datetime.strptime(actual_timetamp, datetimeFormat)
-    #print('Server timestamp')
-    #print(actual_timetamp)
-    #print(type(actual_timetamp))
+    # time of the timestamp server estimated locally, no request on the way (see
+    # clock_sync.py); the local clock until the first sync
+    (now, error) = clock.now() if clock is not None else (None, None)
+    actual_timetamp = toDatetime(now) if now is not None else datetime.datetime.now()
 
     processing_time = actual_timetamp - initial_timestamp
 
-    resultCtxObj['attributes']['processing_time'] = {
+    # the latest event of the camera, published with its counts
+    event = {}
+    event['timestamp'] = obj['attributes']['timestamp']
+    event['direction'] = obj['attributes']['direction']
+    event['url'] = obj['attributes']['url']
+    event['processing_time'] = {
         'type': 'string', 'value': str(processing_time.seconds) + 's:' + str(processing_time.microseconds)}
-    #print(str(processing_time.seconds) + 's:' + str(processing_time.microseconds))
-    with lock:
-        updateContext(resultCtxObj)
-
+    event['processing_time_error'] = {'type': 'float', 'value': round(error, 6) if error is not None else None}
+    event['metadata'] = obj['metadata']
+    engine.update(camera, event)
+
+
+# camera of an entity, from its metadata or the end of its id
+def cameraID(obj):
+    cameraID = obj['metadata'].get('cameraID')
+    if cameraID is not None:
+        return str(cameraID['value'])
+    return str(obj['entityId']['id']).split('.')[-1]
+
+
+def handleTimer():
+    global timer
+    # publish the counts and schedule the next publication
+    timer = threading.Timer(publishInterval, handleTimer)
+    timer.daemon = True
+    timer.start()
+    try:
+        publishCounts()
+    except Exception as e:
+        print('failed to publish the counts: ' + str(e))
+
+
+# publish the counts of the cameras that changed since the last publication, all in
+# one update, instead of one update per vehicle
+def publishCounts():
+    global publications
+    # consistent view of the counts, published without holding any lock
+    (snapshot, events) = engine.snapshot()
+
+    ctxObjs = []
+    for camera in sorted(snapshot):
+        counts = snapshot[camera]
+        if published.get(camera) == counts:
+            continue
+        published[camera] = counts
+        ctxObjs.append(countingObject(camera, counts, events.get(camera)))
+    if len(ctxObjs) > 0:
+        updateContext(ctxObjs)
+        publications += 1
+    if stateFile:
+        engine.save(stateFile)
+
+
+def countingObject(camera, counts, event):
+    resultCtxObj = {}
+    resultCtxObj['entityId'] = {}
+    resultCtxObj['entityId']['id'] = "Stream.VehicleCounting." + camera
+    resultCtxObj['entityId']['type'] = "VehicleCounting"
+    resultCtxObj['entityId']['isPattern'] = False
 
-def getTimestamp(url):
-    #print('===============Fetching Timestamp====================')
-    resp = urllib.urlopen(url)
-    data = resp.info()
-    return str(data['timestamp'])
+    resultCtxObj['attributes'] = {}
+    resultCtxObj['attributes']['cars'] = {
+        'type': 'integer', 'value': str(sum(row['total'] for row in counts if row['class'] == "car"))}
+    resultCtxObj['attributes']['motorbikes'] = {
+        'type': 'integer', 'value': str(sum(row['total'] for row in counts if row['class'] == "motorbike"))}
+    # by class and direction: total, vehicles of the sliding window, of the current
+    # tumbling window and of the previous one
+    resultCtxObj['attributes']['counts'] = {'type': 'array', 'value': counts}
+    resultCtxObj['attributes']['windows'] = {
+        'type': 'object', 'value': {'sliding': engine.sliding, 'tumbling': engine.tumbling}}
+    resultCtxObj['metadata'] = {}
+    if event is not None:
+        for name in ('timestamp', 'direction', 'url', 'processing_time', 'processing_time_error'):
+            resultCtxObj['attributes'][name] = event[name]
+        resultCtxObj['metadata'] = event['metadata']
+    return resultCtxObj
 
 
 def handleConfig(configurations):
@@ -222,34 +226,25 @@ def publishResult(result):
         'type': 'integer', 'value': result['counter']}
 
     # publish the real time results as context updates
-    updateContext(resultCtxObj)
+    updateContext([resultCtxObj])
 
 
-def updateContext(ctxObj):
+# publish context objects in one update
+def updateContext(ctxObjs):
     print('===============Update Context Entity====================')
-    print(json.dumps(ctxObj, indent=4))
+    for ctxObj in ctxObjs:
+        print(json.dumps(ctxObj, indent=4))
     global brokerURL
     if brokerURL == '':
         return
 
-    ctxElement = object2Element(ctxObj)
-
-    updateCtxReq = {}
-    updateCtxReq['updateAction'] = 'UPDATE'
-    updateCtxReq['contextElements'] = []
-    updateCtxReq['contextElements'].append(ctxElement)
-
-    headers = {'Accept': 'application/json',
-               'Content-Type': 'application/json'}
-    response = requests.post(brokerURL + '/updateContext',
-                             data=json.dumps(updateCtxReq), headers=headers)
+    response = ngsi.updateContext(brokerURL, ctxObjs)
     if response.status_code != 200:
         print('failed to update context')
         print response.text
 
 
 if __name__ == '__main__':
-    # handleTimer()
     # https://able.bio/rhett/how-to-set-and-get-environment-variables-in-python--274rgt5
     # acredito que as variaveis de ambiente serao criadas/passadas pelo work
     myport = int(os.environ['myport'])
@@ -258,6 +253,24 @@ if __name__ == '__main__':
     adminCfg = json.loads(myCfg)
     handleConfig(adminCfg)
 
+    # windows of the counts, and the file they are kept in across restarts
+    engine = CountingEngine(float(os.environ.get('windowSliding', '300')),
+                            float(os.environ.get('windowTumbling', '60')),
+                            float(os.environ.get('windowResolution', '1')))
+    publishInterval = float(os.environ.get('publishInterval', publishInterval))
+    stateFile = os.environ.get('stateFile', '')
+    if stateFile and os.path.exists(stateFile):
+        print('counts restored: ' + str(engine.load(stateFile)))
+    handleTimer()
+
+    clock = ClockSync(os.environ.get('timestampServer', "http://10.7.162.10:8090/timestamp"),
+                      float(os.environ.get('clockInterval', '30')))
+    clock.start()
+
+    # notifications processed by a pool of workers, see work_queue.py
+    workQueue = WorkQueue(handleNotify, int(os.environ.get('workers', '2')),
+                          int(os.environ.get('queueSize', '64')))
+
     app.run(host='0.0.0.0', port=myport)
 
     timer.cancel()
@@ -0,0 +1,194 @@
+# NGSI codec shared by the device scripts and the operators: conversion between the
+# context objects ({'entityId', 'attributes': {name: {type, value}}, 'metadata'}) and
+# the NGSI context elements (attributes and domainMetadata as lists), notifications,
+# and the /updateContext requests sent to the broker.
+# JSON goes through the fastest backend installed, orjson or ujson, the json module
+# otherwise; NGSI_JSON=json (or ujson) in the environment forces one. Notifications
+# are decoded into ContextEntity objects whose attributes are only converted when
+# they are used, a single value is read straight from the element.
+
+import os
+import json
+import requests
+
+HEADERS = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+MARKER = '\x00ngsi-%d\x00'  # placeholder of a changing value, cannot be in a profile
+
+BACKENDS = {}
+try:
+    import orjson
+    BACKENDS['orjson'] = (orjson.loads, lambda obj: orjson.dumps(obj).decode('utf-8'))
+except ImportError:
+    pass
+try:
+    import ujson
+    BACKENDS['ujson'] = (ujson.loads, lambda obj: ujson.dumps(obj, escape_forward_slashes=False))
+except ImportError:
+    pass
+BACKENDS['json'] = (json.loads, json.dumps)
+
+backend = None
+_loads = json.loads
+_dumps = json.dumps
+
+
+# select the JSON backend, the fastest installed by default
+def setBackend(name=None):
+    global backend, _loads, _dumps
+    if name is None:
+        name = [b for b in ('orjson', 'ujson', 'json') if b in BACKENDS][0]
+    (_loads, _dumps) = BACKENDS[name]
+    backend = name
+    return name
+
+
+setBackend(os.environ.get('NGSI_JSON') if os.environ.get('NGSI_JSON') in BACKENDS else None)
+
+
+def loads(data):
+    return _loads(data)
+
+
+# values the backend cannot encode (numpy scalars, subclasses) go through the json module
+def dumps(obj):
+    try:
+        return _dumps(obj)
+    except (TypeError, OverflowError):
+        return json.dumps(obj)
+
+
+# {name: {type, value}} of a list of attributes or metadata
+def decodeItems(items):
+    return dict((item['name'], {'type': item['type'], 'value': item['value']}) for item in items or ())
+
+
+# list of attributes or metadata of a {name: {type, value}} dict
+def encodeItems(items):
+    return [{'name': name, 'type': item['type'], 'value': item['value']} for (name, item) in items.items()]
+
+
+def element2Object(element):
+    return {'entityId': element['entityId'], 'attributes': decodeItems(element.get('attributes')),
+            'metadata': decodeItems(element.get('domainMetadata'))}
+
+
+def object2Element(ctxObj):
+    return {'entityId': ctxObj['entityId'], 'attributes': encodeItems(ctxObj.get('attributes') or {}),
+            'domainMetadata': encodeItems(ctxObj.get('metadata') or {})}
+
+
+# context entity of a notification, read like the dict of element2Object
+# (obj['attributes']['url']['value']) but converted only when it is used
+class ContextEntity(object):
+    __slots__ = ('element', '_attributes', '_metadata')
+
+    def __init__(self, element):
+        self.element = element
+        self._attributes = None
+        self._metadata = None
+
+    @property
+    def entityId(self):
+        return self.element['entityId']
+
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = decodeItems(self.element.get('attributes'))
+        return self._attributes
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = decodeItems(self.element.get('domainMetadata'))
+        return self._metadata
+
+    # value of an attribute, without converting the others
+    def value(self, name, default=None):
+        if self._attributes is not None:
+            attr = self._attributes.get(name)
+            return attr['value'] if attr is not None else default
+        for attr in self.element.get('attributes') or ():
+            if attr['name'] == name:
+                return attr['value']
+        return default
+
+    def __getitem__(self, key):
+        if key == 'entityId':
+            return self.entityId
+        if key == 'attributes':
+            return self.attributes
+        if key == 'metadata':
+            return self.metadata
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ('entityId', 'attributes', 'metadata')
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def toObject(self):
+        return {'entityId': self.entityId, 'attributes': self.attributes, 'metadata': self.metadata}
+
+
+# context entities of a notification, the body as received or already decoded
+def readContextElements(data):
+    if not isinstance(data, dict):
+        data = loads(data)
+    return [ContextEntity(response['contextElement']) for response in data['contextResponses']
+            if response['statusCode']['code'] == 200]
+
+
+# /updateContext request of context elements, dicts or already encoded by a template
+def encodeRequest(action, ctxElements):
+    elements = [dumps(e) if isinstance(e, dict) else e for e in ctxElements]
+    return '{"updateAction": ' + dumps(action) + ', "contextElements": [' + ', '.join(elements) + ']}'
+
+
+# send context objects (or encoded elements) to a broker, returns the response
+def updateContext(brokerURL, ctxObjs, action='UPDATE', session=None, timeout=None):
+    data = encodeRequest(action, [object2Element(o) if isinstance(o, dict) else o for o in ctxObjs])
+    return (session or requests).post(brokerURL + '/updateContext', data=data, headers=HEADERS, timeout=timeout)
+
+
+def deleteContext(brokerURL, ctxObjs, session=None, timeout=None):
+    return updateContext(brokerURL, ctxObjs, 'DELETE', session, timeout)
+
+
+# Context element of an entity whose attributes are mostly constant: the element is
+# serialized once, and only the values of the changing attributes are encoded per update
+class EntityTemplate:
+
+    # ctxObj: the entity with its constant attributes and metadata
+    # dynamic: [(name, type)] of the changing attributes, their values are given to encode
+    def __init__(self, ctxObj, dynamic):
+        attributes = dict(ctxObj.get('attributes', {}))
+        for (i, (name, type)) in enumerate(dynamic):
+            attributes[name] = {'type': type, 'value': MARKER % i}
+        ctxObj = dict(ctxObj)
+        ctxObj['attributes'] = attributes
+
+        # the serialized element, split around the changing values; the attributes are
+        # not necessarily serialized in the order of dynamic
+        text = dumps(object2Element(ctxObj))
+        markers = sorted((text.index(dumps(MARKER % i)), i) for i in range(len(dynamic)))
+        self.parts = []
+        self.order = []  # index of the value of each slot
+        start = 0
+        for (position, i) in markers:
+            self.parts.append(text[start:position])
+            self.order.append(i)
+            start = position + len(dumps(MARKER % i))
+        self.parts.append(text[start:])
+        self.names = [name for (name, type) in dynamic]
+
+    # the encoded context element, with the values of the changing attributes in order
+    def encode(self, *values):
+        if len(values) != len(self.names):
+            raise ValueError('expected values of ' + ', '.join(self.names))
+        chunks = [self.parts[0]]
+        for (i, part) in zip(self.order, self.parts[1:]):
+            chunks.append(dumps(values[i]))
+            chunks.append(part)
+        return ''.join(chunks)
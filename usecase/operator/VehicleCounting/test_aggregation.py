@@ -0,0 +1,133 @@
+# Tests of the windowed counts of the vehicles (see aggregation.py).
+# Usage: python -m pytest test_aggregation.py
+
+import threading
+from aggregation import SlidingCounter, TumblingCounter, CountingEngine
+
+T0 = 1000000.0  # a time on a bucket and period boundary
+
+
+def test_sliding_window_boundaries():
+    counter = SlidingCounter(10)
+    counter.add(100)
+    counter.add(105, 2)
+    # the last bucket of the window still holds the oldest count
+    assert counter.value(109) == 3
+    assert counter.value(110) == 2
+    assert counter.value(114) == 2
+    assert counter.value(115) == 0
+
+
+def test_sliding_window_ring_wraps():
+    counter = SlidingCounter(3)
+    for bucket in range(10):
+        counter.add(bucket)
+        assert counter.value(bucket) == min(bucket + 1, 3)
+    assert sorted(counter.buckets) == [1, 1, 1]
+
+
+def test_sliding_window_jumps_and_late_counts():
+    counter = SlidingCounter(10)
+    counter.add(100, 5)
+    # a jump of the whole window clears it
+    assert counter.value(200) == 0
+    counter.add(195)
+    # older than the window
+    counter.add(190)
+    assert counter.value(200) == 1
+    # time going backwards does not expire anything
+    assert counter.value(150) == 1
+
+
+def test_tumbling_periods():
+    counter = TumblingCounter()
+    counter.add(10, 2)
+    counter.add(10)
+    assert (counter.period, counter.count, counter.previous) == (10, 3, 0)
+    counter.add(11)
+    assert (counter.count, counter.previous) == (1, 3)
+    # late count of a closed period
+    counter.add(10)
+    assert (counter.count, counter.previous) == (1, 3)
+    # a period without counts in between
+    counter.advance(13)
+    assert (counter.count, counter.previous) == (0, 0)
+
+
+def test_engine_snapshot():
+    engine = CountingEngine(sliding=10, tumbling=5, resolution=1)
+    engine.count('cam-1', 'car', 'Up', now=T0)
+    engine.count('cam-1', 'bus', 'Down', 2, now=T0 + 1)
+    engine.count('cam-1', 'car', 'Up', now=T0 + 6)
+    engine.count('cam-2', 'car', 'Down', now=T0 + 9)
+    engine.update('cam-1', {'direction': 'Up'}, now=T0 + 6)
+
+    (counts, events) = engine.snapshot(now=T0 + 9.5)
+    assert counts['cam-1'] == [
+        {'class': 'bus', 'direction': 'Down', 'total': 2, 'sliding': 2, 'tumbling': 0, 'previous': 2},
+        {'class': 'car', 'direction': 'Up', 'total': 2, 'sliding': 2, 'tumbling': 1, 'previous': 1}]
+    assert counts['cam-2'][0]['sliding'] == 1
+    assert events == {'cam-1': {'direction': 'Up'}}
+
+    # the first counts leave the sliding window, the totals stay
+    (counts, events) = engine.snapshot(now=T0 + 10)
+    assert [(row['total'], row['sliding']) for row in counts['cam-1']] == [(2, 2), (2, 1)]
+    (counts, events) = engine.snapshot(now=T0 + 15)
+    assert [(row['total'], row['sliding'], row['tumbling'], row['previous']) for row in counts['cam-1']] == [
+        (2, 0, 0, 0), (2, 1, 0, 0)]
+    (counts, events) = engine.snapshot(now=T0 + 16)
+    assert [(row['total'], row['sliding']) for row in counts['cam-1']] == [(2, 0), (2, 0)]
+    assert engine.stats()['events'] == 4 and engine.stats()['keys'] == 3
+
+
+def test_engine_shards_merged():
+    engine = CountingEngine(sliding=60, tumbling=60, resolution=1)
+
+    def count(i):
+        for k in range(1000):
+            engine.count('cam', 'car', 'Up', now=T0 + k % 30)
+        engine.update('cam', {'worker': i}, now=T0 + i)
+
+    threads = [threading.Thread(target=count, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    (counts, events) = engine.snapshot(now=T0 + 30)
+    assert counts['cam'][0]['total'] == 4000 and counts['cam'][0]['sliding'] == 4000
+    # the latest event of all the shards
+    assert events == {'cam': {'worker': 3}}
+    assert engine.stats()['shards'] == 4 and engine.stats()['events'] == 4000
+
+
+def test_save_and_load(tmpdir):
+    path = str(tmpdir.join('counts.json'))
+    engine = CountingEngine(sliding=10, tumbling=5, resolution=1)
+    thread = threading.Thread(target=engine.count, args=('cam', 'car', 'Up'), kwargs={'now': T0 + 1})
+    thread.start()
+    thread.join()
+    engine.count('cam', 'car', 'Up', now=T0 + 3)
+    engine.count('cam', 'car', 'Up', 2, now=T0 + 7)
+    engine.save(path, now=T0 + 8)
+
+    restored = CountingEngine(sliding=10, tumbling=5, resolution=1)
+    assert restored.load(path) == 1
+    for now in (T0 + 8, T0 + 12, T0 + 20):
+        assert restored.snapshot(now=now)[0] == engine.snapshot(now=now)[0]
+    # counted on top of the restored counts
+    restored.count('cam', 'car', 'Up', now=T0 + 20)
+    assert restored.snapshot(now=T0 + 20)[0]['cam'][0]['total'] == 5
+
+
+def test_load_with_other_windows(tmpdir):
+    path = str(tmpdir.join('counts.json'))
+    engine = CountingEngine(sliding=10, tumbling=5, resolution=1)
+    engine.count('cam', 'car', 'Up', 3, now=T0)
+    engine.save(path, now=T0)
+
+    # only the totals survive a change of the windows
+    restored = CountingEngine(sliding=20, tumbling=5, resolution=1)
+    restored.load(path)
+    row = restored.snapshot(now=T0)[0]['cam'][0]
+    assert (row['total'], row['sliding'], row['tumbling']) == (3, 0, 0)
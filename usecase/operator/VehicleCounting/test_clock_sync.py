@@ -0,0 +1,127 @@
+# Tests of the local estimate of the timestamp server clock (see clock_sync.py), with a
+# fake local clock and exchanges, and against a server served locally.
+# Usage: python -m pytest test_clock_sync.py
+
+import datetime
+import threading
+import pytest
+import clock_sync
+from clock_sync import ClockSync, toSeconds, toDatetime, MAX_DRIFT, DRIFT_ERROR
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+# a clock syncing with the (local time, offset, round trip) samples given, or the
+# exceptions raised instead
+class ScriptedClock(ClockSync):
+
+    def __init__(self, script, **kwargs):
+        ClockSync.__init__(self, 'http://127.0.0.1:1/timestamp', **kwargs)
+        self.script = list(script)
+
+    def exchange(self):
+        sample = self.script.pop(0)
+        if isinstance(sample, Exception):
+            raise sample
+        return sample
+
+
+@pytest.fixture
+def local(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(clock_sync, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_shortest_round_trip_kept(local):
+    clock = ScriptedClock([(10.0, 5.0, 0.08), (10.1, 5.02, 0.01), (10.2, 4.9, 0.2)], samples=3)
+    assert clock.now() == (None, None)
+    assert clock.sync()
+    assert clock.reference == (10.1, 5.02, 0.005)
+    local[0] = 10.1
+    assert clock.now() == pytest.approx((15.12, 0.005))
+
+
+def test_drift_followed_between_syncs(local):
+    drift = 100e-6
+    clock = ScriptedClock([(t, 3.0 + drift * t, 0.002) for t in (0.0, 30.0, 60.0, 90.0)], samples=1)
+    for i in range(4):
+        assert clock.sync()
+    assert clock.drift == pytest.approx(drift)
+
+    # extrapolated from the last sync, its error bound growing with the time since
+    local[0] = 190.0
+    (now, error) = clock.now()
+    assert now == pytest.approx(190.0 + 3.0 + drift * 190.0)
+    assert error == pytest.approx(0.001 + DRIFT_ERROR * 100.0)
+
+
+def test_drift_clipped(local):
+    clock = ScriptedClock([(0.0, 0.0, 0.001), (10.0, 1.0, 0.001)], samples=1)
+    clock.sync()
+    clock.sync()
+    assert clock.drift == MAX_DRIFT
+
+
+def test_history_bounded(local):
+    clock = ScriptedClock([(float(t), 1.0, 0.001) for t in range(5)], samples=1, history=3)
+    for i in range(5):
+        clock.sync()
+    assert [s[0] for s in clock.syncs] == [2.0, 3.0, 4.0]
+    assert clock.drift == 0.0
+
+
+def test_failed_exchanges(local):
+    clock = ScriptedClock([IOError('down'), IOError('down'), (5.0, 2.0, 0.004), IOError('down')], samples=2)
+    assert not clock.sync()
+    assert clock.now() == (None, None)
+    assert clock.sync()
+    assert clock.stats()['exchanges'] == 1 and clock.stats()['failures'] == 3
+    assert clock.stats()['offset'] == 2.0
+
+
+def test_datetime_seconds():
+    dt = datetime.datetime(2019, 10, 17, 11, 9, 18, 224879)
+    assert toDatetime(toSeconds(dt)) == dt
+
+
+class TimestampServer(BaseHTTPRequestHandler):
+    offset = datetime.timedelta(seconds=42)
+    header = False
+
+    def do_GET(self):
+        server = datetime.datetime.now() + self.offset
+        self.send_response(200)
+        if self.header:
+            self.send_header('timestamp', server.strftime('%Y-%m-%d %H:%M:%S.%f'))
+            self.end_headers()
+        else:
+            self.end_headers()
+            self.wfile.write(server.strftime('%Y-%m-%d_%H-%M-%S-%f').encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class HeaderTimestampServer(TimestampServer):
+    header = True
+
+
+@pytest.mark.parametrize('handler', [TimestampServer, HeaderTimestampServer])
+def test_against_a_server(handler):
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        clock = ClockSync('http://127.0.0.1:%d/timestamp' % server.server_address[1], samples=3)
+        assert clock.sync()
+    finally:
+        server.shutdown()
+        server.server_close()
+    (now, error) = clock.now()
+    expected = toSeconds(datetime.datetime.now() + TimestampServer.offset)
+    assert abs(now - expected) < 0.05
+    assert 0 < error < 0.05
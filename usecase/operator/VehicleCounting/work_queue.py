@@ -0,0 +1,82 @@
+# Work queue shared by the operators: the notifications are acknowledged as soon as
+# their entities are queued, and processed by a pool of worker threads. The queue is
+# bounded, when it is full the notification is rejected (503) instead of making the
+# broker wait. Its depth and the time the work waited are exposed with /stats.
+# Configured with the workers and queueSize environment variables.
+
+import time
+import threading
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+
+class WorkQueue:
+
+    def __init__(self, handler, workers=2, max_size=64):
+        self.handler = handler  # called with each queued item by a worker
+        self.max_size = max(1, int(max_size))
+        self.queue = Queue(self.max_size)
+        self.lock = threading.Lock()
+
+        # counters
+        self.queued = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.process_time = 0.0
+
+        self.workers = []
+        for i in range(max(1, int(workers))):
+            thread = threading.Thread(target=self.work, name='worker-' + str(i))
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    # queue an item, never blocks; returns False if the queue is full
+    def submit(self, item):
+        try:
+            self.queue.put_nowait((item, time.time()))
+        except Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.queued += 1
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def work(self):
+        while True:
+            (item, queued_at) = self.queue.get()
+            start = time.time()
+            ok = True
+            try:
+                self.handler(item)
+            except Exception as e:
+                ok = False
+                print('failed to process a notification: ' + str(e))
+            end = time.time()
+            with self.lock:
+                wait = start - queued_at
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.process_time += end - start
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+    def stats(self):
+        with self.lock:
+            done = self.processed + self.failed
+            return {'depth': self.queue.qsize(), 'max_size': self.max_size, 'max_depth': self.max_depth,
+                    'workers': len(self.workers), 'queued': self.queued, 'rejected': self.rejected,
+                    'processed': self.processed, 'failed': self.failed,
+                    'avg_wait': round(self.wait_time / done, 6) if done > 0 else 0.0,
+                    'max_wait': round(self.max_wait, 6),
+                    'avg_process': round(self.process_time / done, 6) if done > 0 else 0.0}